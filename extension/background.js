@@ -564,8 +564,10 @@ function save_data(worker_id, data, api) {
         data: data
     }
 
-    // Send data to server, return promise with server response
-    return fetch_post_json(SERVER_URL + '/save_data', out_data)
+    // Send data to server, return promise with server response. Retry while
+    // over the server's rate limits, which would otherwise lose the data.
+    return fetch_post_json_retry(SERVER_URL + '/save_data', out_data,
+                                 SAVE_RETRIES, SAVE_RETRY_WAIT)
         .catch(function(error) {
             log_work(worker_id, 'error saving data', error)
         })
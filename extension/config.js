@@ -23,6 +23,11 @@ var EXPIRATION_CHECK_INTERVAL = (1000 * 60 * 60 * 12) // check every 12 hours
 // Server
 var SERVER_URL = (LOCAL_SERVER) ? 'http://localhost' : 'https://webusage.xyz'
 
+// Uploads the server turns away with a 429 are sent again after its
+// Retry-After, at most SAVE_RETRIES times
+var SAVE_RETRIES = 10
+var SAVE_RETRY_WAIT = 30 // seconds, without a Retry-After
+
 // Web Workers - Active
 var WORKERS = {}
 var WORKER_IDS = [
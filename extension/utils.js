@@ -411,6 +411,55 @@ function fetch_post_json(url, body){
     return data
 }
 
+/**
+ * POST a json message, waiting and trying again while the server is busy
+ * 
+ * A 429 or 503 response is retried after its Retry-After seconds, or
+ * default_wait without one. Every attempt sends the same Idempotency-Key, so
+ * the server saves a retried request once.
+ * 
+ * @param {String} url A URL to send a request to
+ * @param {String} body A jsonable object containing the request details
+ * @param {number} retries The attempts made after the first one
+ * @param {number} default_wait Seconds to wait without a Retry-After
+ * 
+ * @memberof utils
+ */
+function fetch_post_json_retry(url, body, retries, default_wait){
+
+    let details = { 
+        method: 'POST', 
+        headers: {
+            'Accept': 'application/json', 
+            'Content-Type': 'application/json',
+            'Idempotency-Key': make_id(32)
+        },
+        body: jsonify(body)
+    }
+
+    function attempt(retries_left) {
+        return fetch(url, details)
+        .then(function(response) {
+            let busy = response.status === 429 || response.status === 503
+            if (busy && retries_left > 0) {
+                let wait = parseInt(response.headers.get('Retry-After'), 10)
+                if (isNaN(wait)) wait = default_wait
+                return new Promise(function(resolve) {
+                    setTimeout(resolve, wait * 1000)
+                }).then(function() { return attempt(retries_left - 1) })
+            }
+            return response_to_json(response_validation(response))
+        })
+    }
+
+    var data = attempt(retries)
+        .catch(function(error) {
+            log_err('Request failed', error)
+        });
+
+    return data
+}
+
 /**
  * GET text content at a given URL
  * 
@@ -124,7 +124,8 @@ function check_permissions(msg) {
             to: wid,
             from: 'background',
             subject: 'api',
-            state: 'init'
+            state: 'init',
+            user_id: USER.user_id
         })
     }
 }
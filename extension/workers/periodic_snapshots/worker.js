@@ -15,6 +15,10 @@ var params = {
     process: false
 }
 
+// Last URL list received and its ETag, sent back to get a 304 while unchanged
+var url_list = []
+var url_list_etag = null
+
 onmessage = function(event) {
 
     // Receive a message
@@ -35,16 +39,14 @@ onmessage = function(event) {
     // Send message with data request
     if (msg.subject === 'api') { 
 
-        // Update search terms
-        let post_data = {request_key: "send_me_the_terms"}
-
-        fetch_post_json(SERVER_URL + '/update_search_terms', post_data)
-        .then(function(url_list) {
+        // Update search terms, the list of the user's cohort
+        fetch_search_terms(msg.user_id)
+        .then(function(urls) {
             log_console("Snapshot URLs received");
-            log_json(url_list);
+            log_json(urls);
 
             // Update URL list
-            params.urls = url_list;
+            params.urls = urls;
 
             message_background({
                 to: 'background',
@@ -75,3 +77,38 @@ onmessage = function(event) {
         });
     }
 };
+
+
+/**
+ * POST for the snapshot URL list, reusing the last one while unchanged
+ * 
+ * @param {String} user_id The user whose cohort's list to get
+ * 
+ * @memberof periodic_snapshots
+ */
+function fetch_search_terms(user_id) {
+
+    let headers = {
+        'Accept': 'application/json', 
+        'Content-Type': 'application/json' 
+    }
+    if (url_list_etag !== null) {
+        headers['If-None-Match'] = url_list_etag
+    }
+    let details = {
+        method: 'POST',
+        headers: headers,
+        body: jsonify({request_key: "send_me_the_terms", user_id: user_id})
+    }
+
+    return fetch(SERVER_URL + '/update_search_terms', details)
+    .then(function(response) {
+        if (response.status === 304) return url_list;
+        return response_to_json(response_validation(response))
+        .then(function(urls) {
+            url_list = urls;
+            url_list_etag = response.headers.get('ETag');
+            return urls;
+        });
+    });
+}
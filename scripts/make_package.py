@@ -1,64 +1,184 @@
 #!/usr/bin/env python3
-"""Utility script for building Chrome and Firefox packages."""
+"""Utility script for building Chrome and Firefox packages.
 
-import sys, os, shutil, json, termcolor, tempfile
+Both packages are built from one pass over the extension directory. Files are
+written straight into the zips, with config.js and manifest.json rewritten in
+memory for Firefox, so no copy of the extension is made.
 
-# Replace a line in a file
-def replace_file_line(filepath, original, replacement):
-    # Create temp file
-    fh, abs_path = tempfile.mkstemp()
-    with os.fdopen(fh,'w') as new_file:
-        with open(filepath) as old_file:
-            for line in old_file:
-                line = f"{replacement}\n" if line.strip() == original else line
-                new_file.write(line)
+The archives are reproducible: entries are sorted by path and carry a fixed
+timestamp and permissions, so the same sources always give the same bytes.
 
-    # Copy the file permissions from the old file to the new file
-    shutil.copymode(filepath, abs_path)
-    # Remove original file
-    os.remove(filepath)
-    # Move new file
-    shutil.move(abs_path, filepath)
+File hashes are cached by size and modification time in CACHE_PATH, and a
+package is only rebuilt when the hashes of its files, or this script, change.
+"""
 
+import sys, os, json, hashlib, termcolor, zipfile
 
 ARCHIVE_NAME = 'extension'
 ARCHIVE_EXT = 'zip'
 EXTENSION_PATH = 'extension/'
-TEMP_PATH = 'tmp/'
+CACHE_PATH = '.make_package_cache.json'
 FIREFOX_PATH = 'sqlplatform/app/static/firefox/'
 FIREFOX_URL_SLUG = 'https://webusage.xyz/static/firefox/'
 UUID = '{5b66c614-f950-4642-9017-8c590c085395}'
 
-# Remove old packages, if they exists
-try:
-    os.remove("{}-chrome.{}".format(ARCHIVE_NAME, ARCHIVE_EXT))
-except:
-    pass
-try:
-    os.remove("{}-fx.{}".format(ARCHIVE_NAME, ARCHIVE_EXT))
-except:
-    pass
-
-# Zip up a new Chrome package
-shutil.make_archive('{}-chrome'.format(ARCHIVE_NAME), ARCHIVE_EXT, EXTENSION_PATH)
-
-# Load the manifest and pull out the extension name and version number
-manifest_path = os.path.join(EXTENSION_PATH, 'manifest.json')
-with open(manifest_path, 'r') as infile:
-    manifest = json.load(infile)
-name = manifest['name']
-version = manifest['version']
-
-# Read the old Firefox updates.json
-ffupdate_path = os.path.join(FIREFOX_PATH, 'updates.json')
-ffupdate = json.loads(open(ffupdate_path).read())
-
-# Is this version already in updates.json?
-if any(u['version'] == version for u in ffupdate['addons'][UUID]['updates']):
-    print(termcolor.colored(
-        'Version {} already appears in {}updates.json'.format(version, FIREFOX_PATH),
-        'red'))
-else:
+# Fixed entry timestamp (the earliest a zip can hold) and permissions
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+ZIP_FILE_MODE = 0o644
+ZIP_COMPRESS_LEVEL = 9
+
+# Line replacements in config.js for Firefox
+FIREFOX_CONFIG_LINES = {
+    # Change hard-coded browser name in config for Firefox
+    "var BROWSER = 'chrome';": "var BROWSER = 'firefox';",
+    # Snapshots are not collected on Firefox
+    "'periodic_snapshots',": "//'periodic_snapshots',",
+}
+
+# Host permissions to handle FF CORS error
+FIREFOX_PERMISSIONS = [
+    "https://webusage.xyz/*",
+    "https://myactivity.google.com/item?*",
+    "https://adssettings.google.com/*",
+    "https://*.nielsen.com/*",
+    "https://o.bluekai.com/*"
+]
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+def load_cache():
+    try:
+        with open(CACHE_PATH, 'r') as infile:
+            return json.load(infile)
+    except (OSError, ValueError):
+        return {}
+
+def save_cache(cache):
+    tmp_path = CACHE_PATH + '.tmp'
+    with open(tmp_path, 'w') as outfile:
+        json.dump(cache, outfile, indent=1, sort_keys=True)
+    os.replace(tmp_path, CACHE_PATH)
+
+def list_files(root):
+    """Paths of the files under root, relative with '/' and sorted"""
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.relpath(os.path.join(dirpath, filename), root)
+            paths.append(path.replace(os.sep, '/'))
+    return sorted(paths)
+
+def hash_files(root, paths, cached):
+    """Content hashes of files, reusing cached ones of unchanged files
+
+    Arguments:
+        root {str} -- Directory of the files
+        paths {list} -- Paths relative to root
+        cached {dict} -- [size, mtime_ns, hash] by path, from the last run
+
+    Returns:
+        dict -- [size, mtime_ns, hash] by path
+    """
+    hashes = {}
+    for path in paths:
+        stat = os.stat(os.path.join(root, path))
+        entry = cached.get(path)
+        if entry is None or entry[:2] != [stat.st_size, stat.st_mtime_ns]:
+            with open(os.path.join(root, path), 'rb') as infile:
+                entry = [stat.st_size, stat.st_mtime_ns, sha256(infile.read())]
+        hashes[path] = entry
+    return hashes
+
+def output_state(path):
+    """Size and modification time of a built package, None if missing"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+# Rewrites of the Firefox package
+
+def firefox_config(data):
+    lines = data.decode('utf-8').splitlines(keepends=True)
+    lines = [f"{FIREFOX_CONFIG_LINES[line.strip()]}\n"
+             if line.strip() in FIREFOX_CONFIG_LINES else line
+             for line in lines]
+    return ''.join(lines).encode('utf-8')
+
+def firefox_manifest(data):
+    manifest = json.loads(data.decode('utf-8'))
+    # Add the FF settings to the manifest
+    manifest["browser_specific_settings"] = {
+        "gecko": {
+            "id": UUID,
+            "update_url": FIREFOX_URL_SLUG + "updates.json"
+        }
+    }
+    manifest["permissions"].extend(FIREFOX_PERMISSIONS)
+    return json.dumps(manifest, indent=4, sort_keys=True).encode('utf-8')
+
+# Packages by name, with the rewrites of their files
+VARIANTS = {
+    'chrome': {},
+    'fx': {
+        'config.js': firefox_config,
+        'manifest.json': firefox_manifest,
+    },
+}
+
+
+def zip_entry(path):
+    info = zipfile.ZipInfo(path, date_time=ZIP_DATE_TIME)
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.create_system = 3  # Unix, so the permissions are read the same everywhere
+    info.external_attr = ZIP_FILE_MODE << 16
+    return info
+
+def build_packages(root, paths, variants):
+    """Write the zips of the given variants in one pass over the files
+
+    Each zip is written next to its final path and moved into place once
+    complete.
+
+    Arguments:
+        root {str} -- The extension directory
+        paths {list} -- Sorted paths of its files
+        variants {dict} -- Output path by variant name
+    """
+    zips = {name: zipfile.ZipFile(output + '.tmp', 'w', zipfile.ZIP_DEFLATED,
+                                  compresslevel=ZIP_COMPRESS_LEVEL)
+            for name, output in variants.items()}
+    try:
+        for path in paths:
+            with open(os.path.join(root, path), 'rb') as infile:
+                data = infile.read()
+            for name, archive in zips.items():
+                rewrite = VARIANTS[name].get(path)
+                archive.writestr(zip_entry(path), rewrite(data) if rewrite else data,
+                                compresslevel=ZIP_COMPRESS_LEVEL)
+    finally:
+        for archive in zips.values():
+            archive.close()
+    for name, output in variants.items():
+        os.replace(output + '.tmp', output)
+
+def update_firefox_updates(name, version):
+    """Add the version to the Firefox updates.json, if it isn't there yet"""
+    ffupdate_path = os.path.join(FIREFOX_PATH, 'updates.json')
+    with open(ffupdate_path) as infile:
+        ffupdate = json.load(infile)
+
+    # Is this version already in updates.json?
+    if any(u['version'] == version for u in ffupdate['addons'][UUID]['updates']):
+        print(termcolor.colored(
+            'Version {} already appears in {}updates.json'.format(version, FIREFOX_PATH),
+            'red'))
+        return
+
     # Add the new version to ffupdate
     ffupdate['addons'][UUID]['updates'].append(
         {
@@ -75,47 +195,42 @@ else:
     with open(ffupdate_path, 'w') as f:
         f.write(json.dumps(ffupdate, indent=4, sort_keys=True))
 
-# Copy the extension to a new temp directory
-shutil.copytree(EXTENSION_PATH, TEMP_PATH)
-
-# Change hard-coded browser name in config for Firefox
-replace_file_line(
-    filepath=os.path.join(TEMP_PATH, 'config.js'), 
-    original="var BROWSER = 'chrome';", 
-    replacement="var BROWSER = 'firefox';"
-)
-
-# Change hard-coded browser name in config for Firefox
-replace_file_line(
-    filepath=os.path.join(TEMP_PATH, 'config.js'), 
-    original="'periodic_snapshots',", 
-    replacement="//'periodic_snapshots',"
-)
-
-
-# Add the FF settings to the manifest and rewrite it
-manifest["browser_specific_settings"] = {
-    "gecko": {
-        "id": UUID,
-        "update_url": FIREFOX_URL_SLUG + "updates.json"
-    }
-}
-
-# Add host permissions to handle FF CORS error
-manifest["permissions"].extend([
-    "https://webusage.xyz/*",
-    "https://myactivity.google.com/item?*",
-    "https://adssettings.google.com/*",
-    "https://*.nielsen.com/*",
-    "https://o.bluekai.com/*"
-    
-])
-
-with open(os.path.join(TEMP_PATH, 'manifest.json'), 'w') as f:
-    f.write(json.dumps(manifest, indent=4, sort_keys=True))
-
-# Zip up a new Firefox package
-shutil.make_archive('{}-fx'.format(ARCHIVE_NAME), ARCHIVE_EXT, TEMP_PATH)
 
-# Remove the temp directory
-shutil.rmtree(TEMP_PATH, ignore_errors=True)
+def main():
+    cache = load_cache()
+    paths = list_files(EXTENSION_PATH)
+    files = hash_files(EXTENSION_PATH, paths, cache.get('files', {}))
+
+    # Load the manifest and pull out the extension name and version number
+    with open(os.path.join(EXTENSION_PATH, 'manifest.json'), 'r') as infile:
+        manifest = json.load(infile)
+    update_firefox_updates(manifest['name'], manifest['version'])
+
+    # A package changes with its files and with the rewrites in this script
+    with open(__file__, 'rb') as infile:
+        script_hash = sha256(infile.read())
+    builds = cache.get('builds', {})
+    todo = {}
+    for name in VARIANTS:
+        output = '{}-{}.{}'.format(ARCHIVE_NAME, name, ARCHIVE_EXT)
+        key = sha256(json.dumps([script_hash, name, [[path, files[path][2]]
+                                                    for path in paths]]).encode('utf-8'))
+        build = builds.get(output)
+        if build is not None and build['key'] == key and \
+           build['output'] == output_state(output):
+            print('{} is up to date'.format(output))
+            continue
+        todo[name] = (output, key)
+
+    if todo:
+        build_packages(EXTENSION_PATH, paths,
+                       {name: output for name, (output, key) in todo.items()})
+        for name, (output, key) in todo.items():
+            builds[output] = dict(key=key, output=output_state(output))
+            print('Built {}'.format(output))
+
+    save_cache(dict(files=files, builds=builds))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,13 +1,19 @@
 from flask import Flask, jsonify
 from flask_sqlalchemy import SQLAlchemy
+from flask_migrate import Migrate
 
 db = SQLAlchemy()
+migrate = Migrate()
 
 def create_app():
     app = Flask(__name__)
     app.config.from_object('config.ProdConfig')
     
     db.init_app(app)
+    migrate.init_app(app, db)
+
+    from app.logs import init_logging
+    init_logging(app)
 
     from app.faq import bp as faq_bp
     app.register_blueprint(faq_bp)
@@ -18,5 +24,11 @@ def create_app():
     from app.save_data import bp as save_data_bp
     app.register_blueprint(save_data_bp)
 
+    from app.metrics import bp as metrics_bp
+    app.register_blueprint(metrics_bp)
+
+    from app.timeline import bp as timeline_bp
+    app.register_blueprint(timeline_bp)
+
 
     return app
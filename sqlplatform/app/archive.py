@@ -0,0 +1,161 @@
+"""Cold tier for old HTML blobs
+
+`python db_jobs.py html-archive` moves the compressed data of html_blob rows
+older than HTML_ARCHIVE_AGE_DAYS to append-only segment files in
+HTML_ARCHIVE_DIR and leaves the segment number, offset and length in the row.
+The bytes are copied as stored, so the blob's codec still applies.
+
+Segments are named `<number>.seg`, each with a `<number>.idx` of
+`<hash> <offset> <length>` lines, so the pointers can be rebuilt from the
+files alone. A segment is closed once it reaches HTML_ARCHIVE_SEGMENT_SIZE.
+
+Reads map the segment with mmap and slice the blob out of it, so only the
+pages of that blob are read from disk whatever the size of the segment.
+"""
+import fcntl
+import glob
+import mmap
+import os
+from collections import OrderedDict
+from threading import Lock
+
+from flask import current_app
+
+SEGMENT_EXT = '.seg'
+INDEX_EXT = '.idx'
+LOCK_FILE = 'archive.lock'
+
+# This worker's segment reader, see get_segment_reader
+segment_reader = None
+
+
+def segment_path(archive_dir, number, ext=SEGMENT_EXT):
+    return os.path.join(archive_dir, f'{number:06d}{ext}')
+
+
+class SegmentReader(object):
+    """Reads blobs out of memory-mapped segments
+
+    Arguments:
+        archive_dir {str} -- Directory of the segments
+
+    Keyword Arguments:
+        max_open {int} -- Segments kept mapped, least recently used are closed
+    """
+
+    def __init__(self, archive_dir, max_open=64):
+        self.archive_dir = archive_dir
+        self.max_open = max_open
+        self.maps = OrderedDict()
+        self.lock = Lock()
+
+    def _map(self, number, end):
+        """The mapping of a segment covering at least end bytes"""
+        mapped = self.maps.get(number)
+        if mapped is not None and len(mapped) >= end:
+            self.maps.move_to_end(number)
+            return mapped
+
+        # New segment, or one that grew since it was mapped. The old mapping
+        # is dropped first, so a failed remap leaves none behind.
+        if mapped is not None:
+            self.maps.pop(number, None)
+            mapped.close()
+        with open(segment_path(self.archive_dir, number), 'rb') as infile:
+            mapped = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(mapped) < end:
+            mapped.close()
+            raise ValueError(f'Segment {number} ends before byte {end}')
+        self.maps[number] = mapped
+        self.maps.move_to_end(number)
+        while len(self.maps) > self.max_open:
+            self.maps.popitem(last=False)[1].close()
+        return mapped
+
+    def read(self, number, offset, length):
+        """The stored bytes of a blob"""
+        with self.lock:
+            return self._map(number, offset + length)[offset:offset + length]
+
+    def close(self):
+        with self.lock:
+            for mapped in self.maps.values():
+                mapped.close()
+            self.maps.clear()
+
+
+class SegmentWriter(object):
+    """Appends blobs to the last segment, only one writer at a time
+
+    Call sync, and only then point rows at what was appended.
+
+    Arguments:
+        archive_dir {str} -- Directory of the segments
+        segment_size {int} -- Bytes after which a new segment is started
+    """
+
+    def __init__(self, archive_dir, segment_size):
+        self.archive_dir = archive_dir
+        self.segment_size = segment_size
+        os.makedirs(archive_dir, exist_ok=True)
+
+        self.lock_file = open(os.path.join(archive_dir, LOCK_FILE), 'w')
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.lock_file.close()
+            raise RuntimeError(f'Another job is writing to {archive_dir}')
+
+        numbers = [int(os.path.basename(path)[:-len(SEGMENT_EXT)])
+                   for path in glob.glob(os.path.join(archive_dir, '*' + SEGMENT_EXT))]
+        self.number = max(numbers, default=0)
+        self.segment = self.index = None
+        self._open()
+
+    def _open(self):
+        self.segment = open(segment_path(self.archive_dir, self.number), 'ab')
+        self.index = open(segment_path(self.archive_dir, self.number, INDEX_EXT), 'a')
+
+    def append(self, blob_hash, data):
+        """Append the stored bytes of a blob
+
+        Returns:
+            tuple -- Segment number, offset and length of the blob
+        """
+        if self.segment.tell() + len(data) > self.segment_size and \
+           self.segment.tell() > 0:
+            self.sync()
+            self.segment.close()
+            self.index.close()
+            self.number += 1
+            self._open()
+
+        offset = self.segment.tell()
+        self.segment.write(data)
+        self.index.write(f'{blob_hash} {offset} {len(data)}\n')
+        return self.number, offset, len(data)
+
+    def sync(self):
+        for outfile in (self.segment, self.index):
+            outfile.flush()
+            os.fsync(outfile.fileno())
+
+    def close(self):
+        self.sync()
+        self.segment.close()
+        self.index.close()
+        self.lock_file.close()
+
+
+def get_segment_reader():
+    """Get this worker's reader of the archived blobs"""
+    global segment_reader
+    if segment_reader is None:
+        config = current_app.config
+        segment_reader = SegmentReader(config['HTML_ARCHIVE_DIR'],
+                                       config['HTML_ARCHIVE_OPEN_SEGMENTS'])
+    return segment_reader
+
+def read_archived(number, offset, length):
+    """The stored bytes of an archived blob"""
+    return get_segment_reader().read(number, offset, length)
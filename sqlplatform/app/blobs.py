@@ -0,0 +1,136 @@
+"""Content-addressed, compressed storage for HTML bodies
+
+Each distinct HTML body is stored once in the `html_blob` table, keyed by the
+SHA-256 of its UTF-8 bytes and compressed with zlib, or with zstd when the
+`zstandard` package is installed. Rows in `snapshots`, `activity` and
+`website_history` keep the hash in `html_hash`.
+
+Blobs older than HTML_ARCHIVE_AGE_DAYS are moved out of the table into
+segment files, see app.archive.
+
+The same codecs compress the JSON payloads of the generic `data` table.
+"""
+import base64
+import hashlib
+import json
+import zlib
+
+from flask import current_app
+
+from app import db
+from app.archive import read_archived
+from app.cache import LRUCache
+from app.models import HtmlBlob
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Hashes of blobs this worker has committed, see get_stored_blobs
+stored_blobs = None
+
+
+def hash_html(html):
+    """Hex SHA-256 digest of an HTML string"""
+    return hashlib.sha256(html.encode('utf-8')).hexdigest()
+
+def compress(raw, codec):
+    """Compress bytes with a codec name ('zlib' or 'zstd')"""
+    if codec == 'zlib':
+        return zlib.compress(raw, 6)
+    elif codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('zstd codec requires the zstandard package')
+        return zstandard.ZstdCompressor(level=3).compress(raw)
+    raise ValueError(f'Unknown codec: {codec}')
+
+def decompress(data, codec):
+    """Decompress bytes written by compress"""
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    elif codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('zstd codec requires the zstandard package')
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError(f'Unknown codec: {codec}')
+
+def blob_text(codec, data, segment=None, offset=None, length=None):
+    """The HTML of an html_blob row, from the row or its archive segment
+
+    Arguments:
+        codec {str} -- The `codec` column
+        data {bytes} -- The `data` column, None once archived
+
+    Keyword Arguments:
+        segment, offset, length {int} -- The `archive_*` columns
+    """
+    if data is None and segment is not None:
+        data = read_archived(segment, offset, length)
+    return decompress(data, codec).decode('utf-8')
+
+def decode_data(data, payload, codec):
+    """Decode the JSON payload of a `data` row
+
+    Arguments:
+        data {str} -- The `data` column, base64 JSON in rows without a codec
+        payload {bytes} -- The `payload` column, compressed JSON
+        codec {str} -- The `codec` column, None for base64 rows
+
+    Returns:
+        The decoded JSON value, or data as is when it holds no payload
+    """
+    if codec is not None:
+        return json.loads(decompress(payload, codec).decode('utf-8'))
+    try:
+        return json.loads(base64.urlsafe_b64decode(data).decode('utf-8'))
+    except (TypeError, ValueError):
+        # e.g. 'error: no data received'
+        return data
+
+def get_stored_blobs():
+    """Get this worker's LRU of recently committed blob hashes"""
+    global stored_blobs
+    if stored_blobs is None:
+        stored_blobs = LRUCache(current_app.config['HTML_BLOB_CACHE_SIZE'])
+    return stored_blobs
+
+def extract_html(rows):
+    """Replace the html of each row with a blob hash
+
+    Arguments:
+        rows {list} -- Row dicts, modified in place
+
+    Returns:
+        dict -- HTML bodies keyed by hash, one per distinct body
+    """
+    blobs = {}
+    for row in rows:
+        html = row.pop('html', None)
+        if html is not None:
+            row['html_hash'] = hash_html(html)
+            blobs[row['html_hash']] = html
+    return blobs
+
+def put_blobs(blobs):
+    """Insert blobs that are not stored yet, without committing
+
+    Arguments:
+        blobs {dict} -- HTML bodies keyed by hash
+    """
+    stored = get_stored_blobs()
+    codec = current_app.config['HTML_BLOB_CODEC']
+    new_blobs = []
+    for blob_hash, html in blobs.items():
+        if blob_hash in stored:
+            continue
+        raw = html.encode('utf-8')
+        new_blobs.append(dict(hash=blob_hash, codec=codec, size=len(raw),
+                              data=compress(raw, codec)))
+
+    if new_blobs:
+        insert = HtmlBlob.__table__.insert()\
+                    .prefix_with('IGNORE', dialect='mysql')\
+                    .prefix_with('OR IGNORE', dialect='sqlite')
+        db.session.execute(insert, new_blobs)
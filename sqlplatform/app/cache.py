@@ -0,0 +1,55 @@
+"""Per-worker in-memory caches
+"""
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache(object):
+    """Bounded mapping that evicts the least recently used key
+
+    Each gunicorn worker holds its own instances, so a cache only ever knows
+    about the requests that worker has served.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                return True
+            return False
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                return self._data[key]
+            return default
+
+    def set(self, key, value=True):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def update(self, keys, value=True):
+        for key in keys:
+            self.set(key, value)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
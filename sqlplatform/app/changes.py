@@ -0,0 +1,32 @@
+"""Rows changed in place, for the incremental backups
+
+An incremental segment of db_backup.py holds the rows added since the last
+one and, dumped again whole, the id ranges recorded in row_change since.
+Jobs that update or delete existing rows record the ranges they touch with
+record_change, in the transaction of the change, so a backup that sees the
+change also sees the range. db_export.py reads the ranges the same way.
+
+Ids are handed out when a row is inserted, not when it is committed, so both
+only read up to the ids that existed TRANSACTION_MARGIN before, when every
+row with a lower id had been committed.
+"""
+from datetime import datetime, timedelta
+
+from app.models import RowChange
+
+# Longest a transaction inserting rows stays open, the drainer's, a db_jobs.py
+# chunk or a /save_data request
+TRANSACTION_MARGIN = timedelta(hours=1)
+
+
+def record_change(conn, table_name, id_start, id_end):
+    """Record that rows with id_start <= id < id_end of a table changed
+
+    Arguments:
+        conn {Connection} -- Connection in the transaction of the change
+        table_name {str} -- The changed table
+        id_start {int} -- First id of the range
+        id_end {int} -- Id after the range
+    """
+    conn.execute(RowChange.__table__.insert(), table_name=table_name,
+                 id_start=id_start, id_end=id_end, created=datetime.utcnow())
@@ -2,10 +2,12 @@
 """
 from flask import render_template
 from app.faq import bp
+from app.pages import cached_page
 
 
 @bp.route('/faq', methods=['GET'])
 @bp.route('/faq/', methods=['GET'])
+@cached_page
 def faq():
     # make_connection()
     return render_template('faq.html', title='FAQ', faq=faq_content)
@@ -0,0 +1,190 @@
+"""Features of captured pages, parsed once from their HTML
+
+extract_page turns one stored page into an ExtractedPage row and its
+ExtractedItem rows:
+
+- `link`: links to other sites, in page order
+- `result`: search results, links around an <h3> as on Google, ranked from 0
+- `video`: YouTube video ids linked or embedded, first occurrence
+- `tweet`: ids of linked tweets
+- `captured_link`, `captured_tweet`, `captured_iframe`: the JSON lists the
+  extension sent with activity captures
+
+It runs in the worker processes of db_features.py, so it only gets plain
+values and never touches the database.
+"""
+import json
+import re
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlsplit, parse_qs
+
+from app.blobs import decompress
+from app.urls import url_domain
+
+# Bump when the extraction changes, then rerun db_features.py with --rebuild
+EXTRACTOR_VERSION = 1
+
+VIDEO_ID = re.compile(r'(?:youtube\.com/(?:watch\?(?:.*&)?v=|embed/|shorts/)|'
+                      r'youtu\.be/)([\w-]{11})')
+TWEET_ID = re.compile(r'(?:twitter|x)\.com/\w+/status(?:es)?/(\d+)')
+
+# Longest value kept in an item
+MAX_VALUE = 2048
+
+
+class PageParser(HTMLParser):
+    """Collects the title, links, results and embeds of a page
+
+    Arguments:
+        base_url {str} -- URL of the page, to resolve relative links
+    """
+
+    def __init__(self, base_url):
+        super().__init__(convert_charrefs=True)
+        self.base_url = base_url or ''
+        self.title = []
+        self.in_title = False
+        self.links = []
+        self.results = []
+        self.embeds = []
+        # href of the <a> being parsed, and whether it holds an <h3>
+        self.anchor = None
+        self.anchor_h3 = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'title':
+            self.in_title = True
+        elif tag == 'a':
+            href = dict(attrs).get('href')
+            self.anchor = self.resolve(href) if href else None
+            self.anchor_h3 = False
+            if self.anchor:
+                self.links.append(self.anchor)
+        elif tag == 'h3' and self.anchor:
+            self.anchor_h3 = True
+        elif tag == 'iframe':
+            src = dict(attrs).get('src')
+            if src:
+                self.embeds.append(self.resolve(src))
+
+    def handle_endtag(self, tag):
+        if tag == 'title':
+            self.in_title = False
+        elif tag == 'a':
+            if self.anchor and self.anchor_h3:
+                self.results.append(self.anchor)
+            self.anchor = None
+
+    def handle_data(self, data):
+        if self.in_title:
+            self.title.append(data)
+
+    def resolve(self, href):
+        """Absolute URL of a link, unwrapping Google's /url?q= redirects"""
+        try:
+            url = urljoin(self.base_url, href.strip())
+            parts = urlsplit(url)
+        except ValueError:
+            return None
+        if parts.scheme not in ('http', 'https'):
+            return None
+        if parts.path == '/url' and 'google.' in parts.netloc:
+            query = parse_qs(parts.query)
+            target = (query.get('q') or query.get('url') or [None])[0]
+            if target and target.startswith('http'):
+                return target
+        return url
+
+
+def page_html(html, codec=None, data=None):
+    """The HTML of a stored page
+
+    Activity captures of mutations are stored as a JSON list of fragments,
+    which are joined.
+
+    Arguments:
+        html {str} -- Inline html of the row, None when in the blob store
+        codec {str} -- Codec of the blob
+        data {bytes} -- Compressed blob
+    """
+    if html is None:
+        if data is None:
+            return ''
+        html = decompress(data, codec).decode('utf-8')
+    if html.startswith('["'):
+        try:
+            fragments = json.loads(html)
+        except ValueError:
+            return html
+        if isinstance(fragments, list):
+            return ''.join(f for f in fragments if isinstance(f, str))
+    return html
+
+def json_list(value):
+    """Items of a JSON encoded list column, [] if it is not one"""
+    if not value:
+        return []
+    try:
+        items = json.loads(value)
+    except ValueError:
+        return []
+    return items if isinstance(items, list) else []
+
+def first_seen(values):
+    seen = set()
+    for value in values:
+        if value not in seen:
+            seen.add(value)
+            yield value
+
+def extract_page(task):
+    """Parse one page
+
+    Arguments:
+        task {dict} -- source, source_id and url of the row, its html (or
+                       codec and compressed data), and for activity the
+                       links, tweet_ids and youtube_iframes columns
+
+    Returns:
+        tuple -- The ExtractedPage row dict and a list of ExtractedItem
+                 row dicts
+    """
+    page_domain = url_domain(task.get('url') or '') or None
+    # Every page has the same keys, the batches are inserted with executemany
+    page = dict(source=task['source'], source_id=task['source_id'],
+                domain=page_domain, title=None, html_size=None, n_links=None,
+                n_results=None, version=EXTRACTOR_VERSION, error=None)
+    items = []
+    def add(kind, values):
+        for position, value in enumerate(values):
+            if value is None:
+                continue
+            value = str(value)[:MAX_VALUE]
+            items.append(dict(source=task['source'], source_id=task['source_id'],
+                              kind=kind, position=position, value=value,
+                              domain=url_domain(value) if '://' in value else None))
+
+    try:
+        html = page_html(task.get('html'), task.get('codec'), task.get('data'))
+        parser = PageParser(task.get('url'))
+        parser.feed(html)
+        parser.close()
+
+        hrefs = parser.links + parser.embeds
+        add('link', first_seen(url for url in parser.links
+                               if url_domain(url) != page_domain))
+        add('result', parser.results)
+        add('video', first_seen(match.group(1) for url in hrefs
+                                for match in [VIDEO_ID.search(url)] if match))
+        add('tweet', first_seen(match.group(1) for url in parser.links
+                                for match in [TWEET_ID.search(url)] if match))
+        page.update(title=' '.join(''.join(parser.title).split())[:MAX_VALUE] or None,
+                    html_size=len(html), n_links=len(parser.links),
+                    n_results=len(parser.results))
+    except Exception as e:
+        page['error'] = f'{type(e).__name__}: {e}'[:255]
+
+    add('captured_link', json_list(task.get('links')))
+    add('captured_tweet', json_list(task.get('tweet_ids')))
+    add('captured_iframe', json_list(task.get('youtube_iframes')))
+    return page, items
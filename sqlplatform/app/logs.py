@@ -0,0 +1,250 @@
+"""Structured logging off the request path
+
+Records are JSON objects, one per line: time, level, event, message, the
+request id, user_id and api of the request that logged them, and the fields
+passed to log_event. The event names the type of message, e.g. 'request'
+for the summary logged after each /save_data request.
+
+Request threads only put records on a bounded queue. A listener thread
+formats them and writes them to LOG_FILE, or stderr when unset, which
+gunicorn's capture_output passes to its error log. When the queue is full
+records are dropped and counted rather than waited on.
+
+Each event can be sampled (LOG_SAMPLING, the share of its records kept) and
+rate limited per worker (LOG_RATE_LIMITS, token buckets of records per second
+and burst). Warnings and errors are never sampled. The next record of an
+event after some were dropped carries their number in `suppressed`.
+
+Errors answered to a client are logged with their traceback under an error
+id, and only the id is sent back, see log_error.
+"""
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+import time
+import traceback
+import uuid
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, WatchedFileHandler
+
+from flask import g, has_request_context, request
+
+# Logger of the application's records, app.logger shares its handler
+logger = logging.getLogger('sqlplatform')
+
+# This process's queue handler, see init_logging
+queue_handler = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as a line of JSON"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.utcfromtimestamp(record.created)
+                            .isoformat(timespec='milliseconds') + 'Z',
+            'level': record.levelname,
+            'event': getattr(record, 'event', record.name),
+            'message': record.getMessage(),
+            'pid': record.process,
+        }
+        entry.update(getattr(record, 'fields', None) or {})
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            entry['suppressed'] = suppressed
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        elif record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps a share of the records of each event, at a rate at most
+
+    Arguments:
+        sampling {dict} -- Share of records kept by event, 1 if missing
+        rate_limits {dict} -- (records per second, burst) by event, with a
+                              'default' entry; None for no limit
+    """
+
+    def __init__(self, sampling, rate_limits):
+        super().__init__()
+        self.sampling = sampling
+        self.rate_limits = rate_limits
+        self.buckets = {}
+        self.suppressed = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        event = getattr(record, 'event', record.name)
+        if record.levelno < logging.WARNING and \
+           random.random() >= self.sampling.get(event, 1):
+            return False
+
+        limit = self.rate_limits.get(event, self.rate_limits['default'])
+        with self.lock:
+            if limit is not None:
+                rate, burst = limit
+                now = time.monotonic()
+                tokens, updated = self.buckets.get(event, (burst, now))
+                tokens = min(tokens + (now - updated) * rate, burst)
+                if tokens < 1:
+                    self.buckets[event] = (tokens, now)
+                    self.suppressed[event] = self.suppressed.get(event, 0) + 1
+                    return False
+                self.buckets[event] = (tokens - 1, now)
+            record.suppressed = self.suppressed.pop(event, 0)
+        return True
+
+
+class Listener(QueueListener):
+    """Writes out the queued records in a thread"""
+
+    def enqueue_sentinel(self):
+        # Wait for room when stopping rather than lose the records before it
+        self.queue.put(self._sentinel)
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Puts records on a bounded queue, dropping them when it is full
+
+    The listener thread is started in the process that logs first, so a
+    handler inherited over a fork starts one of its own.
+
+    Arguments:
+        maxsize {int} -- Records the queue holds
+        target {logging.Handler} -- Handler the listener writes records to
+    """
+
+    def __init__(self, maxsize, target):
+        super().__init__(queue.Queue(maxsize))
+        self.target = target
+        self.listener = None
+        self.pid = None
+        self.dropped = 0
+        self.start_lock = threading.Lock()
+
+    def prepare(self, record):
+        # A queued record must not keep the frames of its traceback, and the
+        # request objects they hold, alive. The traceback and message are
+        # made text here, the JSON is left to the listener thread.
+        record = copy.copy(record)
+        if record.exc_info:
+            record.exc_text = ''.join(
+                traceback.TracebackException(*record.exc_info).format()).rstrip('\n')
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if self.pid != os.getpid():
+            self.start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        with self.start_lock:
+            if self.pid == os.getpid():
+                return
+            # The queue of the parent may hold its records, start anew
+            self.queue = queue.Queue(self.queue.maxsize)
+            self.listener = Listener(self.queue, self.target,
+                                     respect_handler_level=True)
+            self.listener.start()
+            self.pid = os.getpid()
+
+    def stop(self):
+        """Write out the queued records, e.g. at exit"""
+        if self.listener is not None and self.pid == os.getpid():
+            self.listener.stop()
+            self.pid = None
+        if self.dropped:
+            self.target.handle(logging.makeLogRecord(dict(
+                name=logger.name, levelno=logging.WARNING, levelname='WARNING',
+                msg=f'{self.dropped} records dropped, the log queue was full')))
+
+
+def init_logging(app):
+    """Send the records of the app and its logger through the queue
+
+    Arguments:
+        app {Flask} -- The application, configured
+    """
+    global queue_handler
+    config = app.config
+    if queue_handler is None:
+        if config['LOG_FILE']:
+            target = WatchedFileHandler(config['LOG_FILE'])
+        else:
+            target = logging.StreamHandler(sys.stderr)
+        target.setFormatter(JsonFormatter())
+
+        queue_handler = NonBlockingQueueHandler(config['LOG_QUEUE_SIZE'], target)
+        queue_handler.addFilter(SamplingFilter(config['LOG_SAMPLING'],
+                                               config['LOG_RATE_LIMITS']))
+        atexit.register(queue_handler.stop)
+
+        logger.handlers = [queue_handler]
+        logger.setLevel(config['LOG_LEVEL'])
+        logger.propagate = False
+
+    # app.logger records go through the queue too, with the app's name as event
+    app.logger.handlers = [queue_handler]
+    app.logger.setLevel(config['LOG_LEVEL'])
+    app.logger.propagate = False
+
+    @app.before_request
+    def set_request_id():
+        g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+
+    @app.after_request
+    def add_request_id(response):
+        response.headers['X-Request-ID'] = g.get('request_id', '')
+        return response
+
+
+def request_fields():
+    """Request id, user_id and api of the current request, if any"""
+    if not has_request_context():
+        return {}
+    return dict(request_id=g.get('request_id'), user_id=g.get('user_id'),
+                api=g.get('api'))
+
+def log_event(event, message='', level=logging.INFO, exc_info=None, **fields):
+    """Log a record of an event with fields
+
+    Arguments:
+        event {str} -- Type of message, sampled and rate limited on its own
+        message {str} -- Text of the record
+
+    Keyword Arguments:
+        level {int} -- Logging level (default: INFO)
+        exc_info -- Passed on to the logger, to log a traceback
+        fields -- Added to the JSON record
+    """
+    if not logger.isEnabledFor(level):
+        return
+    fields = {**request_fields(), **fields}
+    logger.log(level, message, exc_info=exc_info,
+               extra=dict(event=event, fields=fields))
+
+def log_error(event, message):
+    """Log the exception being handled under a new error id
+
+    Returns:
+        str -- The error id, to send to the client instead of the traceback
+    """
+    error_id = uuid.uuid4().hex[:12]
+    log_event(event, message, level=logging.ERROR, exc_info=True,
+              error_id=error_id)
+    return error_id
@@ -0,0 +1,79 @@
+"""Ingestion metrics, exported at /metrics
+
+Under gunicorn, `prometheus_multiproc_dir` is set by
+deployment/gunicorn.config.py and every worker writes its samples to
+memory-mapped files there, which /metrics adds up across workers. Without it,
+e.g. with the Flask development server, samples stay in the process.
+"""
+from contextlib import contextmanager
+import sys
+import time
+
+from prometheus_client import Counter, Histogram
+
+# apis with a model of their own, everything else is counted as generic
+APIS = ('browser_history', 'periodic_snapshots', 'activity', 'website_history')
+
+SECONDS_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 180)
+BYTES_BUCKETS = tuple(1024 * 4 ** i for i in range(11))  # 1 KiB to 1 GiB
+
+REQUESTS = Counter(
+    'save_data_requests_total', '/save_data requests by api and HTTP status',
+    ['api', 'status'])
+REQUEST_SECONDS = Histogram(
+    'save_data_request_seconds', 'Time to handle a /save_data request',
+    ['api'], buckets=SECONDS_BUCKETS)
+REQUEST_BYTES = Histogram(
+    'save_data_request_bytes', 'Request body size as received',
+    ['api'], buckets=BYTES_BUCKETS)
+DECOMPRESSED_BYTES = Counter(
+    'save_data_decompressed_bytes_total',
+    'Bytes of gzip/deflate request bodies once decompressed', ['api'])
+ERRORS = Counter(
+    'save_data_errors_total', '/save_data requests that failed, by exception',
+    ['api', 'error'])
+RATE_LIMITED = Counter(
+    'save_data_rate_limited_total',
+    '/save_data requests answered 429, by api and the limit hit',
+    ['api', 'limit'])
+REJECTED_PARTICIPANTS = Counter(
+    'save_data_rejected_participants_total',
+    '/save_data requests of participants whose data is not saved, by reason',
+    ['api', 'reason'])
+UNKNOWN_PARTICIPANTS = Counter(
+    'save_data_unknown_participants_total',
+    '/save_data requests saved for user ids without a user row', ['api'])
+DUPLICATE_REQUESTS = Counter(
+    'save_data_duplicate_requests_total',
+    'Retried /save_data requests answered without saving again', ['api'])
+ROWS_INSERTED = Counter(
+    'db_rows_inserted_total', 'Rows inserted by table', ['table'])
+COMMIT_SECONDS = Histogram(
+    'db_commit_seconds', 'Time to commit the rows of a request or batch',
+    buckets=SECONDS_BUCKETS)
+
+
+def api_label(api):
+    """Metric label of an api, with a bounded set of values"""
+    if api in APIS:
+        return api
+    return 'generic' if api else 'unknown'
+
+def count_error(api):
+    """Count the exception being handled"""
+    ERRORS.labels(api_label(api), sys.exc_info()[0].__name__).inc()
+
+@contextmanager
+def time_commit():
+    start = time.perf_counter()
+    yield
+    COMMIT_SECONDS.observe(time.perf_counter() - start)
+
+def count_rows(n_rows):
+    """Count inserted rows
+
+    Arguments:
+        n_rows {dict} -- The number of rows keyed by model
+    """
+    for model, count in n_rows.items():
+        ROWS_INSERTED.labels(model.__tablename__).inc(count)
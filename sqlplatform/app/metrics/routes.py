@@ -0,0 +1,22 @@
+"""Prometheus metrics
+"""
+import os
+
+from flask import Response
+from prometheus_client import (
+    CollectorRegistry, REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+)
+from prometheus_client import multiprocess
+
+from app.metrics import bp
+
+
+@bp.route('/metrics')
+def metrics():
+    """Metrics of all workers in the Prometheus text format"""
+    if 'prometheus_multiproc_dir' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
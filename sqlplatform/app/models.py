@@ -8,37 +8,214 @@ MEDIUMTEXT |    16,777,215 (224−1) bytes = 16 MiB
   LONGTEXT | 4,294,967,295 (232−1) bytes =  4 GiB
 
 """
+from datetime import datetime
+
+from sqlalchemy.dialects import mysql
+from sqlalchemy.ext.declarative import declared_attr
+
 from app import db
 
+# UTC datetime with millisecond precision, as sent by the extension
+Timestamp = db.DateTime().with_variant(mysql.DATETIME(fsp=3), 'mysql')
+
+
+def user_time_index(table):
+    """Index for per-user time range queries"""
+    return db.Index(f'ix_{table}_user_timestamp', 'user_id', 'timestamp')
+
+
 class User(db.Model):
     __tablename__ = 'user'
+    __table_args__ = (
+        db.Index('ux_user_user_id', 'user_id', unique=True),
+    )
     id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     user_id = db.Column(db.String(128))
     browser = db.Column(db.String(10))
     consent = db.Column(db.Boolean)
     consent_fb = db.Column(db.Boolean)
-    install_time = db.Column(db.String(128))
+    install_time = db.Column(Timestamp)
     version = db.Column(db.String(10))
     
     def __repr__(self):
         return '<User %r>' % self.id
 
+
+class UserReinstall(db.Model):
+    """A later registration of a user_id, as it was sent
+
+    The user row keeps the install_time of the first registration and takes
+    the other values of the last one.
+    """
+    __tablename__ = 'user_reinstall'
+    id = db.Column(db.Integer, autoincrement=True, primary_key=True)
+    user_id = db.Column(db.String(128), index=True)
+    browser = db.Column(db.String(10))
+    consent = db.Column(db.Boolean)
+    consent_fb = db.Column(db.Boolean)
+    install_time = db.Column(Timestamp)
+    version = db.Column(db.String(10))
+    created = db.Column(db.DateTime, default=datetime.utcnow)
+
 class Data(db.Model):
+    """Data of apis without a model of their own
+
+    The JSON payload is stored compressed in `payload`, with the codec in
+    `codec`. Rows saved before have no codec and keep the payload as base64
+    encoded JSON in `data`, see app.blobs.decode_data.
+    """
     __tablename__ = 'data'
+    __table_args__ = (user_time_index('data'),)
     id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     api = db.Column(db.String(128))
     data = db.Column(db.Text(4294000000))
+    payload = db.Column(db.LargeBinary(4294000000))
+    codec = db.Column(db.String(10))
     user_id = db.Column(db.String(128))
     worker_id = db.Column(db.String(128))
-    timestamp = db.Column(db.String(128))
+    timestamp = db.Column(Timestamp)
     version = db.Column(db.String(25))
 
+    @property
+    def decoded(self):
+        """The decoded JSON payload"""
+        from app.blobs import decode_data
+        return decode_data(self.data, self.payload, self.codec)
+
     def __repr__(self):
         return '<Data %r>' % self.id
 
 
-class BrowserHistory(db.Model):
+class HtmlBlob(db.Model):
+    """Compressed HTML body stored once per distinct content, see app.blobs
+
+    Old blobs have their data moved to segment files, see app.archive, and
+    keep where it is in the `archive_*` columns.
+    """
+    __tablename__ = 'html_blob'
+    id = db.Column(db.Integer, autoincrement=True, primary_key=True)
+    hash = db.Column(db.String(64), unique=True, nullable=False)
+    codec = db.Column(db.String(10))
+    size = db.Column(db.BigInteger)
+    data = db.Column(db.LargeBinary(4294000000))
+    created = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    archive_segment = db.Column(db.Integer)
+    archive_offset = db.Column(db.BigInteger)
+    archive_length = db.Column(db.BigInteger)
+
+    @property
+    def text(self):
+        """The decompressed HTML"""
+        from app.blobs import blob_text
+        return blob_text(self.codec, self.data, self.archive_segment,
+                         self.archive_offset, self.archive_length)
+
+
+class HtmlBlobMixin(object):
+    """HTML stored in html_blob and referenced by hash
+
+    Rows saved before the blob store keep their HTML in the `html` column.
+    """
+    html_hash = db.Column(db.String(64))
+
+    @declared_attr
+    def html_blob(cls):
+        return db.relationship(
+            'HtmlBlob', viewonly=True, uselist=False,
+            primaryjoin=f'foreign({cls.__name__}.html_hash) == HtmlBlob.hash'
+        )
+
+    @property
+    def html_text(self):
+        """The decompressed HTML, from the blob store or the legacy column"""
+        if self.html_hash is not None:
+            return self.html_blob.text
+        return self.html
+
+
+class Url(db.Model):
+    """Distinct URL referenced by id from the history tables, see app.urls"""
+    __tablename__ = 'url'
+    id = db.Column(db.Integer, autoincrement=True, primary_key=True)
+    url_hash = db.Column(db.String(64), unique=True, nullable=False)
+    url = db.Column(db.Text)
+    domain = db.Column(db.String(255), index=True)
+
+
+class UrlMixin(object):
+    """URL stored once in the url table and referenced by id
+
+    Rows saved before URL interning keep their URL in the `url` column.
+    """
+    url_id = db.Column(db.Integer, index=True)
+
+    @declared_attr
+    def url_ref(cls):
+        return db.relationship(
+            'Url', viewonly=True, uselist=False,
+            primaryjoin=f'foreign({cls.__name__}.url_id) == Url.id'
+        )
+
+    @property
+    def url_text(self):
+        """The URL, from the url table or the legacy column"""
+        if self.url_id is not None:
+            return self.url_ref.url
+        return self.url
+
+
+class RequestKey(db.Model):
+    """Key of a saved /save_data request, to skip retries, see save_rows"""
+    __tablename__ = 'request_key'
+    id = db.Column(db.Integer, autoincrement=True, primary_key=True)
+    key = db.Column(db.String(64), unique=True, nullable=False)
+    created = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+
+class TablePartition(db.Model):
+    """Catalog of the monthly partitions of a large table, see db_partitions.py
+
+    A partition holds the rows with id_start <= id < id_end, which arrived
+    from period_start until period_end (None for the current partition).
+    """
+    __tablename__ = 'table_partition'
+    __table_args__ = (
+        db.Index('ux_table_partition_name', 'table_name', 'name', unique=True),
+    )
+    id = db.Column(db.Integer, autoincrement=True, primary_key=True)
+    table_name = db.Column(db.String(64), nullable=False)
+    name = db.Column(db.String(64), nullable=False)
+    id_start = db.Column(db.BigInteger)
+    id_end = db.Column(db.BigInteger)
+    period_start = db.Column(db.DateTime)
+    period_end = db.Column(db.DateTime)
+    # 'active', 'archived' to a table of its own, or 'dropped'
+    state = db.Column(db.String(10), default='active')
+    archive_table = db.Column(db.String(64))
+
+    def __repr__(self):
+        return '<TablePartition %r>' % self.name
+
+
+class RowChange(db.Model):
+    """Rows with id_start <= id < id_end of a table updated or deleted in
+    place, which the next incremental backup reads again, see app/changes.py
+    """
+    __tablename__ = 'row_change'
+    id = db.Column(db.Integer, autoincrement=True, primary_key=True)
+    table_name = db.Column(db.String(64), nullable=False)
+    id_start = db.Column(db.BigInteger, nullable=False)
+    id_end = db.Column(db.BigInteger, nullable=False)
+    created = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class BrowserHistory(UrlMixin, db.Model):
     __tablename__ = 'browser_history'
+    __table_args__ = (
+        # Deduplicate history visits in the database, see handle_browser_history
+        db.Index('uq_browser_history_user_hv', 'user_id', 'hv_id', unique=True),
+        user_time_index('browser_history'),
+    )
     sql_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     hv_id = db.Column(db.String(260))
     id = db.Column(db.String(128))
@@ -49,24 +226,26 @@ class BrowserHistory(db.Model):
     transition = db.Column(db.String(25))
     user_id = db.Column(db.String(128))
     worker_id = db.Column(db.String(128))
-    timestamp = db.Column(db.String(128))
+    timestamp = db.Column(Timestamp)
     version = db.Column(db.String(25))
 
 
-class WebsiteHistory(db.Model):
+class WebsiteHistory(UrlMixin, HtmlBlobMixin, db.Model):
     __tablename__ = 'website_history'
+    __table_args__ = (user_time_index('website_history'),)
     id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     url = db.Column(db.Text)
     name = db.Column(db.String(25))
     html = db.Column(db.Text(4294000000))
     user_id = db.Column(db.String(128))
     worker_id = db.Column(db.String(128))
-    timestamp = db.Column(db.String(128))
+    timestamp = db.Column(Timestamp)
     version = db.Column(db.String(25))
 
 
-class Snapshots(db.Model):
+class Snapshots(UrlMixin, HtmlBlobMixin, db.Model):
     __tablename__ = 'snapshots'
+    __table_args__ = (user_time_index('snapshots'),)
     id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     wintab = db.Column(db.String(128))
     incognito = db.Column(db.Boolean)
@@ -74,12 +253,13 @@ class Snapshots(db.Model):
     html = db.Column(db.Text(4294000000))
     user_id = db.Column(db.String(128))
     worker_id = db.Column(db.String(128))
-    timestamp = db.Column(db.String(128))
+    timestamp = db.Column(Timestamp)
     version = db.Column(db.String(25))
 
 
-class Activity(db.Model):
+class Activity(UrlMixin, HtmlBlobMixin, db.Model):
     __tablename__ = 'activity'
+    __table_args__ = (user_time_index('activity'),)
     id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     wintab = db.Column(db.String(128)) 
     lastwt = db.Column(db.String(128)) 
@@ -91,5 +271,62 @@ class Activity(db.Model):
     youtube_iframes = db.Column(db.Text)
     user_id = db.Column(db.String(128))
     worker_id = db.Column(db.String(128))
-    timestamp = db.Column(db.String(128))
+    timestamp = db.Column(Timestamp)
     version = db.Column(db.String(25))
+
+
+class ExtractedPage(db.Model):
+    """A snapshot, activity or website history page parsed by db_features.py
+
+    The rows of its links, results, video and tweet ids are ExtractedItem
+    rows with the same source and source_id, see app/features.py.
+    """
+    __tablename__ = 'extracted_page'
+    __table_args__ = (
+        db.Index('ux_extracted_page_source', 'source', 'source_id', unique=True),
+        user_time_index('extracted_page'),
+    )
+    id = db.Column(db.Integer, autoincrement=True, primary_key=True)
+    # Table and id of the parsed row
+    source = db.Column(db.String(32), nullable=False)
+    source_id = db.Column(db.Integer, nullable=False)
+    user_id = db.Column(db.String(128))
+    timestamp = db.Column(Timestamp)
+    url_id = db.Column(db.Integer)
+    domain = db.Column(db.String(255), index=True)
+    title = db.Column(db.Text)
+    html_size = db.Column(db.BigInteger)
+    n_links = db.Column(db.Integer)
+    n_results = db.Column(db.Integer)
+    # EXTRACTOR_VERSION that parsed it, and why it failed if it did
+    version = db.Column(db.Integer)
+    error = db.Column(db.String(255))
+
+
+class ExtractedItem(db.Model):
+    """A link, search result, video or tweet id of an extracted page"""
+    __tablename__ = 'extracted_item'
+    __table_args__ = (
+        db.Index('ix_extracted_item_source', 'source', 'source_id'),
+        db.Index('ix_extracted_item_kind_domain', 'kind', 'domain'),
+    )
+    id = db.Column(db.Integer, autoincrement=True, primary_key=True)
+    source = db.Column(db.String(32), nullable=False)
+    source_id = db.Column(db.Integer, nullable=False)
+    # 'link', 'result', 'video', 'tweet', or 'captured_*' for the JSON columns
+    # of activity
+    kind = db.Column(db.String(16), nullable=False)
+    # Order on the page, the rank of a result
+    position = db.Column(db.Integer)
+    value = db.Column(db.Text)
+    domain = db.Column(db.String(255))
+
+
+class ExtractWatermark(db.Model):
+    """Last id of a table parsed by db_features.py"""
+    __tablename__ = 'extract_watermark'
+    id = db.Column(db.Integer, autoincrement=True, primary_key=True)
+    source = db.Column(db.String(32), unique=True, nullable=False)
+    last_id = db.Column(db.BigInteger, default=0)
+    version = db.Column(db.Integer)
+    updated = db.Column(db.DateTime, default=datetime.utcnow)
@@ -0,0 +1,84 @@
+"""Cache of pre-rendered, precompressed static pages
+
+The index, privacy, FAQ and snapshot pages only change between deploys. Each
+worker renders a page on its first request and keeps the HTML with its gzip
+and, when the `brotli` package is installed, brotli encodings. Later requests
+get the variant matching Accept-Encoding, or a 304 when the client's copy is
+current.
+"""
+import functools
+import gzip
+import hashlib
+from datetime import datetime
+
+from flask import current_app, request, Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Rendered pages of this worker by endpoint
+pages = {}
+
+
+class Page(object):
+    """The encoded variants of a rendered page
+
+    Arguments:
+        html {str} -- The rendered page
+    """
+
+    def __init__(self, html):
+        body = html.encode('utf-8')
+        self.variants = {'identity': body, 'gzip': gzip.compress(body, 9)}
+        if brotli is not None:
+            self.variants['br'] = brotli.compress(body, quality=11)
+        self.etag = hashlib.sha256(body).hexdigest()[:16]
+        self.last_modified = datetime.utcnow().replace(microsecond=0)
+
+    def response(self):
+        """Response to the current request"""
+        # Prefer the smallest encoding among those the client accepts equally
+        offers = [enc for enc in ('br', 'gzip', 'identity') if enc in self.variants]
+        encoding = request.accept_encodings.best_match(offers, default='identity')
+
+        # Strong ETags differ per encoding, as the bytes do
+        etag = self.etag if encoding == 'identity' else f'{self.etag}-{encoding}'
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains(etag)
+        else:
+            since = request.if_modified_since
+            not_modified = since is not None and \
+                since.replace(tzinfo=None) >= self.last_modified
+
+        if not_modified:
+            response = Response(status=304)
+        else:
+            response = Response(self.variants[encoding], mimetype='text/html')
+            if encoding != 'identity':
+                response.headers['Content-Encoding'] = encoding
+        response.set_etag(etag)
+        response.last_modified = self.last_modified
+        response.vary.add('Accept-Encoding')
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config['PAGE_CACHE_MAX_AGE']
+        return response
+
+
+def cached_page(view):
+    """Render a view once per worker and serve it from the page cache"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not current_app.config['PAGE_CACHE']:
+            return view(*args, **kwargs)
+
+        page = pages.get(request.endpoint)
+        if page is None:
+            html = view(*args, **kwargs)
+            if isinstance(html, Response):
+                html = html.get_data(as_text=True)
+            page = pages[request.endpoint] = Page(html)
+        return page.response()
+    return wrapper
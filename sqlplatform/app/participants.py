@@ -0,0 +1,128 @@
+"""Participants and the study source they were recruited from
+
+The registry caches, per worker, what /save_data needs to know about a
+participant: their source, consent and browser, from the `user` table that
+/save_user fills. A participant is looked up once per PARTICIPANT_TTL
+seconds, and an id without a user row once per PARTICIPANT_NEGATIVE_TTL, so
+most requests are checked without touching the database.
+
+Only data of participants who declined consent and of ended cohorts is
+rejected. An id without a user row is counted and its data saved: the
+extension registers once, without retrying, and starts uploading right away,
+so a late or failed /save_user must not lose a participant's data. When the
+user table can't be read the check fails open.
+
+A participant saved by /save_user is read again by the worker that saved
+it. Other workers see it once their entry expires.
+"""
+import time
+from collections import namedtuple
+
+from flask import current_app
+from sqlalchemy.exc import SQLAlchemyError
+
+from app import db
+from app.cache import LRUCache
+from app.models import User
+
+# What the registry knows of a participant with a user row
+Participant = namedtuple('Participant', ['source', 'consent', 'browser'])
+
+# This worker's registry, see get_participant_registry
+participant_registry = None
+
+
+def get_source_from_id(_id):
+    """Extract source from User ID"""
+    id_hyphens = _id.split('-')
+
+    if _id.startswith('test-'):
+        return 'test'
+    elif len(id_hyphens) == 5:
+        return 'qualtrics'
+    elif len(_id) == 14:
+        return 'yougov'
+
+
+class ParticipantRegistry(object):
+    """Participants by user_id, cached with a time to live
+
+    Arguments:
+        maxsize {int} -- Participants and unknown ids kept
+        ttl {float} -- Seconds a participant is trusted before it is read again
+        negative_ttl {float} -- Seconds an unknown id stays unknown
+    """
+
+    def __init__(self, maxsize, ttl, negative_ttl):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        # (Participant or None, expiry on the monotonic clock) by user_id
+        self.entries = LRUCache(maxsize)
+
+    def get(self, user_id):
+        """The participant of an id, None if it has no user row"""
+        entry = self.entries.get(user_id)
+        if entry is not None and entry[1] > time.monotonic():
+            return entry[0]
+
+        try:
+            user = User.query.with_entities(User.consent, User.browser)\
+                             .filter_by(user_id=user_id).first()
+        except SQLAlchemyError:
+            # e.g. MySQL is down, treat the id as unknown for a while
+            db.session.rollback()
+            current_app.logger.exception('Error reading participant')
+            user = None
+        participant = None if user is None else \
+                      Participant(get_source_from_id(user_id), user.consent,
+                                  user.browser)
+        self.remember(user_id, participant)
+        return participant
+
+    def remember(self, user_id, participant):
+        ttl = self.ttl if participant is not None else self.negative_ttl
+        self.entries.set(user_id, (participant, time.monotonic() + ttl))
+
+    def forget(self, user_id):
+        """Read a participant again on the next check, e.g. once saved"""
+        self.entries.pop(user_id)
+
+
+def get_participant_registry():
+    """Get this worker's participant registry"""
+    global participant_registry
+    if participant_registry is None:
+        config = current_app.config
+        participant_registry = ParticipantRegistry(
+            config['PARTICIPANT_CACHE_SIZE'], config['PARTICIPANT_TTL'],
+            config['PARTICIPANT_NEGATIVE_TTL'])
+    return participant_registry
+
+def check_participant(user_id, lookup=True):
+    """Whether data of a user_id may be saved
+
+    Arguments:
+        user_id {str} -- The participant
+
+    Keyword Arguments:
+        lookup {bool} -- Read the user table on a cache miss, False to only
+                         check the cohort, e.g. before spooling
+
+    Returns:
+        str -- 'ended' for a cohort in ENDED_COHORTS and 'unconsented' when
+               the user declined consent, whose data is rejected; 'unknown'
+               without a user row, whose data is saved; None otherwise
+    """
+    config = current_app.config
+    if get_source_from_id(user_id) in config['ENDED_COHORTS']:
+        return 'ended'
+    if not config['PARTICIPANT_CHECK'] or not lookup:
+        return None
+
+    participant = get_participant_registry().get(user_id)
+    if participant is None:
+        return 'unknown'
+    # Users saved without the consent form, e.g. in testing, have no consent
+    if participant.consent is False:
+        return 'unconsented'
+    return None
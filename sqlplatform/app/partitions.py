@@ -0,0 +1,96 @@
+"""Time range queries on the partitioned tables, see db_partitions.py
+
+On MySQL, activity and snapshots are partitioned by RANGE on their id, one
+partition per month of arrival, and the table_partition catalog records the
+ids and arrival period of each. Ids grow with arrival time, so a time range
+maps to an id range, and with it in the WHERE clause MySQL only reads the
+partitions that can hold matching rows.
+
+The timestamps are set by the extension, so a row whose timestamp is far from
+its arrival, from a wrong clock or a delayed upload, can sit in a partition
+outside that id range. Pruning is therefore opt-in and only finds rows whose
+timestamp is within the given skew of their arrival.
+"""
+from datetime import timedelta
+
+from app import db
+from app.models import TablePartition
+
+# A skew to prune with, how far most rows' timestamps are from their arrival
+TIMESTAMP_SKEW = timedelta(days=1)
+
+
+def get_partitions(table):
+    """Catalog entries of the partitions of a table, oldest first"""
+    return TablePartition.query.filter_by(table_name=table)\
+                               .order_by(TablePartition.id_start).all()
+
+def id_range(table, start, end):
+    """Ids of the rows that arrived in [start, end)
+
+    Arguments:
+        table {str} -- Table name
+        start {datetime} -- Start of the period, None for no bound
+        end {datetime} -- End of the period, None for no bound
+
+    Returns:
+        tuple -- (first id, id after the last) with None for no bound, or
+                 None when no partition of the table holds such rows
+    """
+    partitions = [p for p in get_partitions(table) if p.state == 'active']
+    if not partitions:
+        return (None, None)
+
+    found = [p for p in partitions
+             if (start is None or p.period_end is None or p.period_end > start)
+             and (end is None or p.period_start is None or p.period_start < end)]
+    if not found:
+        return None
+    # Rows beyond the current partition overflow into the catch-all one
+    last = found[-1]
+    return (found[0].id_start, None if last.period_end is None else last.id_end)
+
+def time_range(model, start, end, column='timestamp', skew=None):
+    """Filter criteria for the rows of a model with column in [start, end)
+
+    With a skew, adds the id range of the partitions that hold the rows that
+    arrived within skew of the range. Rows whose timestamp is further from
+    their arrival are left out. Tables without partitions, e.g. on SQLite,
+    just get the time criteria.
+
+        Activity.query.filter(*time_range(Activity, start, end))
+        Activity.query.filter(*time_range(Activity, start, end,
+                                          skew=TIMESTAMP_SKEW))
+
+    Arguments:
+        model {db.Model} -- Model of a table in PARTITION_TABLES
+        start {datetime} -- Start of the range, None for no bound
+        end {datetime} -- End of the range, None for no bound
+
+    Keyword Arguments:
+        column {str} -- The time column (default: {'timestamp'})
+        skew {timedelta} -- Difference allowed between column and arrival,
+                            None to read every partition (default: {None})
+
+    Returns:
+        list -- SQLAlchemy criteria
+    """
+    col = getattr(model, column)
+    criteria = []
+    if start is not None:
+        criteria.append(col >= start)
+    if end is not None:
+        criteria.append(col < end)
+    if skew is None:
+        return criteria
+
+    ids = id_range(model.__tablename__,
+                   None if start is None else start - skew,
+                   None if end is None else end + skew)
+    if ids is None:
+        return criteria + [db.false()]
+    if ids[0] is not None:
+        criteria.append(model.id >= ids[0])
+    if ids[1] is not None:
+        criteria.append(model.id < ids[1])
+    return criteria
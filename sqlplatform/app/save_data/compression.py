@@ -0,0 +1,99 @@
+"""Compressed request bodies
+
+Clients may send `Content-Encoding: gzip` or `deflate` bodies to /save_data
+and /save_user. The body is inflated while it is read, so the compressed and
+decompressed bodies never need to be held in memory at the same time.
+"""
+import zlib
+
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
+
+ENCODINGS = ('gzip', 'deflate')
+
+
+def is_zlib_header(head):
+    """Check if two bytes are a zlib (RFC 1950) stream header"""
+    return len(head) >= 2 and head[0] & 0x0f == 8 and \
+        (head[0] << 8 | head[1]) % 31 == 0
+
+
+class DecompressingStream(object):
+    """Read-only file object that inflates a compressed stream
+
+    Arguments:
+        stream {file} -- The compressed input stream
+        encoding {str} -- The content encoding, 'gzip' or 'deflate'
+        max_size {int} -- Maximum decompressed size in bytes, larger bodies
+                          raise RequestEntityTooLarge
+
+    Keyword Arguments:
+        chunk_size {int} -- Bytes read from the input stream at a time
+    """
+
+    def __init__(self, stream, encoding, max_size, chunk_size=64 * 1024):
+        self.stream = stream
+        self.encoding = encoding
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._decompressor = None
+        self._pending = b''
+        self._buffer = bytearray()
+        self._eof = False
+
+    def _new_decompressor(self, head):
+        if self.encoding == 'gzip':
+            wbits = 16 + zlib.MAX_WBITS
+        else:
+            # Deflate is zlib wrapped per RFC 7230, but some clients send raw
+            wbits = zlib.MAX_WBITS if is_zlib_header(head) else -zlib.MAX_WBITS
+        return zlib.decompressobj(wbits)
+
+    def _fill(self, size):
+        """Inflate until the buffer holds size bytes or the stream ends"""
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            if not self._pending:
+                self._pending = self.stream.read(self.chunk_size)
+                self.bytes_in += len(self._pending)
+                if not self._pending:
+                    if self._decompressor is not None and \
+                       not self._decompressor.eof:
+                        raise BadRequest('Truncated compressed request body')
+                    self._eof = True
+                    break
+
+            if self._decompressor is None:
+                self._decompressor = self._new_decompressor(self._pending)
+
+            try:
+                out = self._decompressor.decompress(self._pending, self.chunk_size)
+            except zlib.error as e:
+                raise BadRequest(f'Invalid {self.encoding} request body: {e}')
+
+            if self._decompressor.eof:
+                # Start over on concatenated gzip members
+                self._pending = self._decompressor.unused_data
+                if self._pending:
+                    self._decompressor = self._new_decompressor(self._pending)
+            else:
+                self._pending = self._decompressor.unconsumed_tail
+
+            self.bytes_out += len(out)
+            if self.bytes_out > self.max_size:
+                raise RequestEntityTooLarge(
+                    f'Decompressed request body exceeds {self.max_size} bytes')
+            self._buffer.extend(out)
+
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+        self._fill(size)
+        if size < 0:
+            size = len(self._buffer)
+        out = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return out
+
+    def readable(self):
+        return True
@@ -0,0 +1,459 @@
+"""Turn extension data into table rows and save them
+
+Shared by the /save_data routes and the spool drainer (see spool.py), so
+every row builder works on a plain request dict and needs no request context.
+"""
+from collections import defaultdict, deque
+from datetime import datetime, timezone
+import hashlib
+
+from flask import json, current_app, g, has_request_context
+from sqlalchemy.dialects import mysql
+
+from app import db, blobs, urls
+from app.cache import LRUCache
+from app.metrics import instruments
+from app.models import (
+    Data, BrowserHistory, WebsiteHistory, Snapshots, Activity, RequestKey
+)
+
+import inspect
+
+# Meta data the extension sends with every request, ahead of its data
+META_KEYS = ('user_id', 'worker_id', 'timestamp', 'version', 'api')
+
+# Models whose html is moved to the blob store
+HTML_MODELS = (WebsiteHistory, Snapshots, Activity)
+
+# Models whose urls are interned in the url table
+URL_MODELS = (BrowserHistory, WebsiteHistory, Snapshots, Activity)
+
+# Models of requests saved once across retries, see request_key
+DEDUP_MODELS = (WebsiteHistory, Snapshots, Activity)
+
+# Recently saved history visits of this worker, see get_seen_visits
+seen_visits = None
+
+# Keys of requests this worker has saved, see get_seen_requests
+seen_requests = None
+
+
+def get_seen_visits():
+    """Get this worker's LRU of recently saved (user_id, hv_id) pairs"""
+    global seen_visits
+    if seen_visits is None:
+        seen_visits = LRUCache(current_app.config['HISTORY_VISIT_CACHE_SIZE'])
+    return seen_visits
+
+def get_seen_requests():
+    """Get this worker's LRU of recently saved request keys"""
+    global seen_requests
+    if seen_requests is None:
+        seen_requests = LRUCache(current_app.config['REQUEST_KEY_CACHE_SIZE'])
+    return seen_requests
+
+def request_key(api, idempotency_key, rows):
+    """Key identifying a request among its retries
+
+    With an Idempotency-Key header, the key is that of the user and api.
+    Otherwise it is a fingerprint of what the request saves: the user, api,
+    timestamp, url and html of each row.
+
+    Arguments:
+        api {str} -- The api of the request
+        idempotency_key {str} -- The Idempotency-Key header, or None
+        rows {list} -- Row dicts of the request, after extract_html
+
+    Returns:
+        str -- Hex SHA-256 digest
+    """
+    if idempotency_key is not None:
+        parts = ['key', rows[0].get('user_id'), api, idempotency_key]
+    else:
+        parts = ['fingerprint', api]
+        for row in rows:
+            content = row.get('html_hash')
+            if content is None and row.get('html') is not None:
+                content = blobs.hash_html(row['html'])
+            timestamp = row.get('timestamp')
+            parts += [row.get('user_id'), row.get('url'), content,
+                      timestamp.isoformat() if timestamp else None]
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode('utf-8') + b'\x00')
+    return digest.hexdigest()
+
+def parse_timestamp(value):
+    """Convert an ISO 8601 timestamp to a naive UTC datetime
+
+    The extension sends `Date.toISOString()`, e.g. '2020-10-27T14:32:11.123Z'.
+    Other ISO formats with an offset are converted to UTC.
+
+    Arguments:
+        value {str} -- The timestamp, None is passed through
+    """
+    if value is None or isinstance(value, datetime):
+        return value
+    try:
+        return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%fZ')
+    except ValueError:
+        stamp = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        if stamp.tzinfo is not None:
+            stamp = stamp.astimezone(timezone.utc).replace(tzinfo=None)
+        return stamp
+
+def dumps_items(items):
+    """Serialize an iterable as a JSON array, one item at a time"""
+    parts = ['[']
+    for item in items:
+        if len(parts) > 1:
+            parts.append(', ')
+        parts.append(json.dumps(item))
+    parts.append(']')
+    return ''.join(parts)
+
+def encode_json(data):
+    """Convert data to UTF-8 JSON bytes
+
+    A generator, e.g. streamed list items, is serialized as a JSON array.
+    """
+    if inspect.isgenerator(data):
+        return dumps_items(data).encode('utf-8')
+    return json.dumps(data).encode('utf-8')
+
+def browser_history_rows(raw_data):
+    """Build BrowserHistory rows, one per history visit
+
+    Rows are generated lazily, so history items streamed from the request
+    body are turned into rows as they are inserted.
+
+    Arguments:
+        raw_data {dict} -- The incoming raw data
+    """
+    # Extract incoming data
+    raw_data.pop('api')
+    history_items = raw_data.pop('data')
+    raw_data['timestamp'] = parse_timestamp(raw_data.get('timestamp'))
+
+    # Recently saved history-visit ids, duplicates past this cache are
+    # dropped by the unique (user_id, hv_id) key on insert
+    user_id = raw_data['user_id']
+    seen = get_seen_visits()
+
+    for history in history_items:
+        for visit in history['visits']:
+
+            # Add history + visit ID
+            visit['hv_id'] = '-'.join([visit['id'], visit['visitId']])
+
+            # Ignore duplicates due to incomplete pull
+            if (user_id, visit['hv_id']) not in seen:
+                # Add URL to each visit
+                visit['url'] = history['url']
+
+                # Reduce time down to millisecond precision
+                visit['visitTime'] = int(str(visit['visitTime']).split('.')[0])
+
+                # Add meta data
+                visit.update(raw_data)
+
+                yield visit
+
+def website_history_rows(raw_data):
+    """Build the WebsiteHistory row
+
+    Arguments:
+        raw_data {dict} -- The incoming raw data
+    """
+    raw_data.pop('api')
+    data = raw_data.pop('data')
+    raw_data['timestamp'] = parse_timestamp(raw_data.get('timestamp'))
+
+    # Update dict with meta data [user, browser, version]
+    data.update(raw_data)
+    return [data]
+
+def snapshot_rows(raw_data):
+    """Build the Snapshots row
+
+    Arguments:
+        raw_data {dict} -- The incoming raw data
+    """
+    raw_data.pop('api')
+    data = raw_data.pop('data')
+    raw_data['timestamp'] = parse_timestamp(raw_data.get('timestamp'))
+
+    # Update dict with meta data [user, browser, version]
+    data.update(raw_data)
+    return [data]
+
+def activity_rows(raw_data):
+    """Build the Activity row
+
+    Arguments:
+        raw_data {dict} -- The incoming raw data
+    """
+    raw_data.pop('api')
+    data = raw_data.pop('data')
+    raw_data['timestamp'] = parse_timestamp(raw_data.get('timestamp'))
+
+    # Update dict with meta data [user, browser, version]
+    data.update(raw_data)
+
+    for json_key in ['links', 'tweet_ids', 'youtube_iframes']:
+        if json_key in data:
+            data[json_key] = json.dumps(data[json_key])
+
+    # Check if html is a list of updates (e.g. infinity scroll mutation updates)
+    if 'html' in data:
+        if isinstance(data['html'], list):
+            data['html'] = json.dumps(data['html'])
+
+    return [data]
+
+def generic_rows(raw_data):
+    """Build the Data row for an api without a matching SQL model
+
+    The data is stored as compressed JSON in `payload`, see app.blobs.decode_data.
+
+    Arguments:
+        raw_data {dict} -- The incoming raw data
+    """
+    if 'data' in raw_data:
+        codec = current_app.config['DATA_CODEC']
+        raw_data['payload'] = blobs.compress(encode_json(raw_data.pop('data')), codec)
+        raw_data['codec'] = codec
+    else:
+        raw_data['data'] = 'error: no data received'
+    raw_data['timestamp'] = parse_timestamp(raw_data.get('timestamp'))
+    return [raw_data]
+
+# Row builder and model for each api, anything else is saved as generic Data
+API_ROWS = {
+    'browser_history': (BrowserHistory, browser_history_rows),
+    'website_history': (WebsiteHistory, website_history_rows),
+    'periodic_snapshots': (Snapshots, snapshot_rows),
+    'activity': (Activity, activity_rows),
+}
+
+def request_rows(raw_data):
+    """Build the rows for a /save_data request
+
+    Arguments:
+        raw_data {dict} -- The incoming raw data
+
+    Returns:
+        tuple -- The model and an iterable of row dicts
+    """
+    model, build_rows = API_ROWS.get(raw_data['api'], (Data, generic_rows))
+    return model, build_rows(raw_data)
+
+def table_rows(model, rows):
+    """Align row dicts with the columns of a model's table
+
+    Every row gets the same keys so they can be sent in a single executemany,
+    and keys that are not columns of the table are dropped.
+
+    Arguments:
+        model {db.Model} -- The model whose table receives the rows
+        rows {iterable} -- Dicts of column values, one per row
+    """
+    columns = [c.name for c in model.__table__.columns
+               if not (c.primary_key and c.autoincrement is True)]
+    for row in rows:
+        yield {col: row.get(col) for col in columns}
+
+def insert_rows(model, rows, chunk_size=None, ignore_duplicates=False,
+                commit_chunks=False):
+    """Insert rows with batched multi-row inserts in the current session
+
+    Rows are sent in chunks through a single executemany per chunk, which the
+    MySQL driver rewrites into multi-row INSERT statements. The last chunk is
+    left for the caller to commit.
+
+    Arguments:
+        model {db.Model} -- The model whose table receives the rows
+        rows {iterable} -- Dicts of column values, one per row
+
+    Keyword Arguments:
+        chunk_size {int} -- Rows per INSERT (default: BULK_INSERT_CHUNK_SIZE)
+        ignore_duplicates {bool} -- Skip rows that violate a unique key, with
+                                    a no-op ON DUPLICATE KEY UPDATE on MySQL
+                                    so other errors still raise, and INSERT OR
+                                    IGNORE on SQLite (default: {False})
+        commit_chunks {bool} -- Commit after every full chunk (default: {False})
+
+    Returns:
+        int -- The number of rows inserted. On MySQL skipped duplicates are
+               counted too, as the driver reports found rather than changed
+               rows.
+    """
+    if chunk_size is None:
+        chunk_size = current_app.config['BULK_INSERT_CHUNK_SIZE']
+
+    table = model.__table__
+    insert = table.insert()
+    if ignore_duplicates:
+        if db.engine.dialect.name == 'mysql':
+            pk = list(table.primary_key.columns)[0]
+            insert = mysql.insert(table).on_duplicate_key_update({pk.name: pk})
+        else:
+            insert = insert.prefix_with('OR IGNORE', dialect='sqlite')
+
+    n_rows = 0
+    chunk = []
+    for row in table_rows(model, rows):
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            n_rows += db.session.execute(insert, chunk).rowcount
+            chunk = []
+            if commit_chunks:
+                db.session.commit()
+    if chunk:
+        n_rows += db.session.execute(insert, chunk).rowcount
+    return n_rows
+
+def save_rows(rows_by_model, atomic=None, dedup=None, request_keys=()):
+    """Save rows of one or more models to SQL database
+
+    The html of rows for HTML_MODELS is moved to the blob store first and the
+    urls of rows for URL_MODELS are replaced by url ids. Blobs, urls and rows
+    are committed together. Errors roll back the open transaction and are
+    raised to the caller.
+
+    Arguments:
+        rows_by_model {dict} -- Row dicts keyed by model, BrowserHistory rows
+                                may be any iterable
+
+    Keyword Arguments:
+        atomic {bool} -- Commit once for all rows instead of once per chunk
+                         (default: BULK_INSERT_ATOMIC)
+        dedup {tuple} -- (api, Idempotency-Key header or None) of a request
+                         whose retries are saved once, with rows_by_model
+                         holding lists (default: no deduplication)
+        request_keys {list} -- Keys of requests found not saved yet, inserted
+                               with their rows, see save_requests
+
+    Returns:
+        dict -- The number of rows inserted for each model, 0 for a retry
+    """
+    if atomic is None:
+        atomic = current_app.config['BULK_INSERT_ATOMIC']
+
+    html_blobs = {}
+    if current_app.config['HTML_BLOB_STORE']:
+        for model, rows in rows_by_model.items():
+            if model in HTML_MODELS:
+                html_blobs.update(blobs.extract_html(rows))
+
+    # Retries of a saved request are counted and skipped. The key is
+    # inserted with the rows, so of concurrent retries only one commits.
+    key = None
+    if dedup is not None:
+        api = dedup[0]
+        key = request_key(api, dedup[1],
+                          [row for rows in rows_by_model.values() for row in rows])
+        if key in get_seen_requests():
+            instruments.DUPLICATE_REQUESTS.labels(instruments.api_label(api)).inc()
+            return {model: 0 for model in rows_by_model}
+
+    # Keys of the visits that fit in the LRU, remembered once committed
+    visit_keys = deque(maxlen=get_seen_visits().maxsize)
+    def track_visits(rows):
+        for row in rows:
+            visit_keys.append((row['user_id'], row['hv_id']))
+            yield row
+
+    url_ids = {}
+    intern_urls = current_app.config['URL_INTERNING']
+
+    n_rows = {}
+    try:
+        if key is not None:
+            insert = RequestKey.__table__.insert()\
+                        .prefix_with('IGNORE', dialect='mysql')\
+                        .prefix_with('OR IGNORE', dialect='sqlite')
+            if not db.session.execute(insert, dict(key=key)).rowcount:
+                db.session.rollback()
+                get_seen_requests().set(key)
+                instruments.DUPLICATE_REQUESTS.labels(
+                    instruments.api_label(api)).inc()
+                return {model: 0 for model in rows_by_model}
+        if request_keys:
+            # A concurrent save of one of them fails on the unique key
+            db.session.execute(RequestKey.__table__.insert(),
+                               [dict(key=key) for key in request_keys])
+
+        blobs.put_blobs(html_blobs)
+        for model, rows in rows_by_model.items():
+            if model is BrowserHistory:
+                rows = track_visits(rows)
+            if intern_urls and model in URL_MODELS:
+                rows = urls.assign_url_ids(
+                    rows, url_ids, current_app.config['BULK_INSERT_CHUNK_SIZE'])
+            n_rows[model] = insert_rows(
+                model, rows,
+                ignore_duplicates=model is BrowserHistory,
+                commit_chunks=not atomic
+            )
+        with instruments.time_commit():
+            db.session.commit()
+    except:
+        db.session.rollback()
+        raise
+    finally:
+        db.session.close()
+
+    # Remember what was committed
+    blobs.get_stored_blobs().update(html_blobs)
+    get_seen_visits().update(visit_keys)
+    urls.remember_url_ids(url_ids)
+    for saved_key in [key] if key is not None else request_keys:
+        get_seen_requests().set(saved_key)
+    instruments.count_rows(n_rows)
+    if has_request_context():
+        # For the request's log record
+        g.rows = g.get('rows', 0) + sum(n_rows.values())
+    return n_rows
+
+def save_requests(requests):
+    """Save the rows of many /save_data requests in one transaction
+
+    Retries of a saved request of DEDUP_MODELS are skipped, by the same
+    request_key as the dedup of save_rows.
+
+    Arguments:
+        requests {iterable} -- (incoming raw data dict, Idempotency-Key header
+                               or None) of each request
+
+    Returns:
+        dict -- The number of rows inserted for each model
+    """
+    rows_by_model = defaultdict(list)
+    deduped = {}
+    for raw_data, idempotency_key in requests:
+        api = raw_data['api']
+        model, rows = request_rows(raw_data)
+        if model not in DEDUP_MODELS:
+            rows_by_model[model].extend(rows)
+            continue
+        rows = list(rows)
+        key = request_key(api, idempotency_key, rows)
+        if key in deduped or key in get_seen_requests():
+            instruments.DUPLICATE_REQUESTS.labels(instruments.api_label(api)).inc()
+            continue
+        deduped[key] = (api, model, rows)
+
+    saved = set()
+    if deduped:
+        saved = {key for key, in RequestKey.query.with_entities(RequestKey.key)
+                                    .filter(RequestKey.key.in_(list(deduped)))}
+        for key, (api, model, rows) in deduped.items():
+            if key in saved:
+                get_seen_requests().set(key)
+                instruments.DUPLICATE_REQUESTS.labels(
+                    instruments.api_label(api)).inc()
+            else:
+                rows_by_model[model].extend(rows)
+    return save_rows(rows_by_model,
+                     request_keys=[key for key in deduped if key not in saved])
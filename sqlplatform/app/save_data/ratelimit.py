@@ -0,0 +1,229 @@
+"""Per-user rate limits and per-api in-flight caps for /save_data
+
+The gunicorn workers share the limiter state through a memory-mapped file
+(RATE_LIMIT_FILE), so a decision is a few memory reads and writes under a
+byte-range lock, without a round trip to the database.
+
+The file holds a table of token buckets, one per (user_id, api) hashed to a
+slot. A slot remembers the hash of its key; when another key lands on it the
+bucket starts over full for that key. With enough slots for the active
+participants this rarely happens, and when it does it errs on letting
+requests through.
+
+After the buckets, each worker owns a row of counters of the requests it is
+processing, by api hashed to a column. The in-flight count of an api is the
+sum of its column. Checks in different workers can race, so a cap may be
+exceeded by one request per worker. Rows of workers that died are cleared by
+the surviving workers.
+
+There are rows for twice the gunicorn workers, since old and new workers
+overlap during a reload, or RATE_LIMIT_MAX_WORKERS. The number of slots and
+rows is part of the file name, so processes sized differently never share a
+file. A worker that finds no free row is not counted and logs an error.
+"""
+import fcntl
+import hashlib
+import logging
+import math
+import mmap
+import os
+import random
+import struct
+import threading
+import time
+
+from flask import current_app
+
+from app.logs import log_event
+from app.save_data.spool import pid_alive
+
+# Key hash, tokens and time of the last update of a token bucket
+BUCKET = struct.Struct('Qdd')
+
+# In-flight counter rows at least, and columns
+MIN_WORKERS = 128
+API_SLOTS = 64
+ZERO_ROW = memoryview(bytes(8 * API_SLOTS)).cast('q')
+
+# Seconds between sweeps of the rows of dead workers
+SWEEP_INTERVAL = 5.0
+
+# This worker's limiter, see get_rate_limiter
+rate_limiter = None
+
+
+def key_hash(*parts):
+    """Stable 64 bit hash, the same in every worker"""
+    digest = hashlib.blake2b('\x00'.join(parts).encode('utf-8'),
+                             digest_size=8).digest()
+    return int.from_bytes(digest, 'little') or 1
+
+
+class RateLimiter(object):
+    """Token buckets and in-flight counters shared through a file
+
+    Arguments:
+        path {str} -- The shared file, created if missing
+        n_slots {int} -- Token buckets in the file
+        limits {dict} -- (requests per minute, burst) by api, with a
+                         'default' entry; None for no limit
+        inflight_limits {dict} -- Requests processed at once by api, with a
+                                  'default' entry; None for no limit
+
+    Keyword Arguments:
+        retry_after {int} -- Seconds a client waits when an api is at its
+                             in-flight cap, jittered up to twice that
+        max_workers {int} -- Processes with in-flight counters at once
+    """
+
+    def __init__(self, path, n_slots, limits, inflight_limits, retry_after=5,
+                 max_workers=MIN_WORKERS):
+        self.pid = os.getpid()
+        self.n_slots = n_slots
+        self.limits = limits
+        self.inflight_limits = inflight_limits
+        self.retry_after = retry_after
+        self.max_workers = max_workers
+
+        self.pids_offset = n_slots * BUCKET.size
+        self.counts_offset = self.pids_offset + 8 * max_workers
+        size = self.counts_offset + 8 * max_workers * API_SLOTS
+
+        # The layout is in the name, a file is only shared by processes
+        # that agree on it
+        path = f'{path}-{n_slots}x{max_workers}'
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self.fd).st_size < size:
+            os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size)
+        view = memoryview(self.map)
+        self.pids = view[self.pids_offset:self.counts_offset].cast('q')
+        self.counts = view[self.counts_offset:size].cast('q')
+
+        # fcntl locks don't exclude threads of the same process
+        self.lock = threading.Lock()
+        self.row = None
+        self.next_sweep = 0.0
+
+    def take(self, user_id, api):
+        """Take a token from the bucket of a user and api
+
+        Returns:
+            float -- 0 if allowed, else the seconds until a token is available
+        """
+        limit = self.limits.get(api, self.limits['default'])
+        if limit is None:
+            return 0
+        rate, burst = limit[0] / 60, limit[1]
+
+        key = key_hash(user_id, api)
+        offset = (key % self.n_slots) * BUCKET.size
+        now = time.time()
+        with self.lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, BUCKET.size, offset)
+            try:
+                slot_key, tokens, updated = BUCKET.unpack_from(self.map, offset)
+                if slot_key != key:
+                    tokens = burst
+                else:
+                    tokens = min(tokens + max(now - updated, 0) * rate, burst)
+                if tokens >= 1:
+                    tokens -= 1
+                    wait = 0
+                else:
+                    wait = (1 - tokens) / rate
+                BUCKET.pack_into(self.map, offset, key, tokens, now)
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, BUCKET.size, offset)
+        return wait
+
+    def enter(self, api):
+        """Count a request of an api as in flight, unless at its cap
+
+        Returns:
+            bool -- Whether the request may proceed, then call leave after it
+        """
+        limit = self.inflight_limits.get(api, self.inflight_limits['default'])
+        column = key_hash(api) % API_SLOTS
+        row = self._row()
+        if row is None:
+            # More workers than rows, let the request in untracked
+            log_event('inflight_untracked',
+                      f'No free in-flight row among {self.max_workers}, '
+                      f'raise RATE_LIMIT_MAX_WORKERS', level=logging.ERROR)
+            return True
+        with self.lock:
+            if limit is not None and \
+               sum(self.counts[column::API_SLOTS]) >= limit:
+                return False
+            self.counts[row * API_SLOTS + column] += 1
+        return True
+
+    def leave(self, api):
+        row = self._row()
+        if row is None:
+            return
+        index = row * API_SLOTS + key_hash(api) % API_SLOTS
+        with self.lock:
+            self.counts[index] = max(self.counts[index] - 1, 0)
+
+    def inflight_retry_after(self):
+        """Retry-After of a request over an in-flight cap, spread out so
+        rejected clients don't all come back at once"""
+        return self.retry_after + random.randrange(self.retry_after + 1)
+
+    def _row(self):
+        """This worker's row of in-flight counters, claimed on first use"""
+        now = time.monotonic()
+        if self.row is not None and now < self.next_sweep:
+            return self.row
+
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, 8 * self.max_workers, self.pids_offset)
+        try:
+            self.next_sweep = now + SWEEP_INTERVAL
+            for row in range(self.max_workers):
+                pid = self.pids[row]
+                if pid and pid != self.pid and not pid_alive(pid):
+                    # The worker died, its requests are no longer in flight
+                    self._clear(row, 0)
+            if self.row is None or self.pids[self.row] != self.pid:
+                self.row = None
+                for row in range(self.max_workers):
+                    if not self.pids[row]:
+                        self._clear(row, self.pid)
+                        self.row = row
+                        break
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, 8 * self.max_workers, self.pids_offset)
+        return self.row
+
+    def _clear(self, row, pid):
+        start = row * API_SLOTS
+        self.counts[start:start + API_SLOTS] = ZERO_ROW
+        self.pids[row] = pid
+
+
+def retry_after_seconds(wait):
+    """Retry-After header value for a wait in seconds"""
+    return str(max(math.ceil(wait), 1))
+
+def max_workers():
+    """In-flight counter rows: RATE_LIMIT_MAX_WORKERS, or enough for the old
+    and new gunicorn workers of a reload"""
+    configured = current_app.config['RATE_LIMIT_MAX_WORKERS']
+    if configured:
+        return configured
+    return max(2 * int(os.environ.get('GUNICORN_WORKERS', 1)), MIN_WORKERS)
+
+def get_rate_limiter():
+    """Get this worker's view of the shared limiter state"""
+    global rate_limiter
+    if rate_limiter is None or rate_limiter.pid != os.getpid():
+        config = current_app.config
+        rate_limiter = RateLimiter(
+            config['RATE_LIMIT_FILE'], config['RATE_LIMIT_SLOTS'],
+            config['RATE_LIMITS'], config['INFLIGHT_LIMITS'],
+            config['INFLIGHT_RETRY_AFTER'], max_workers()
+        )
+    return rate_limiter
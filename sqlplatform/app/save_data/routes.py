@@ -1,132 +1,270 @@
 """Save Extension Data
 """
-from flask import request, json, jsonify, current_app
+from flask import request, json, jsonify, current_app, g
 
 from app import db
-from app.models import User, Data, BrowserHistory, WebsiteHistory, Snapshots, Activity
+from app.logs import log_event, log_error
+from app.models import (
+    User, UserReinstall, Data, BrowserHistory, WebsiteHistory, Snapshots, Activity
+)
+from app.participants import check_participant, get_participant_registry
 from app.save_data import bp
+from app.save_data.compression import DecompressingStream, ENCODINGS
+from app.save_data.ingest import (
+    browser_history_rows, website_history_rows, snapshot_rows, activity_rows,
+    generic_rows, save_rows, parse_timestamp, META_KEYS
+)
+from app.metrics import instruments
+from app.save_data.ratelimit import get_rate_limiter, retry_after_seconds
+from app.save_data.spool import get_spool_writer
+from app.save_data.stream_json import StreamingJSONPayload, RecordingStream
+from werkzeug.exceptions import HTTPException
 
-import base64
-import traceback
-from pprint import pprint
+import time
 
 
-def get_source_from_id(_id):
-    """Extract source from User ID"""
-    id_hyphens = _id.split('-')
-
-    if _id.startswith('test-'):
-        return 'test'
-    elif len(id_hyphens) == 5:
-        return 'qualtrics'
-    elif len(_id) == 14:
-        return 'yougov'
-
-def check_if_id_exists(model, id):
-    row = db.session.query(model[id])
-    value = value.filter_by(user_id=user_id).scalar() 
-    return value is not None
-
-def check_if_user_exists(user_id):
-    row = db.session.query(User.user_id)
-    value = value.filter_by(user_id=user_id).scalar() 
-    return value is not None
-
-def b64encode_json(data):
-    """Convert dict to json string and base64 encode it"""
-    utf8_json_str = json.dumps(data).encode('utf-8')
-    return base64.urlsafe_b64encode(utf8_json_str).decode('ascii')
-
 def save_to_sql(data):
-    """Save data to SQL database"""
+    """Save data to SQL database
+
+    Returns:
+        tuple -- A 500 response if it failed, None if saved
+    """
     try:
         db.session.add(data)
         db.session.commit()        
         db.session.close()
     except:
-        err = f'Error saving: {traceback.format_exc()}'
-        current_app.logger.error(err)
-        return jsonify(dict(error=err))
+        db.session.rollback()
+        error_id = log_error('save_error', 'Error saving')
+        return jsonify(dict(error=f'Error saving, id {error_id}',
+                            error_id=error_id)), 500
+
+def check_participant_data(user_id, api, lookup=True):
+    """Turn away data of ended cohorts and unconsented participants
+
+    Data of user ids without a user row is counted and saved.
+
+    Returns:
+        tuple -- The response rejecting the data, None if it may be saved
+    """
+    rejected = check_participant(user_id, lookup=lookup)
+    if rejected == 'unknown':
+        instruments.UNKNOWN_PARTICIPANTS.labels(instruments.api_label(api)).inc()
+        log_event('unknown_participant', 'Data of unregistered participant')
+        return None
+    if rejected is None:
+        return None
+
+    instruments.REJECTED_PARTICIPANTS.labels(instruments.api_label(api),
+                                             rejected).inc()
+    log_event('rejected', f'Data of {rejected} participant not saved',
+              reason=rejected)
+    if rejected == 'ended':
+        return jsonify(dict(error=f"data not saved, participation for your group has ended, please uninstall the extension"))
+    return jsonify(dict(error=f"data not saved, {rejected} participant")), 403
+
+def check_rate_limit(user_id, api):
+    """Take a request in if it is within the limits of its user and api
+
+    Returns:
+        tuple -- A 429 response with a Retry-After, None if the request may
+                 proceed
+    """
+    limiter = get_rate_limiter()
+    if not limiter.enter(api):
+        limit, retry_after = 'inflight', str(limiter.inflight_retry_after())
+    else:
+        wait = limiter.take(user_id, api)
+        if not wait:
+            g.inflight_api = api
+            return None
+        limiter.leave(api)
+        limit, retry_after = 'rate', retry_after_seconds(wait)
+
+    instruments.RATE_LIMITED.labels(instruments.api_label(api), limit).inc()
+    response = jsonify(dict(error=f'[{api}] too many requests, retry later'))
+    response.headers['Retry-After'] = retry_after
+    # Let the extension read the Retry-After to wait it out
+    response.headers['Access-Control-Expose-Headers'] = 'Retry-After'
+    return response, 429
+
+@bp.teardown_request
+def leave_rate_limiter(exc):
+    api = g.pop('inflight_api', None)
+    if api is not None:
+        get_rate_limiter().leave(api)
+
+@bp.before_request
+def start_timer():
+    g.start_time = time.perf_counter()
+
+@bp.before_request
+def decompress_request_body():
+    """Inflate gzip or deflate encoded request bodies while they are read"""
+    encoding = request.headers.get('Content-Encoding', 'identity').strip().lower()
+    if encoding == 'identity':
+        return
+
+    if encoding not in ENCODINGS:
+        err = f'Unsupported Content-Encoding: {encoding}'
+        return jsonify(dict(error=err)), 415
+
+    g.body_stream = DecompressingStream(
+        request.stream, encoding,
+        max_size=current_app.config['MAX_DECOMPRESSED_BODY_SIZE']
+    )
+    request.stream = g.body_stream
+
+@bp.after_request
+def log_request(response):
+    """Log a summary of the request, see LOG_SAMPLING['request']"""
+    fields = dict(path=request.path, status=response.status_code,
+                  rows=g.get('rows'),
+                  duration_ms=round(1000 * (time.perf_counter() - g.start_time), 1),
+                  bytes=request.content_length)
+    stream = g.get('body_stream')
+    if stream is not None:
+        fields.update(encoding=stream.encoding, bytes=stream.bytes_in,
+                      decompressed_bytes=stream.bytes_out)
+    log_event('request', request.endpoint, **fields)
+    return response
+
+@bp.after_request
+def record_metrics(response):
+    """Record the latency and size of /save_data requests by api"""
+    if request.endpoint != 'save_data.save_data':
+        return response
+
+    api = instruments.api_label(g.get('api'))
+    instruments.REQUESTS.labels(api, response.status_code).inc()
+    instruments.REQUEST_SECONDS.labels(api).observe(
+        time.perf_counter() - g.start_time)
+
+    stream = g.get('body_stream')
+    if stream is not None:
+        instruments.REQUEST_BYTES.labels(api).observe(stream.bytes_in)
+        instruments.DECOMPRESSED_BYTES.labels(api).inc(stream.bytes_out)
+    elif request.content_length is not None:
+        instruments.REQUEST_BYTES.labels(api).observe(request.content_length)
+    return response
 
 # Receive data from the browser extension and save to json lines file.
 @bp.route('/save_user', methods=['POST'])
 def save_user():
     try:
         # Store new user
-        print('Saving new user')
         new_user = request.get_json(force=True)
-        save_to_sql(data=User(**new_user))
-        
-        pprint(new_user)
+        g.user_id = new_user.get('user_id')
+        new_user['install_time'] = parse_timestamp(new_user.get('install_time'))
+
+        # user_id is unique, a reinstall is kept in user_reinstall and updates
+        # the existing user but for its first install_time
+        user = User.query.filter_by(user_id=new_user['user_id']).first()
+        if user is None:
+            error = save_to_sql(data=User(**new_user))
+        else:
+            db.session.add(UserReinstall(**new_user))
+            for key, value in new_user.items():
+                if key != 'install_time' or user.install_time is None:
+                    setattr(user, key, value)
+            error = save_to_sql(data=user)
+        get_participant_registry().forget(new_user['user_id'])
+        if error is not None:
+            return error
+
+        log_event('save_user', 'Saved user', new=user is None)
         return jsonify(dict(success="Saved user."))
 
+    except HTTPException as e:
+        # Unreadable request body, e.g. over the decompressed size cap
+        return jsonify(dict(error=e.description)), e.code
+
     except:
-        err = f'Error saving user: {traceback.format_exc()}'
-        current_app.logger.error(err)
-        return jsonify(dict(error=err))
+        error_id = log_error('save_user_error', 'Error saving user')
+        return jsonify(dict(error=f'Error saving user, id {error_id}',
+                            error_id=error_id))
 
 # Receive data from the browser extension and save to json lines file.
 @bp.route('/save_data', methods=['POST'])
 def save_data():
     # if request.method == 'POST':
     try:
-        # Receive data
-        data = request.get_json(force=True)
-
-        # Check user source
-        user_source = get_source_from_id(data['user_id'])
-        if user_source == 'yougov':
-            # Reject data from yougov participants
-            return jsonify(dict(error=f"data not saved, participation for your group has ended, please uninstall the extension"))
+        # Receive the meta data, leaving `data` unread until the request is
+        # let in. A spooled body is kept as read, to append it whole.
+        config = current_app.config
+        spool = config['INGEST_MODE'] == 'spool'
+        payload = None
+        if spool:
+            body = RecordingStream(request.stream)
+            payload = StreamingJSONPayload(body, config['STREAM_JSON_CHUNK_SIZE'])
+        elif config['STREAM_JSON']:
+            payload = StreamingJSONPayload(request.stream, 
+                                           config['STREAM_JSON_CHUNK_SIZE'])
+        if payload is not None:
+            data = payload.parse_meta('data', required=META_KEYS)
+        else:
+            data = request.get_json(force=True)
+        g.api = data.get('api')
+        g.user_id = data.get('user_id')
+
+        # Reject data of ended cohorts and unconsented participants. Spooled
+        # requests don't wait on the user table, the drainer checks them.
+        rejected = check_participant_data(data['user_id'], data['api'],
+                                          lookup=not spool)
+        if rejected is not None:
+            return rejected
+
+        # Turn clients away when over a limit, before `data` is read if the
+        # meta data comes first, as the extension sends it
+        if config['RATE_LIMIT']:
+            rejected = check_rate_limit(data['user_id'], data['api'])
+            if rejected is not None:
+                return rejected
+
+        # Append to the spool for drain_spool.py to save
+        if spool:
+            get_spool_writer().append(body.getvalue(),
+                                      request.headers.get('Idempotency-Key'))
+            return jsonify(dict(success=f"[{data['api']}] received"))
+
+        # Read `data`, item by item when it is a list
+        if payload is not None:
+            data = payload.finish()
 
         # Check if matches an existing SQL model
         model_key = data['api']
-        
+
+        # Optional key the extension keeps across retries of a request
+        idempotency_key = request.headers.get('Idempotency-Key')
+
         if model_key == 'browser_history':
             return handle_browser_history(data)
 
         elif model_key == 'website_history':
-            return handle_website_history(data)
+            return handle_website_history(data, idempotency_key)
 
         elif model_key == 'periodic_snapshots':
-            return handle_snapshots(data)
+            return handle_snapshots(data, idempotency_key)
         
         elif model_key == 'activity':
-            return handle_activity(data)
+            return handle_activity(data, idempotency_key)
 
         else:
             # No matching SQL model
-            if 'data' in data:
-                data['data'] = b64encode_json(data['data'])  
-            else:
-                data['data'] = 'error: no data received'
-            save_to_sql(data=Data(**data))
-            return jsonify(dict(success=f"[{data['api']}] saved as generic"))
-            
-    except:
-        err = f'Error saving data\n: {traceback.format_exc()}'
-        current_app.logger.error(err)
-        return jsonify(dict(error=err))
-
-def handle_activity(raw_data):
-    """Store Activity data
-    
-    Arguments:
-        raw_data {dict} -- The incoming raw data
-    """
-    # pprint(raw_data)
-    
-    api = raw_data.pop('api')
-    data = raw_data.pop('data')
+            api = data['api']
+            save_rows({Data: generic_rows(data)})
+            return jsonify(dict(success=f"[{api}] saved as generic"))
 
-    # Update dict with meta data [user, browser, version]
-    data.update(raw_data)
+    except HTTPException as e:
+        # Unreadable request body, e.g. over the decompressed size cap
+        instruments.count_error(g.get('api'))
+        return jsonify(dict(error=e.description)), e.code
 
-    # Save website history
-    save_to_sql(Activity(**data))
-
-    # Return response when done
-    return jsonify(dict(success=f"[{api}] saved"))
+    except:
+        instruments.count_error(g.get('api'))
+        error_id = log_error('save_data_error', 'Error saving data')
+        return jsonify(dict(error=f'Error saving data, id {error_id}',
+                            error_id=error_id))
 
 def handle_browser_history(raw_data):
     """Store BrowserHistory data
@@ -135,113 +273,76 @@ def handle_browser_history(raw_data):
         raw_data {dict} -- The incoming raw data
     """
     # pprint(raw_data)
-    
-    # Extract incoming data
-    api = raw_data.pop('api')
-    history_items = raw_data.pop('data')
-
-    # Get existing history-visit ids for user
-    user_id = raw_data['user_id']
-    query = db.session\
-            .query(BrowserHistory.hv_id)\
-            .filter(BrowserHistory.user_id == user_id)
-
-    existing_ids = set([row.hv_id for row in query.distinct()])
-    print(f'Existing IDs: {len(existing_ids)}')
-
-    for history in history_items:
-        print(f"Saving: {len(history['visits'])} history visit items")
-
-        for visit in history['visits']:
 
-            # Add history + visit ID
-            visit['hv_id'] = '-'.join([visit['id'], visit['visitId']])
+    api = raw_data['api']
 
-            # Ignore duplicates due to incomplete pull
-            if visit['hv_id'] not in existing_ids:
-                # Add URL to each visit
-                visit['url'] = history['url']
-
-                # Reduce time down to millisecond precision
-                visit['visitTime'] = int(str(visit['visitTime']).split('.')[0])
-
-                # Add meta data
-                visit.update(raw_data)
-
-                # Save visit to SQL database
-                save_to_sql(BrowserHistory(**visit))
+    # Save visits to SQL database in batches
+    visits = browser_history_rows(raw_data)
+    save_rows({BrowserHistory: visits})
 
     # Return response when done
     return jsonify(dict(success=f"[{api}] received visits"))
 
-def handle_website_history(raw_data):
+def handle_website_history(raw_data, idempotency_key=None):
     """Store WebsiteHistory data
     
     Arguments:
         raw_data {dict} -- The incoming raw data
+
+    Keyword Arguments:
+        idempotency_key {str} -- Idempotency-Key header, retries of a saved
+                                 request are answered without saving again
     """
     # pprint(raw_data)
     
-    api = raw_data.pop('api')
-    data = raw_data.pop('data')
-
-    # Update dict with meta data [user, browser, version]
-    data.update(raw_data)
+    api = raw_data['api']
 
     # Save website history
-    save_to_sql(WebsiteHistory(**data))
+    save_rows({WebsiteHistory: website_history_rows(raw_data)},
+              dedup=(api, idempotency_key))
 
     # Return response when done
     return jsonify(dict(success=f"[{api}] saved"))
 
-def handle_snapshots(raw_data):
+def handle_snapshots(raw_data, idempotency_key=None):
     """Store Snapshot data
     
     Arguments:
         raw_data {dict} -- The incoming raw data
+
+    Keyword Arguments:
+        idempotency_key {str} -- Idempotency-Key header, retries of a saved
+                                 request are answered without saving again
     """
     # pprint(raw_data)
     
-    api = raw_data.pop('api')
-    data = raw_data.pop('data')
-
-    # Update dict with meta data [user, browser, version]
-    data.update(raw_data)
+    api = raw_data['api']
 
     # Save website history
-    save_to_sql(Snapshots(**data))
+    save_rows({Snapshots: snapshot_rows(raw_data)},
+              dedup=(api, idempotency_key))
 
     # Return response when done
     return jsonify(dict(success=f"[{api}] saved data."))
 
 
-def handle_activity(raw_data):
+def handle_activity(raw_data, idempotency_key=None):
     """Store Activity data
     
     Arguments:
         raw_data {dict} -- The incoming raw data
+
+    Keyword Arguments:
+        idempotency_key {str} -- Idempotency-Key header, retries of a saved
+                                 request are answered without saving again
     """
     # pprint(raw_data)
     
-    api = raw_data.pop('api')
-    data = raw_data.pop('data')
-
-    # Update dict with meta data [user, browser, version]
-    data.update(raw_data)
-
-    for json_key in ['links', 'tweet_ids', 'youtube_iframes']:
-        if json_key in data:
-            data[json_key] = json.dumps(data[json_key])
-
-    # Check if html is a list of updates (e.g. infinity scroll mutation updates)
-    if 'html' in data:
-        if isinstance(data['html'], list):
-            data['html'] = json.dumps(data['html'])
+    api = raw_data['api']
 
     # Save website history
-    save_to_sql(Activity(**data))
+    save_rows({Activity: activity_rows(raw_data)},
+              dedup=(api, idempotency_key))
 
     # Return response when done
     return jsonify(dict(success=f"[{api}] saved data"))
-
-
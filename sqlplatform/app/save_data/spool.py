@@ -0,0 +1,375 @@
+"""Write-ahead spool for /save_data requests
+
+With INGEST_MODE = 'spool', each worker appends validated request bodies to
+its own segment file in SPOOL_DIR and answers right away. drain_spool.py
+replays the segments into the SQL database in batches, skipping retries of a
+saved request as the sync mode does (see save_requests).
+
+Segment files are named `<start time>-<pid>.open` while a worker appends to
+them and are renamed to `.seg` once full or when the worker exits. Each
+record is framed as a `<length> <crc32> [<Idempotency-Key>]` header line, the
+body and a newline, so a torn write at the end of a segment is detected and
+dropped.
+
+Records are acknowledged once written to the file and fsynced in batches
+(every SPOOL_FSYNC_RECORDS records, or SPOOL_FSYNC_INTERVAL seconds after the
+first unsynced one, by a timer when no record follows), so a worker crash
+loses nothing and a power loss at most the last unsynced batch. A segment is
+fsynced before it is sealed, also when the worker exits.
+Replay is at-least-once: a drainer crash between commit and checkpoint
+replays that batch again.
+"""
+import atexit
+import glob
+import json
+import os
+import threading
+import time
+import zlib
+from urllib.parse import quote, unquote
+
+from flask import current_app
+from sqlalchemy.exc import InterfaceError, OperationalError
+
+from app.metrics import instruments
+from app.participants import check_participant
+from app.save_data.ingest import save_requests
+
+OPEN_EXT = '.open'
+SEALED_EXT = '.seg'
+CHECKPOINT = 'checkpoint.json'
+REJECTED = 'rejected'
+
+# This worker's spool writer, see get_spool_writer
+spool_writer = None
+
+
+def frame(payload, idempotency_key=None):
+    """Record header for a payload and the Idempotency-Key of its request"""
+    header = b'%d %08x' % (len(payload), zlib.crc32(payload))
+    if idempotency_key is not None:
+        header += b' ' + quote(idempotency_key, safe='').encode('ascii')
+    return header + b'\n'
+
+def segment_key(path):
+    """Segment name without its open/sealed extension"""
+    return os.path.basename(path).rsplit('.', 1)[0]
+
+def writer_pid(path):
+    """The pid of the worker that writes a segment"""
+    return int(segment_key(path).rsplit('-', 1)[1])
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def seal(path):
+    """Rename an open segment to a sealed one"""
+    sealed = path[:-len(OPEN_EXT)] + SEALED_EXT
+    os.rename(path, sealed)
+    return sealed
+
+def fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class SpoolWriter(object):
+    """Appends request bodies to this worker's current segment
+
+    Arguments:
+        spool_dir {str} -- Directory holding the segment files
+        segment_size {int} -- Bytes after which a segment is sealed
+        fsync_records {int} -- Records written between fsyncs
+        fsync_interval {float} -- Seconds between fsyncs
+    """
+
+    def __init__(self, spool_dir, segment_size, fsync_records, fsync_interval):
+        self.spool_dir = spool_dir
+        self.segment_size = segment_size
+        self.fsync_records = fsync_records
+        self.fsync_interval = fsync_interval
+        self.pid = os.getpid()
+        self.path = None
+        self.fd = None
+        self.size = 0
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+        # Syncs the records of an interval when no other record comes
+        self.timer = None
+        self.lock = threading.Lock()
+        os.makedirs(spool_dir, exist_ok=True)
+
+    def _open(self):
+        name = f'{time.time_ns():020d}-{self.pid}{OPEN_EXT}'
+        self.path = os.path.join(self.spool_dir, name)
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o640)
+        self.size = 0
+        fsync_dir(self.spool_dir)
+
+    def _sync(self):
+        if self.fd is not None and self.unsynced:
+            os.fsync(self.fd)
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def sync(self):
+        with self.lock:
+            self._sync()
+
+    def _close(self):
+        if self.fd is None:
+            return
+        self._sync()
+        os.fsync(self.fd)
+        os.close(self.fd)
+        self.fd = None
+        seal(self.path)
+        fsync_dir(self.spool_dir)
+
+    def close(self):
+        """Sync and seal the current segment"""
+        with self.lock:
+            self._close()
+
+    def append(self, payload, idempotency_key=None):
+        """Append a request body to the spool
+
+        Arguments:
+            payload {bytes} -- The raw JSON request body
+
+        Keyword Arguments:
+            idempotency_key {str} -- The Idempotency-Key header, if any
+        """
+        with self.lock:
+            if self.fd is None:
+                self._open()
+
+            parts = [frame(payload, idempotency_key), payload, b'\n']
+            total = sum(len(part) for part in parts)
+            written = os.writev(self.fd, parts)
+            if written < total:
+                # Short write, finish the record from where it stopped
+                rest = b''.join(parts)[written:]
+                while rest:
+                    rest = rest[os.write(self.fd, rest):]
+            self.size += total
+            self.unsynced += 1
+
+            if self.unsynced >= self.fsync_records or \
+               time.monotonic() - self.last_sync >= self.fsync_interval:
+                self._sync()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.fsync_interval, self.sync)
+                self.timer.daemon = True
+                self.timer.start()
+
+            if self.size >= self.segment_size:
+                self._close()
+
+
+def get_spool_writer():
+    """Get this worker's spool writer, sealed when the worker exits"""
+    global spool_writer
+    if spool_writer is None or spool_writer.pid != os.getpid():
+        config = current_app.config
+        spool_writer = SpoolWriter(
+            config['SPOOL_DIR'], config['SPOOL_SEGMENT_SIZE'],
+            config['SPOOL_FSYNC_RECORDS'], config['SPOOL_FSYNC_INTERVAL']
+        )
+        atexit.register(spool_writer.close)
+    return spool_writer
+
+
+def read_records(path, offset, limit):
+    """Read complete records from a segment
+
+    Arguments:
+        path {str} -- The segment file
+        offset {int} -- Byte offset of the first record to read
+        limit {int} -- Maximum number of records to read
+
+    Returns:
+        tuple -- A list of (payload or None if corrupt, Idempotency-Key or
+                 None) and the offset after the last complete record
+    """
+    records = []
+    with open(path, 'rb') as infile:
+        infile.seek(offset)
+        while len(records) < limit:
+            header = infile.readline()
+            if not header.endswith(b'\n'):
+                break
+            try:
+                length, crc, *key = header.split()
+                length, crc = int(length), int(crc, 16)
+                if len(key) > 1:
+                    raise ValueError(header)
+                key = unquote(key[0].decode('ascii')) if key else None
+            except ValueError:
+                # Unreadable header, the rest of the segment can't be framed
+                records.append((None, None))
+                offset = os.path.getsize(path)
+                break
+            payload = infile.read(length)
+            if len(payload) < length or infile.read(1) != b'\n':
+                break
+            records.append((payload if zlib.crc32(payload) == crc else None, key))
+            offset = infile.tell()
+    return records, offset
+
+
+class Drainer(object):
+    """Replays spooled records into the SQL database
+
+    Arguments:
+        spool_dir {str} -- Directory holding the segment files
+        batch_size {int} -- Records saved per transaction
+    """
+
+    def __init__(self, spool_dir, batch_size):
+        self.spool_dir = spool_dir
+        self.batch_size = batch_size
+        self.checkpoint_path = os.path.join(spool_dir, CHECKPOINT)
+        self.rejected_dir = os.path.join(spool_dir, REJECTED)
+        self.checkpoint = self.load_checkpoint()
+        os.makedirs(self.rejected_dir, exist_ok=True)
+
+    def load_checkpoint(self):
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path, 'r') as infile:
+                return json.load(infile)
+        return {}
+
+    def save_checkpoint(self):
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'w') as outfile:
+            json.dump(self.checkpoint, outfile)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def segments(self):
+        paths = glob.glob(os.path.join(self.spool_dir, '*' + OPEN_EXT)) + \
+                glob.glob(os.path.join(self.spool_dir, '*' + SEALED_EXT))
+        return sorted(paths, key=os.path.basename)
+
+    def reject(self, segment, payload, reason):
+        """Set aside a record that can't be saved"""
+        current_app.logger.error(f'Rejected spool record from {segment}: {reason}')
+        if payload is None:
+            return
+        name = f'{os.path.basename(segment)}-{time.time_ns()}.json'
+        with open(os.path.join(self.rejected_dir, name), 'wb') as outfile:
+            outfile.write(payload)
+
+    def save(self, segment, spooled):
+        """Save a batch, falling back to one record at a time on errors
+
+        Arguments:
+            segment {str} -- Name of the segment the batch is read from
+            spooled {list} -- (payload, Idempotency-Key) of each record
+        """
+        records = []
+        for payload, idempotency_key in spooled:
+            if payload is None:
+                self.reject(segment, payload, 'checksum mismatch')
+                continue
+            try:
+                raw_data = json.loads(payload)
+            except ValueError as e:
+                self.reject(segment, payload, e)
+                continue
+            # Checked here rather than before spooling, see save_data
+            rejected = check_participant(raw_data.get('user_id') or '')
+            if rejected in ('ended', 'unconsented'):
+                instruments.REJECTED_PARTICIPANTS.labels(
+                    instruments.api_label(raw_data.get('api')), rejected).inc()
+                continue
+            if rejected == 'unknown':
+                instruments.UNKNOWN_PARTICIPANTS.labels(
+                    instruments.api_label(raw_data.get('api'))).inc()
+            records.append((payload, raw_data, idempotency_key))
+
+        try:
+            save_requests((raw_data, idempotency_key)
+                          for _, raw_data, idempotency_key in records)
+        except (InterfaceError, OperationalError):
+            raise
+        except Exception:
+            # Find the records that fail on their own
+            for payload, _, idempotency_key in records:
+                try:
+                    save_requests([(json.loads(payload), idempotency_key)])
+                except (InterfaceError, OperationalError):
+                    # Database unavailable, not a problem with the record
+                    raise
+                except Exception as e:
+                    self.reject(segment, payload, repr(e))
+
+    def drain_segment(self, path):
+        """Replay a segment from its checkpoint
+
+        Returns:
+            int -- The number of records read
+        """
+        key = segment_key(path)
+        if path.endswith(OPEN_EXT) and not pid_alive(writer_pid(path)):
+            # Writer died without sealing, anything after the last complete
+            # record was never acknowledged
+            path = seal(path)
+
+        n_records = 0
+        offset = self.checkpoint.get(key, 0)
+        while True:
+            try:
+                records, next_offset = read_records(path, offset, self.batch_size)
+            except FileNotFoundError:
+                # Sealed by its writer meanwhile, picked up on the next pass
+                return n_records
+            if not records:
+                break
+            self.save(key, records)
+            n_records += len(records)
+            offset = self.checkpoint[key] = next_offset
+            self.save_checkpoint()
+
+        if path.endswith(SEALED_EXT):
+            if offset < os.path.getsize(path):
+                current_app.logger.error(
+                    f'Dropped torn record at the end of {key}, offset {offset}')
+            os.remove(path)
+            self.checkpoint.pop(key, None)
+            self.save_checkpoint()
+        return n_records
+
+    def drain(self):
+        """Replay every segment once
+
+        Returns:
+            int -- The number of records read
+        """
+        return sum(self.drain_segment(path) for path in self.segments())
+
+    def run(self, poll_interval):
+        """Keep draining the spool, waiting poll_interval when it is empty"""
+        while True:
+            try:
+                n_records = self.drain()
+            except Exception:
+                # e.g. the database is down, retry from the checkpoint
+                current_app.logger.exception('Error draining spool')
+                n_records = 0
+            if not n_records:
+                time.sleep(poll_interval)
@@ -0,0 +1,206 @@
+"""Incremental parsing of /save_data request bodies
+
+The extension sends `{"user_id": ..., "api": ..., "data": [...]}` with the
+meta data ahead of `data`. The meta data can be read on its own first, so a
+request is checked before its data is read at all. When `data` is a list, its
+items are then decoded from the request stream one at a time, so a large
+browser history upload never exists as a whole in memory.
+"""
+import codecs
+import json
+
+WHITESPACE = ' \t\n\r'
+
+
+class StreamingJSONPayload(object):
+    """Parser for a JSON object whose list of items is read lazily
+
+    Arguments:
+        stream {file} -- The request body
+
+    Keyword Arguments:
+        chunk_size {int} -- Bytes read from the stream at a time
+    """
+
+    def __init__(self, stream, chunk_size=64 * 1024):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        # The object read so far, and the key parse_meta stopped at
+        self.obj = {}
+        self.items_key = None
+
+    def _read(self, size):
+        """Append up to size bytes of the stream to the buffer
+
+        Returns:
+            bool -- False once the stream is exhausted
+        """
+        if self.eof:
+            return False
+
+        # Drop what has been parsed already
+        if self.pos > self.chunk_size:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+
+        chunk = self.stream.read(size)
+        if not chunk:
+            self.eof = True
+            self.buf += self.utf8.decode(b'', final=True)
+            return False
+        self.buf += self.utf8.decode(chunk)
+        return True
+
+    def _peek(self):
+        """Skip whitespace and return the next character, '' at the end"""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._read(self.chunk_size):
+                return ''
+
+    def _expect(self, chars):
+        """Consume the next character, which must be one of chars"""
+        char = self._peek()
+        if not char or char not in chars:
+            raise ValueError(f'Expected one of {chars!r}, got {char!r}')
+        self.pos += 1
+        return char
+
+    def _value(self):
+        """Decode the next complete JSON value"""
+        self._peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A value that ends the buffer, e.g. a number, may continue
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # Read ahead in growing steps so long values are decoded in
+            # amortized linear time
+            self._read(size)
+            size *= 2
+
+    def _end(self):
+        if self._peek():
+            raise ValueError('Extra data after JSON object')
+
+    def _items(self, obj):
+        if self._peek() == ']':
+            self.pos += 1
+        else:
+            while True:
+                yield self._value()
+                if self._expect(',]') == ']':
+                    break
+        self._rest(obj)
+
+    def _rest(self, obj):
+        """Read the keys that follow a value up to the end of the object"""
+        while self._expect(',}') == ',':
+            key = self._value()
+            self._expect(':')
+            obj[key] = self._value()
+        self._end()
+
+    def parse_meta(self, items_key='data', required=()):
+        """Parse the object up to items_key, leaving its value unread
+
+        Arguments:
+            items_key {str} -- Key of the value to leave for finish
+            required {tuple} -- Keys that must come before items_key for it
+                                to be left unread, otherwise the whole object
+                                is decoded
+
+        Returns:
+            dict -- The keys ahead of items_key, or the whole object
+        """
+        self._expect('{')
+        obj = self.obj
+        if self._peek() == '}':
+            self.pos += 1
+            self._end()
+            return obj
+
+        while True:
+            key = self._value()
+            self._expect(':')
+            if key == items_key and all(k in obj for k in required):
+                self.items_key = key
+                return obj
+            obj[key] = self._value()
+            if self._expect(',}') == '}':
+                break
+
+        self._end()
+        return obj
+
+    def finish(self):
+        """Read the rest of the object after parse_meta
+
+        Returns:
+            dict -- The object, with a generator of items under items_key
+                    when it holds a list
+        """
+        obj = self.obj
+        key, self.items_key = self.items_key, None
+        if key is None:
+            return obj
+
+        if self._peek() == '[':
+            self.pos += 1
+            obj[key] = self._items(obj)
+            return obj
+        obj[key] = self._value()
+        self._rest(obj)
+        return obj
+
+    def parse(self, items_key='data', required=()):
+        """Parse the object up to its list of items
+
+        Arguments:
+            items_key {str} -- Key of the list to read lazily
+            required {tuple} -- Keys that must come before items_key for it
+                                to be read lazily, otherwise the whole object
+                                is decoded
+
+        Returns:
+            dict -- The object, with a generator of items under items_key
+                    when it holds a list
+        """
+        self.parse_meta(items_key, required)
+        return self.finish()
+
+
+class RecordingStream(object):
+    """A stream that keeps the bytes read from it, e.g. to spool a body whose
+    start was parsed
+
+    Arguments:
+        stream {file} -- The stream to read
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.chunks = []
+
+    def read(self, size=-1):
+        chunk = self.stream.read(size)
+        self.chunks.append(chunk)
+        return chunk
+
+    def getvalue(self):
+        """The whole stream, the bytes read so far and the rest of it"""
+        return b''.join(self.chunks) + self.stream.read()
@@ -0,0 +1,152 @@
+"""Helpers for online schema migrations, see migrations/README
+
+Used from migration scripts only. Index builds use MySQL's online DDL and data
+changes are made in primary key chunks that commit on their own, so a live
+database keeps taking writes while a migration runs.
+"""
+import time
+from contextlib import contextmanager
+
+import sqlalchemy as sa
+from alembic import op
+
+# Rows per chunk for backfills and deduplication
+CHUNK_SIZE = 10000
+
+
+def is_mysql():
+    return op.get_bind().dialect.name == 'mysql'
+
+@contextmanager
+def chunk_connection():
+    """Connection for chunked data changes
+
+    On MySQL this is a separate connection, so each chunk commits on its own
+    instead of growing one transaction over the whole table. SQLite only
+    allows one writer, so the migration connection is used there.
+    """
+    bind = op.get_bind()
+    if bind.dialect.name != 'mysql':
+        yield bind
+        return
+    conn = bind.engine.connect()
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+def log(message):
+    print(f'[migration] {message}', flush=True)
+
+def create_index(name, table, columns, unique=False):
+    """Add an index without blocking reads or writes
+
+    Arguments:
+        name {str} -- Index name
+        table {str} -- Table name
+        columns {list} -- Indexed column names
+        unique {bool} -- Create a unique index
+    """
+    if is_mysql():
+        kind = 'UNIQUE INDEX' if unique else 'INDEX'
+        cols = ', '.join(f'`{col}`' for col in columns)
+        op.execute(f'ALTER TABLE `{table}` ADD {kind} `{name}` ({cols}), '
+                   'ALGORITHM=INPLACE, LOCK=NONE')
+    else:
+        op.create_index(name, table, columns, unique=unique)
+
+def drop_index(name, table):
+    if is_mysql():
+        op.execute(f'ALTER TABLE `{table}` DROP INDEX `{name}`, '
+                   'ALGORITHM=INPLACE, LOCK=NONE')
+    else:
+        op.drop_index(name, table_name=table)
+
+def backfill(table, pk, source, target, convert, chunk_size=CHUNK_SIZE,
+             pause=0):
+    """Fill a new column from an existing one in primary key chunks
+
+    Only rows where target is NULL are updated, so an interrupted backfill
+    can be rerun and picks up where it stopped.
+
+    Arguments:
+        table {str} -- Table name
+        pk {str} -- Integer primary key column
+        source {str} -- Column to read
+        target {str} -- Column to write
+        convert {callable} -- Maps a source value to a target value
+
+    Keyword Arguments:
+        chunk_size {int} -- Rows per chunk and transaction
+        pause {float} -- Seconds to sleep between chunks to limit load
+    """
+    t = sa.table(table, sa.column(pk), sa.column(source), sa.column(target))
+    select = sa.select([t.c[pk], t.c[source]])\
+               .where(t.c[pk] > sa.bindparam('last'))\
+               .where(t.c[target].is_(None))\
+               .order_by(t.c[pk]).limit(chunk_size)
+    update = t.update().where(t.c[pk] == sa.bindparam('_pk'))\
+                       .values({target: sa.bindparam('_value')})
+
+    last, n_rows = 0, 0
+    with chunk_connection() as conn:
+        while True:
+            rows = conn.execute(select, last=last).fetchall()
+            if not rows:
+                break
+            values = [dict(_pk=row[0], _value=convert(row[1])) for row in rows
+                      if row[1] is not None]
+            with conn.begin():
+                if values:
+                    conn.execute(update, values)
+            last = rows[-1][0]
+            n_rows += len(rows)
+            log(f'{table}.{target}: {n_rows} rows, up to {pk} {last}')
+            time.sleep(pause)
+
+def delete_duplicates(table, pk, columns, chunk_size=CHUNK_SIZE, copy_to=None,
+                      copy_columns=()):
+    """Delete rows that repeat the values of columns, keeping the first
+
+    Needed before adding a unique index to a table that had none. Finding the
+    duplicates scans the table once.
+
+    Arguments:
+        table {str} -- Table name
+        pk {str} -- Integer primary key column, the lowest is kept
+        columns {list} -- Columns of the future unique key
+
+    Keyword Arguments:
+        copy_to {str} -- Table the deleted rows are copied to first, in the
+                         same transaction
+        copy_columns {list} -- Columns copied, of the same name in both tables
+    """
+    names = list(columns) + [col for col in copy_columns if col not in columns]
+    t = sa.table(table, sa.column(pk), *[sa.column(col) for col in names])
+    keys = [t.c[col] for col in columns]
+    groups = sa.select(keys + [sa.func.min(t.c[pk])])\
+               .group_by(*keys).having(sa.func.count() > 1)
+
+    later = [t.c[pk] > sa.bindparam('_keep')] + \
+            [t.c[col] == sa.bindparam(f'_{col}') for col in columns]
+    delete = t.delete().where(sa.and_(*later))
+    copy = None
+    if copy_to is not None:
+        target = sa.table(copy_to, *[sa.column(col) for col in copy_columns])
+        copy = target.insert().from_select(
+            list(copy_columns),
+            sa.select([t.c[col] for col in copy_columns])
+              .where(sa.and_(*later)).order_by(t.c[pk]))
+
+    with chunk_connection() as conn:
+        duplicates = conn.execute(groups).fetchall()
+        log(f'{table}: {len(duplicates)} duplicated {", ".join(columns)}')
+
+        for start in range(0, len(duplicates), chunk_size):
+            chunk = duplicates[start:start + chunk_size]
+            params = [dict({f'_{col}': row[i] for i, col in enumerate(columns)},
+                           _keep=row[-1]) for row in chunk]
+            with conn.begin():
+                if copy is not None:
+                    conn.execute(copy, params)
+                conn.execute(delete, params)
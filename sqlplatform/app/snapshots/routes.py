@@ -1,50 +1,43 @@
 """ Snapshot API Routes
 """
 
-from flask import request, jsonify, render_template
+from flask import request, render_template, Response
+from app.pages import cached_page
+from app.participants import get_source_from_id
 from app.snapshots import bp
-from urllib.parse import quote_plus
-import itertools
+from app.snapshots.terms import get_snapshot_urls
 
 @bp.route('/taking_snapshots', methods=['GET'])
+@cached_page
 def taking_snapshots():
     return render_template('taking_snapshots.html', title='Taking Snapshots')
 
-@bp.route('/update_search_terms', methods=['POST'])
+@bp.route('/update_search_terms', methods=['GET', 'POST'])
 def search_terms():
-    data = request.get_json(force=True)
-    if data['request_key'] == 'send_me_the_terms':
-
-        snapshot_urls = []
-
-        front_page_urls = [
-            "https://news.google.com",
-            "https://youtube.com", 
-            "https://twitter.com",
-            "https://www.bing.com/news"
-        ]
-
-        search_urls = [
-            "https://www.google.com/search?q=",
-            "https://news.google.com/search?q=",
-            "https://www.youtube.com/results?search_query=",
-            "https://twitter.com/search?q="
-        ]
-
-        queries = [
-            'donald trump',
-            'mike pence',
-            'joe biden',
-            'kamala harris',
-            'coronavirus',
-            'covid-19'
-        ]
-
-        # Add frontpage URLs to list
-        snapshot_urls.extend(front_page_urls)
-
-        # Add all search URL + query combinations to list
-        pairs = itertools.product(search_urls, queries)
-        snapshot_urls.extend([f"{url}{quote_plus(qry)}" for url, qry in pairs])
-
-        return jsonify(snapshot_urls)
+    """The snapshot URL list of the participant's cohort
+
+    POST {"request_key": "send_me_the_terms", "user_id": ...} as sent by the
+    extension, or GET with `?user_id=`. Send the ETag of the last list in
+    If-None-Match to get a 304 while it is unchanged.
+    """
+    if request.method == 'POST':
+        data = request.get_json(force=True)
+        if data.get('request_key') != 'send_me_the_terms':
+            return Response(status=400)
+        user_id = data.get('user_id')
+    else:
+        user_id = request.args.get('user_id')
+
+    cohort = get_source_from_id(user_id) if user_id else None
+    body, etag = get_snapshot_urls().get(cohort)
+
+    # The list is only read, so POST is answered like GET
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    # Let the extension's worker read the ETag to send it back
+    response.headers['Access-Control-Expose-Headers'] = 'ETag'
+    return response
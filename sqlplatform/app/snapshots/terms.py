@@ -0,0 +1,90 @@
+"""Snapshot URL lists, built once per version of the terms file
+
+SNAPSHOT_TERMS_FILE holds a `version` and term sets per cohort (participant
+source, see app.participants). A cohort only lists what differs from
+`default`. The URL list of each cohort is built and serialized when the file
+changes, and served as is with an ETag of its version and content.
+"""
+import hashlib
+import itertools
+import json
+import os
+import time
+from urllib.parse import quote_plus
+
+from flask import current_app
+
+DEFAULT_COHORT = 'default'
+
+# This worker's snapshot URL lists, see get_snapshot_urls
+snapshot_urls = None
+
+
+def build_urls(terms):
+    """Front page URLs followed by every search URL + query combination"""
+    urls = list(terms.get('front_page_urls', []))
+    pairs = itertools.product(terms.get('search_urls', []), terms.get('queries', []))
+    urls.extend(f"{url}{quote_plus(qry)}" for url, qry in pairs)
+    return urls
+
+
+class SnapshotUrls(object):
+    """Serialized URL lists per cohort, reloaded when the terms file changes
+
+    Arguments:
+        path {str} -- The terms file
+
+    Keyword Arguments:
+        check_interval {float} -- Seconds between checks of the file
+    """
+
+    def __init__(self, path, check_interval=5.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.mtime = None
+        self.checked = 0
+        self.lists = {}
+        self.reload()
+
+    def reload(self):
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime == self.mtime:
+            return
+        with open(self.path, 'r') as infile:
+            config = json.load(infile)
+
+        default = config['cohorts'][DEFAULT_COHORT]
+        lists = {}
+        for cohort, terms in config['cohorts'].items():
+            body = json.dumps(build_urls(dict(default, **terms))).encode('utf-8')
+            digest = hashlib.sha256(body).hexdigest()[:16]
+            lists[cohort] = (body, f"{config['version']}-{cohort}-{digest}")
+
+        # Swapped in whole, requests being served keep the old lists
+        self.lists = lists
+        self.mtime = mtime
+
+    def get(self, cohort):
+        """The serialized URL list and its ETag for a cohort
+
+        Arguments:
+            cohort {str} -- A participant source, None or an unknown source
+                            gets the default list
+        """
+        now = time.monotonic()
+        if now - self.checked >= self.check_interval:
+            self.checked = now
+            try:
+                self.reload()
+            except (OSError, ValueError, KeyError):
+                # Keep serving the last good lists
+                current_app.logger.exception('Error reloading snapshot terms')
+        return self.lists.get(cohort) or self.lists[DEFAULT_COHORT]
+
+
+def get_snapshot_urls():
+    """Get this worker's snapshot URL lists"""
+    global snapshot_urls
+    if snapshot_urls is None:
+        snapshot_urls = SnapshotUrls(current_app.config['SNAPSHOT_TERMS_FILE'])
+    return snapshot_urls
@@ -0,0 +1,5 @@
+from flask import Blueprint
+
+bp = Blueprint('timeline', __name__)
+
+from app.timeline import routes
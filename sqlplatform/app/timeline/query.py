@@ -0,0 +1,196 @@
+"""Time-ordered rows of one participant across the data tables
+
+The rows of TABLES are merged in (timestamp, table, id) order. Each table is
+read in batches with a keyset condition on its (user_id, timestamp) index, so
+reading a page costs the same however far into the timeline it starts. A
+cursor is the position of the last row of a page. Rows without a timestamp
+are not part of the timeline.
+
+HTML and the payloads of the data table are never read by the keyset
+queries. When asked for, they are fetched by id for a few rows at a time as
+they are written out, so memory stays bounded by FETCH_CHUNK bodies.
+"""
+import base64
+import heapq
+import json
+from collections import defaultdict
+from datetime import datetime
+from itertools import islice
+
+import sqlalchemy as sa
+
+from app import db
+from app.blobs import blob_text, decode_data
+from app.models import (
+    Url, HtmlBlob, Data, BrowserHistory, WebsiteHistory, Snapshots, Activity
+)
+
+# Tables of the timeline, rows at the same time are ordered as listed
+TABLES = {
+    'browser_history': BrowserHistory,
+    'website_history': WebsiteHistory,
+    'snapshots': Snapshots,
+    'activity': Activity,
+    'data': Data,
+}
+RANKS = {name: rank for rank, name in enumerate(TABLES)}
+
+# Large columns, only read by fill_chunk
+BODY_COLUMNS = ('html', 'data', 'payload')
+
+# Rows whose bodies and urls are fetched together
+FETCH_CHUNK = 100
+
+
+def encode_cursor(position):
+    """Opaque cursor of a (timestamp, table rank, id) position"""
+    timestamp, rank, pk = position
+    raw = json.dumps([timestamp.isoformat(), rank, pk]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+def decode_cursor(cursor):
+    """Position of a cursor, ValueError if it is not one"""
+    try:
+        timestamp, rank, pk = json.loads(base64.urlsafe_b64decode(cursor))
+        return datetime.fromisoformat(timestamp), int(rank), int(pk)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f'Invalid cursor: {cursor}') from e
+
+def table_rows(name, user_id, after=None, until=None, batch_size=500):
+    """Rows of a user in one table after a position, in timeline order
+
+    Arguments:
+        name {str} -- Key of TABLES
+        user_id {str} -- The participant
+
+    Keyword Arguments:
+        after {tuple} -- Position to start after (default: the beginning)
+        until {datetime} -- Only rows before this time
+        batch_size {int} -- Rows per query
+
+    Yields:
+        tuple -- Position, table name and row dict, without BODY_COLUMNS
+    """
+    t = TABLES[name].__table__
+    pk = list(t.primary_key.columns)[0]
+    rank = RANKS[name]
+    ts = t.c.timestamp
+    columns = [col for col in t.columns if col.name not in BODY_COLUMNS]
+
+    while True:
+        query = sa.select(columns)\
+                  .where(t.c.user_id == user_id).where(ts.isnot(None))
+        if after is not None:
+            after_ts, after_rank, after_pk = after
+            if rank > after_rank:
+                query = query.where(ts >= after_ts)
+            elif rank < after_rank:
+                query = query.where(ts > after_ts)
+            else:
+                query = query.where(sa.or_(
+                    ts > after_ts, sa.and_(ts == after_ts, pk > after_pk)))
+        if until is not None:
+            query = query.where(ts < until)
+        query = query.order_by(ts, pk).limit(batch_size)
+
+        rows = db.session.execute(query).fetchall()
+        for row in rows:
+            position = (row.timestamp, rank, row[pk.name])
+            yield position, name, dict(row)
+        if len(rows) < batch_size:
+            return
+        after = position
+
+def fill_chunk(chunk, bodies):
+    """Set urls from url ids and, with bodies, the html and payloads"""
+    rows = [row for _, _, row in chunk]
+    url_ids = {row['url_id'] for row in rows if row.get('url_id') is not None}
+    if url_ids:
+        query = sa.select([Url.id, Url.url]).where(Url.id.in_(url_ids))
+        url_by_id = dict(db.session.execute(query).fetchall())
+        for row in rows:
+            if row.get('url_id') is not None:
+                row['url'] = url_by_id.get(row['url_id'])
+    if not bodies:
+        return
+
+    # The legacy html column and the payloads, by id
+    rows_by_name = defaultdict(list)
+    for _, name, row in chunk:
+        if name == 'data' or not row.get('html_hash'):
+            rows_by_name[name].append(row)
+    for name, name_rows in rows_by_name.items():
+        t = TABLES[name].__table__
+        body_columns = [col for col in t.columns if col.name in BODY_COLUMNS]
+        if not body_columns:
+            continue
+        pk = list(t.primary_key.columns)[0]
+        query = sa.select([pk] + body_columns)\
+                  .where(pk.in_([row[pk.name] for row in name_rows]))
+        body_by_id = {stored[pk.name]: dict(stored)
+                      for stored in db.session.execute(query)}
+        for row in name_rows:
+            row.update(body_by_id.get(row[pk.name], {}))
+
+    hashes = {row['html_hash'] for row in rows if row.get('html_hash')}
+    if hashes:
+        query = sa.select([HtmlBlob.hash, HtmlBlob.codec, HtmlBlob.data,
+                           HtmlBlob.archive_segment, HtmlBlob.archive_offset,
+                           HtmlBlob.archive_length])\
+                  .where(HtmlBlob.hash.in_(hashes))
+        html_by_hash = {blob_hash: blob_text(*stored)
+                        for blob_hash, *stored in db.session.execute(query)}
+        for row in rows:
+            if row.get('html_hash'):
+                row['html'] = html_by_hash.get(row['html_hash'])
+    for _, name, row in chunk:
+        if name == 'data':
+            row['data'] = decode_data(row['data'], row.pop('payload'),
+                                      row['codec'])
+
+def to_json(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode('ascii')
+    return value
+
+def timeline(user_id, tables=None, since=None, until=None, cursor=None,
+             limit=None, bodies=False):
+    """A user's rows of all tables merged in time order
+
+    Arguments:
+        user_id {str} -- The participant
+
+    Keyword Arguments:
+        tables {list} -- Keys of TABLES to include (default: all)
+        since {datetime} -- Only rows from this time, ignored with a cursor
+        until {datetime} -- Only rows before this time
+        cursor {str} -- Continue after the page that returned this cursor
+        limit {int} -- Rows at most (default: all)
+        bodies {bool} -- Include html and data payloads
+
+    Yields:
+        dict -- Rows with their `table` and `cursor`
+    """
+    if cursor is not None:
+        after = decode_cursor(cursor)
+    else:
+        after = (since, -1, 0) if since is not None else None
+    batch_size = min(limit or 500, 500)
+
+    merged = heapq.merge(
+        *[table_rows(name, user_id, after, until, batch_size)
+          for name in (tables or TABLES)],
+        key=lambda item: item[0]
+    )
+    merged = islice(merged, limit)
+    while True:
+        chunk = list(islice(merged, FETCH_CHUNK))
+        if not chunk:
+            return
+        fill_chunk(chunk, bodies)
+        for position, name, row in chunk:
+            record = {'table': name, 'cursor': encode_cursor(position)}
+            record.update((key, to_json(value)) for key, value in row.items())
+            yield record
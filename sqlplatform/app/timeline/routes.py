@@ -0,0 +1,66 @@
+"""Read a participant's timeline as NDJSON
+
+    curl -H "Authorization: Bearer $TIMELINE_TOKEN" \
+        "https://webusage.xyz/timeline/<user_id>?since=2020-10-01&limit=500"
+
+Each line is a row with its `table` and `cursor`. The last line is
+`{"next": <cursor>}`, to pass as `cursor` for the next page, or
+`{"next": null}` at the end of the timeline.
+"""
+import hmac
+
+from flask import request, json, jsonify, current_app, abort, Response, \
+    stream_with_context
+
+from app import db
+from app.save_data.ingest import parse_timestamp
+from app.timeline import bp
+from app.timeline.query import TABLES, timeline, decode_cursor
+
+MAX_LIMIT = 10000
+
+
+@bp.before_request
+def check_token():
+    """Only serve requests with the TIMELINE_TOKEN, none without one set"""
+    token = current_app.config['TIMELINE_TOKEN']
+    if not token:
+        abort(404)
+    sent = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(sent.encode('utf-8'),
+                               f'Bearer {token}'.encode('utf-8')):
+        abort(401)
+
+@bp.route('/timeline/<user_id>', methods=['GET'])
+def user_timeline(user_id):
+    args = request.args
+    try:
+        tables = args['tables'].split(',') if args.get('tables') else None
+        if tables and not set(tables) <= set(TABLES):
+            raise ValueError(f'tables must be among {", ".join(TABLES)}')
+        limit = min(int(args.get('limit', 1000)), MAX_LIMIT)
+        if limit < 1:
+            raise ValueError('limit must be positive')
+        since = parse_timestamp(args.get('since'))
+        until = parse_timestamp(args.get('until'))
+        cursor = args.get('cursor')
+        if cursor is not None:
+            decode_cursor(cursor)
+    except ValueError as e:
+        return jsonify(dict(error=str(e))), 400
+    bodies = args.get('bodies') in ('1', 'true')
+
+    def lines():
+        n_rows, last = 0, None
+        try:
+            for record in timeline(user_id, tables, since, until, cursor,
+                                   limit, bodies):
+                n_rows += 1
+                last = record['cursor']
+                yield json.dumps(record) + '\n'
+        finally:
+            db.session.close()
+        yield json.dumps(dict(next=last if n_rows == limit else None)) + '\n'
+
+    return Response(stream_with_context(lines()),
+                    mimetype='application/x-ndjson')
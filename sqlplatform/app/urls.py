@@ -0,0 +1,153 @@
+"""URL interning for the history tables
+
+Each distinct URL is stored once in the `url` table, keyed by the SHA-256 of
+the URL and with its host name in the indexed `domain` column. Rows in
+`browser_history`, `website_history`, `snapshots` and `activity` keep the
+id in `url_id`.
+
+New urls are inserted in a short transaction of their own, in url_hash order,
+and committed before the rows that reference them. Workers interning the same
+urls wait on each other only for that transaction and never deadlock, and the
+ids are read back without a locking read. On MySQL each worker keeps a
+connection for this, outside the pool of its requests, so a request holding a
+pool connection never waits on the pool for a second one. SQLite allows a
+single writer, so the urls are inserted on the caller's connection there.
+"""
+import hashlib
+import os
+from urllib.parse import urlsplit
+
+from flask import current_app
+import sqlalchemy as sa
+
+from app import db
+from app.cache import LRUCache
+from app.models import Url
+
+
+# url -> id of the urls this worker has committed, see get_url_ids
+url_ids = None
+
+# This worker's engine interning urls and the pid it was made in, see
+# get_url_engine
+url_engine = None
+url_engine_pid = None
+
+
+def hash_url(url):
+    """Hex SHA-256 digest of a URL"""
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+def url_domain(url):
+    """Lower case host name of a URL, without a leading 'www.'"""
+    try:
+        host = urlsplit(url).hostname or ''
+    except ValueError:
+        host = ''
+    if host.startswith('www.'):
+        host = host[4:]
+    return host[:255]
+
+def get_url_ids():
+    """Get this worker's LRU of recently committed url ids"""
+    global url_ids
+    if url_ids is None:
+        url_ids = LRUCache(current_app.config['URL_CACHE_SIZE'])
+    return url_ids
+
+def get_url_engine():
+    """Get this worker's single connection engine interning urls, None on
+    SQLite"""
+    global url_engine, url_engine_pid
+    if db.engine.dialect.name != 'mysql':
+        return None
+    if url_engine is None or url_engine_pid != os.getpid():
+        url_engine = sa.create_engine(
+            db.engine.url, pool_size=1, max_overflow=0,
+            pool_recycle=current_app.config['SQLALCHEMY_POOL_RECYCLE'])
+        url_engine_pid = os.getpid()
+    return url_engine
+
+def intern_urls(urls, conn=None):
+    """Get the ids of urls, inserting and committing the ones that are not
+    stored yet
+
+    Arguments:
+        urls {iterable} -- The urls
+
+    Keyword Arguments:
+        conn -- Connection or session of the caller (default: db.session),
+                which the urls are inserted on, uncommitted, on SQLite only
+
+    Returns:
+        dict -- Ids keyed by url
+    """
+    if conn is None:
+        conn = db.session
+    cached = get_url_ids()
+    ids = {}
+    missing = {}
+    for url in set(urls):
+        url_id = cached.get(url)
+        if url_id is not None:
+            ids[url] = url_id
+        else:
+            missing[hash_url(url)] = url
+
+    if missing:
+        table = Url.__table__
+        insert = table.insert().prefix_with('IGNORE', dialect='mysql')\
+                               .prefix_with('OR IGNORE', dialect='sqlite')
+        values = [dict(url_hash=url_hash, url=missing[url_hash],
+                       domain=url_domain(missing[url_hash]))
+                  for url_hash in sorted(missing)]
+        select = sa.select([table.c.url_hash, table.c.id])\
+                   .where(table.c.url_hash.in_(list(missing)))
+
+        engine = get_url_engine()
+        if engine is None:
+            conn.execute(insert, values)
+            rows = conn.execute(select).fetchall()
+        else:
+            with engine.connect() as url_conn:
+                with url_conn.begin():
+                    url_conn.execute(insert, values)
+                rows = url_conn.execute(select).fetchall()
+        for url_hash, url_id in rows:
+            ids[missing[url_hash]] = url_id
+    return ids
+
+def assign_url_ids(rows, new_ids, chunk_size=1000):
+    """Replace the url of each row with a url id
+
+    Rows are handled in chunks, so a generator of rows stays lazy.
+
+    Arguments:
+        rows {iterable} -- Row dicts, modified as they are yielded
+        new_ids {dict} -- Receives the url ids looked up, to be cached by
+                          remember_url_ids once committed
+    """
+    chunk = []
+    def flush():
+        urls = [row['url'] for row in chunk
+                if row.get('url') is not None and row['url'] not in new_ids]
+        if urls:
+            new_ids.update(intern_urls(urls))
+        for row in chunk:
+            url = row.pop('url', None)
+            if url is not None:
+                row['url_id'] = new_ids[url]
+        return chunk
+
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield from flush()
+            chunk = []
+    if chunk:
+        yield from flush()
+
+def remember_url_ids(new_ids):
+    cached = get_url_ids()
+    for url, url_id in new_ids.items():
+        cached.set(url, url_id)
@@ -0,0 +1,122 @@
+"""Run the benchmark scenarios, see benchmarks/__init__.py
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+
+from benchmarks import runner
+from benchmarks.payloads import Payloads
+from benchmarks.server import ROOT, Server
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'diff', '--quiet', 'HEAD'], cwd=ROOT).returncode
+        return commit + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def scenario_kwargs(scenario, args):
+    """Payload size arguments of a scenario"""
+    html_size = args.html_kb * 1024
+    return {
+        'browser_history': dict(n_items=args.items, n_visits=args.visits),
+        'snapshots': dict(html_size=html_size),
+        'activity': dict(html_size=html_size, n_mutations=args.mutations),
+        'website_history': dict(html_size=html_size),
+        'generic': dict(n_items=args.items),
+        'users': dict(),
+    }[scenario]
+
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('--scenarios', nargs='+', choices=list(runner.SCENARIOS),
+                    default=list(runner.SCENARIOS), help='default: all')
+parser.add_argument('--requests', type=int, default=200,
+                    help='requests per scenario')
+parser.add_argument('--concurrency', type=int, default=8,
+                    help='requests in flight')
+parser.add_argument('--items', type=int, default=100,
+                    help='history items per browser_history request, '
+                         'and items per generic request')
+parser.add_argument('--visits', type=int, default=5, help='visits per history item')
+parser.add_argument('--html-kb', type=int, default=100,
+                    help='html size of snapshots, activity and website history')
+parser.add_argument('--mutations', type=int, default=0,
+                    help='send activity html as a list of this many mutations')
+parser.add_argument('--gzip', action='store_true', help='gzip request bodies')
+parser.add_argument('--upload-kbps', type=float,
+                    help='send each body at this many KiB/s, like slow uploads')
+parser.add_argument('--seed', type=int, default=0)
+
+server = parser.add_argument_group('server')
+server.add_argument('--url', help='benchmark a running app instead of starting one')
+server.add_argument('--master-pid', type=int,
+                    help='gunicorn master of --url, to sample worker memory')
+server.add_argument('--database-uri',
+                    help='database of the started app (default: a new SQLite file)')
+server.add_argument('--workers', type=int, default=4, help='gunicorn workers')
+server.add_argument('--worker-class', choices=['sync', 'gevent'], default='sync',
+                    help='gunicorn worker class')
+server.add_argument('--port', type=int, default=5055)
+
+parser.add_argument('--out', help='results file '
+                    '(default: benchmarks/results/<time>-<commit>.json)')
+
+args = parser.parse_args()
+commit = git_commit()
+results = {
+    'commit': commit,
+    'created': datetime.utcnow().isoformat(timespec='seconds'),
+    'python': platform.python_version(),
+    'args': vars(args),
+    'scenarios': {},
+}
+
+if args.url:
+    server = None
+    url, master_pid = args.url.rstrip('/'), args.master_pid
+else:
+    database_uri = args.database_uri or \
+        'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='sqlplatform-bench-'),
+                                    'bench.db')
+    server = Server(database_uri, args.workers, args.worker_class, args.port)
+    server.start()
+    url, master_pid = server.url, server.process.pid
+    results['database'] = database_uri.split(':', 1)[0]
+    results['worker_class'] = args.worker_class
+
+try:
+    payloads = Payloads(seed=args.seed)
+    for scenario in args.scenarios:
+        bodies = runner.build_bodies(payloads, scenario, args.requests, args.gzip,
+                                     **scenario_kwargs(scenario, args))
+        result = runner.run_scenario(url, scenario, bodies, args.concurrency,
+                                     use_gzip=args.gzip, master_pid=master_pid,
+                                     upload_rate=args.upload_kbps and args.upload_kbps * 1024)
+        results['scenarios'][scenario] = result
+        latency = result['latency_ms']
+        print(f"{scenario:16} {result['requests_per_sec']:8.1f} req/s "
+              f"{result['rows_per_sec']:10.1f} rows/s  p50 {latency['p50']} ms  "
+              f"p95 {latency['p95']} ms  p99 {latency['p99']} ms  "
+              f"errors {result['errors']}", flush=True)
+finally:
+    if server is not None:
+        server.stop()
+
+out = args.out or os.path.join(
+    ROOT, 'benchmarks', 'results',
+    f"{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}-{commit}.json")
+os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+with open(out, 'w') as outfile:
+    json.dump(results, outfile, indent=2)
+print(f'Results written to {out}')
+if any(result['errors'] for result in results['scenarios'].values()):
+    sys.exit(1)
@@ -0,0 +1,44 @@
+"""Compare two benchmark result files
+
+    python -m benchmarks.compare old.json new.json
+"""
+import json
+import sys
+
+# Metric, path in a scenario result and whether higher is better
+METRICS = [
+    ('req/s', ('requests_per_sec',), True),
+    ('rows/s', ('rows_per_sec',), True),
+    ('p50 ms', ('latency_ms', 'p50'), False),
+    ('p95 ms', ('latency_ms', 'p95'), False),
+    ('p99 ms', ('latency_ms', 'p99'), False),
+    ('worker MiB', ('peak_worker_rss_mib',), False),
+]
+
+
+def lookup(result, path):
+    for key in path:
+        result = result.get(key) if result else None
+    return result
+
+def compare(old, new):
+    print(f"{'scenario':16} {'metric':10} {old['commit']:>12} {new['commit']:>12}   change")
+    for scenario, new_result in new['scenarios'].items():
+        old_result = old['scenarios'].get(scenario)
+        if old_result is None:
+            continue
+        for name, path, higher_is_better in METRICS:
+            a, b = lookup(old_result, path), lookup(new_result, path)
+            if not a or b is None:
+                continue
+            change = (b - a) / a * 100
+            worse = change < 0 if higher_is_better else change > 0
+            flag = '  worse' if worse and abs(change) >= 10 else ''
+            print(f'{scenario:16} {name:10} {a:12} {b:12} {change:+7.1f}%{flag}')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.exit(__doc__)
+    with open(sys.argv[1]) as old_file, open(sys.argv[2]) as new_file:
+        compare(json.load(old_file), json.load(new_file))
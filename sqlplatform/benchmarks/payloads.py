@@ -0,0 +1,155 @@
+"""Extension payloads for the benchmarks
+
+Shaped like what the browser extension sends (see app/save_data/ingest.py),
+with sizes set by the scenario. A Payloads instance is seeded, so a run sends
+the same bodies every time.
+"""
+import random
+import uuid
+from datetime import datetime, timedelta
+
+WORDS = ('news', 'search', 'video', 'watch', 'results', 'election', 'weather',
+         'sports', 'music', 'recipe', 'review', 'politics', 'trailer', 'live')
+TAGS = ('div', 'span', 'a', 'p', 'li', 'h3')
+DOMAINS = ('www.google.com', 'news.google.com', 'www.youtube.com',
+           'twitter.com', 'www.facebook.com', 'www.nytimes.com')
+TRANSITIONS = ('link', 'typed', 'auto_bookmark', 'generated', 'reload')
+
+# Milliseconds since the epoch of the generated history visits
+EPOCH_MS = 1600000000000
+
+
+def iso_now():
+    """Timestamp as sent by the extension, `Date.toISOString()`"""
+    return datetime.utcnow().isoformat(timespec='milliseconds') + 'Z'
+
+
+class Payloads(object):
+    """Generates request bodies for the benchmark scenarios
+
+    Keyword Arguments:
+        seed {int} -- Random seed
+        n_urls {int} -- Distinct urls to draw from, real histories repeat a
+                        small set of urls many times
+    """
+
+    def __init__(self, seed=0, n_urls=5000):
+        self.random = random.Random(seed)
+        self.urls = [self._url() for _ in range(n_urls)]
+        self.n_users = 0
+
+    def _url(self):
+        words = self.random.sample(WORDS, 3)
+        return (f'https://{self.random.choice(DOMAINS)}/{words[0]}'
+                f'?q={"+".join(words[1:])}&n={self.random.randrange(10 ** 6)}')
+
+    def url(self):
+        # Skewed towards the first urls, like popular pages
+        return self.urls[int(len(self.urls) * self.random.random() ** 3)]
+
+    def html(self, size):
+        """Nested markup of roughly size bytes"""
+        parts = ['<html><body>']
+        length = len(parts[0])
+        while length < size:
+            tag = self.random.choice(TAGS)
+            text = ' '.join(self.random.choices(WORDS, k=8))
+            part = f'<{tag} class="c{self.random.randrange(50)}">{text}</{tag}>'
+            parts.append(part)
+            length += len(part)
+        parts.append('</body></html>')
+        return ''.join(parts)
+
+    def user_id(self):
+        """A new participant id, with the 'test-' prefix of test sources"""
+        self.n_users += 1
+        return f'test-bench-{self.n_users}-{uuid.UUID(int=self.random.getrandbits(128))}'
+
+    def meta(self, api, user_id=None):
+        return {
+            'user_id': user_id or self.user_id(),
+            'worker_id': str(self.random.randrange(1000)),
+            'timestamp': iso_now(),
+            'version': '0.8.0',
+            'api': api,
+        }
+
+    def browser_history(self, n_items=100, n_visits=5):
+        """History items of one pull, each with its visits
+
+        Returns:
+            tuple -- The payload and the number of rows it adds
+        """
+        items = []
+        for i in range(n_items):
+            visits = []
+            for j in range(n_visits):
+                visit_time = EPOCH_MS + self.random.randrange(10 ** 10)
+                visits.append({
+                    'id': str(i),
+                    'visitId': str(i * n_visits + j),
+                    'visitTime': visit_time + 0.123,
+                    'referringVisitId': '0',
+                    'transition': self.random.choice(TRANSITIONS),
+                })
+            items.append({'url': self.url(), 'visits': visits})
+        return dict(self.meta('browser_history'), data=items), n_items * n_visits
+
+    def snapshot(self, html_size=100 * 1024):
+        data = {
+            'wintab': f'{self.random.randrange(100)}-{self.random.randrange(1000)}',
+            'incognito': False,
+            'url': self.url(),
+            'html': self.html(html_size),
+        }
+        return dict(self.meta('periodic_snapshots'), data=data), 1
+
+    def activity(self, html_size=100 * 1024, n_mutations=0):
+        """An activity page capture
+
+        Keyword Arguments:
+            html_size {int} -- Bytes of html
+            n_mutations {int} -- Split the html into a list of this many
+                                 mutation updates, as sent for infinite scroll
+        """
+        html = self.html(html_size)
+        if n_mutations:
+            step = max(len(html) // n_mutations, 1)
+            html = [html[i:i + step] for i in range(0, len(html), step)]
+        data = {
+            'wintab': f'{self.random.randrange(100)}-{self.random.randrange(1000)}',
+            'lastwt': '',
+            'type': 'scroll' if n_mutations else 'load',
+            'url': self.url(),
+            'html': html,
+            'links': [self.url() for _ in range(20)],
+            'tweet_ids': [],
+            'youtube_iframes': [],
+        }
+        return dict(self.meta('activity'), data=data), 1
+
+    def website_history(self, html_size=50 * 1024):
+        data = {
+            'url': self.url(),
+            'name': self.random.choice(('google', 'youtube', 'facebook')),
+            'html': self.html(html_size),
+        }
+        return dict(self.meta('website_history'), data=data), 1
+
+    def generic(self, n_items=500):
+        """An api without a model of its own, e.g. ad_preferences"""
+        data = [{'name': ' '.join(self.random.choices(WORDS, k=3)),
+                 'weight': self.random.random()} for _ in range(n_items)]
+        return dict(self.meta('ad_preferences'), data=data), 1
+
+    def user(self):
+        """A /save_user registration"""
+        stamp = datetime.utcnow() - timedelta(seconds=self.random.randrange(3600))
+        return {
+            'user_id': self.user_id(),
+            'browser': self.random.choice(('chrome', 'firefox')),
+            'consent': True,
+            'consent_fb': self.random.random() < 0.5,
+            'install_time': stamp.isoformat(timespec='milliseconds') + 'Z',
+            'version': '0.8.0',
+        }, 1
@@ -0,0 +1,164 @@
+"""Send scenario payloads concurrently and measure the responses
+"""
+import gzip
+import json
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+import requests
+
+from benchmarks.server import RssSampler
+
+# Scenario name -> endpoint and Payloads method
+SCENARIOS = {
+    'browser_history': ('/save_data', 'browser_history'),
+    'snapshots': ('/save_data', 'snapshot'),
+    'activity': ('/save_data', 'activity'),
+    'website_history': ('/save_data', 'website_history'),
+    'generic': ('/save_data', 'generic'),
+    'users': ('/save_user', 'user'),
+}
+
+
+class ThrottledBody(object):
+    """Request body read at a limited rate, like a slow residential upload
+
+    Arguments:
+        body {bytes} -- The request body
+        rate {float} -- Bytes per second
+    """
+
+    def __init__(self, body, rate, chunk_size=8192):
+        self.body = body
+        self.rate = rate
+        self.chunk_size = chunk_size
+        self.pos = 0
+
+    def __len__(self):
+        # Sent with a Content-Length instead of chunked
+        return len(self.body) - self.pos
+
+    def read(self, size=-1):
+        size = self.chunk_size if size < 0 else min(size, self.chunk_size)
+        chunk = self.body[self.pos:self.pos + size]
+        self.pos += len(chunk)
+        time.sleep(len(chunk) / self.rate)
+        return chunk
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of sorted values"""
+    if not values:
+        return None
+    rank = max(math.ceil(pct / 100 * len(values)) - 1, 0)
+    return values[rank]
+
+def rows_inserted(url):
+    """Total of db_rows_inserted_total in /metrics, None if unavailable"""
+    try:
+        text = requests.get(url + '/metrics', timeout=10).text
+    except requests.RequestException:
+        return None
+    total = 0.0
+    for line in text.splitlines():
+        if line.startswith('db_rows_inserted_total{'):
+            total += float(line.rsplit(' ', 1)[1])
+    return total
+
+def build_bodies(payloads, scenario, n_requests, use_gzip, **kwargs):
+    """Encode the request bodies of a scenario ahead of the timed run
+
+    Returns:
+        list -- (body bytes, number of rows) per request
+    """
+    make_payload = getattr(payloads, SCENARIOS[scenario][1])
+    bodies = []
+    for _ in range(n_requests):
+        payload, n_rows = make_payload(**kwargs)
+        body = json.dumps(payload).encode('utf-8')
+        if use_gzip:
+            body = gzip.compress(body, 6)
+        bodies.append((body, n_rows))
+    return bodies
+
+
+def run_scenario(url, scenario, bodies, concurrency, use_gzip=False,
+                 master_pid=None, upload_rate=None):
+    """Post the bodies with concurrency requests in flight
+
+    Arguments:
+        url {str} -- Base url of the app
+        scenario {str} -- Key of SCENARIOS
+        bodies {list} -- Output of build_bodies
+        concurrency {int} -- Client threads
+
+    Keyword Arguments:
+        use_gzip {bool} -- The bodies are gzip compressed
+        master_pid {int} -- gunicorn master whose workers' RSS is sampled
+        upload_rate {float} -- Bytes per second each request body is sent at
+                               (default: unlimited)
+
+    Returns:
+        dict -- Throughput, latency percentiles, rows and memory of the run
+    """
+    endpoint = url + SCENARIOS[scenario][0]
+    headers = {'Content-Type': 'application/json'}
+    if use_gzip:
+        headers['Content-Encoding'] = 'gzip'
+
+    local = threading.local()
+    def post(body):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        if upload_rate:
+            body = ThrottledBody(body, upload_rate)
+        start = time.perf_counter()
+        try:
+            response = local.session.post(endpoint, data=body, headers=headers,
+                                          timeout=600)
+            ok = response.status_code == 200 and 'error' not in response.json()
+        except (requests.RequestException, ValueError):
+            ok = False
+        return time.perf_counter() - start, ok
+
+    rows_before = rows_inserted(url)
+    sampler = RssSampler(master_pid) if master_pid else None
+    with sampler or nullcontext():
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(post, [body for body, _ in bodies]))
+        seconds = time.perf_counter() - start
+    rows_after = rows_inserted(url)
+
+    latencies = sorted(latency for latency, _ in results)
+    n_errors = sum(1 for _, ok in results if not ok)
+    if rows_before is not None and rows_after is not None and \
+       endpoint.endswith('/save_data'):
+        n_rows = rows_after - rows_before
+    else:
+        # No row counts in /metrics, assume every row of a successful request was saved
+        n_rows = sum(rows for (_, rows), (_, ok) in zip(bodies, results) if ok)
+
+    ms = lambda value: None if value is None else round(value * 1000, 2)
+    mib = lambda value: round(value / 2 ** 20, 1)
+    return {
+        'requests': len(results),
+        'errors': n_errors,
+        'concurrency': concurrency,
+        'seconds': round(seconds, 3),
+        'requests_per_sec': round(len(results) / seconds, 2),
+        'rows': int(n_rows),
+        'rows_per_sec': round(n_rows / seconds, 2),
+        'bytes_sent': sum(len(body) for body, _ in bodies),
+        'latency_ms': {
+            'p50': ms(percentile(latencies, 50)),
+            'p95': ms(percentile(latencies, 95)),
+            'p99': ms(percentile(latencies, 99)),
+            'max': ms(latencies[-1] if latencies else None),
+        },
+        'peak_worker_rss_mib': mib(sampler.peak_worker) if sampler else None,
+        'peak_total_rss_mib': mib(sampler.peak_total) if sampler else None,
+    }
@@ -0,0 +1,158 @@
+"""Start the app under gunicorn for a benchmark and watch its workers
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+def create_tables(database_uri):
+    """Create the tables of a benchmark database, if missing"""
+    env = dict(os.environ, DATABASE_URI=database_uri)
+    code = 'from sqlplatform import app, db\n' \
+           'with app.app_context(): db.create_all()'
+    subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=env, check=True,
+                   stdout=subprocess.DEVNULL)
+
+
+class Server(object):
+    """gunicorn serving the app on a local port
+
+    Arguments:
+        database_uri {str} -- SQLAlchemy URI of the database to write to
+        workers {int} -- gunicorn workers
+
+    Keyword Arguments:
+        worker_class {str} -- 'sync' or 'gevent', see deployment/gunicorn.config.py
+        port {int} -- Port to bind on 127.0.0.1
+        extra_args {list} -- More gunicorn arguments
+    """
+
+    def __init__(self, database_uri, workers, worker_class='sync', port=5055,
+                 extra_args=()):
+        self.database_uri = database_uri
+        self.workers = workers
+        self.worker_class = worker_class
+        self.port = port
+        self.extra_args = list(extra_args)
+        self.url = f'http://127.0.0.1:{port}'
+        self.tmp_dir = tempfile.mkdtemp(prefix='sqlplatform-bench-')
+        self.log_path = os.path.join(self.tmp_dir, 'gunicorn.log')
+        self.process = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self, timeout=30):
+        create_tables(self.database_uri)
+        # Payloads come from new user ids that never went through /save_user.
+        # Files the workers share are kept apart from any app on the host.
+        env = dict(os.environ, DATABASE_URI=self.database_uri,
+                   GUNICORN_WORKER_CLASS=self.worker_class,
+                   PARTICIPANT_CHECK='off',
+                   RATE_LIMIT_FILE=os.path.join(self.tmp_dir, 'ratelimit'),
+                   SPOOL_DIR=os.path.join(self.tmp_dir, 'spool'),
+                   prometheus_multiproc_dir=os.path.join(self.tmp_dir, 'metrics'))
+        # gunicorn of the same environment, it has no `python -m gunicorn`
+        gunicorn = os.path.join(os.path.dirname(sys.executable), 'gunicorn')
+        cmd = [gunicorn if os.path.exists(gunicorn) else 'gunicorn',
+               '-c', 'deployment/gunicorn.config.py',
+               '-w', str(self.workers), '-b', f'127.0.0.1:{self.port}',
+               *self.extra_args, 'wsgi:app']
+        self.log = open(self.log_path, 'wb')
+        self.process = subprocess.Popen(cmd, cwd=ROOT, env=env,
+                                        stdout=self.log, stderr=subprocess.STDOUT)
+
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f'gunicorn exited, see {self.log_path}')
+            try:
+                urllib.request.urlopen(self.url + '/metrics', timeout=1)
+                return
+            except OSError:
+                time.sleep(0.2)
+        self.stop()
+        raise RuntimeError(f'gunicorn did not start, see {self.log_path}')
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait(timeout=30)
+            self.log.close()
+        self.process = None
+
+
+def child_pids(pid):
+    """Pids of the direct children of a process"""
+    pids = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat', 'r') as infile:
+                stat = infile.read()
+        except OSError:
+            continue
+        # The command name in parentheses may contain spaces
+        ppid = int(stat.rsplit(')', 1)[1].split()[1])
+        if ppid == pid:
+            pids.append(int(entry))
+    return pids
+
+def rss_bytes(pid):
+    try:
+        with open(f'/proc/{pid}/status', 'r') as infile:
+            for line in infile:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+class RssSampler(object):
+    """Samples the RSS of the workers of a gunicorn master in the background
+
+    Only works on Linux, elsewhere the peaks stay 0.
+
+    Arguments:
+        master_pid {int} -- The gunicorn master
+
+    Keyword Arguments:
+        interval {float} -- Seconds between samples
+    """
+
+    def __init__(self, master_pid, interval=0.2):
+        self.master_pid = master_pid
+        self.interval = interval
+        self.peak_worker = 0
+        self.peak_total = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            if os.path.isdir('/proc'):
+                sizes = [rss_bytes(pid) for pid in child_pids(self.master_pid)]
+                if sizes:
+                    self.peak_worker = max(self.peak_worker, max(sizes))
+                    self.peak_total = max(self.peak_total, sum(sizes))
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
@@ -24,14 +24,163 @@ FP_CREDENTIALS = './cred'
 MYSQL_URI = get_mysql_uri(FP_CREDENTIALS, "extension")
 SQLITE3_URI = 'sqlite:///test.db'
 
+# max_connections in deployment/my.cnf, and connections left for
+# drain_spool.py, db_jobs.py, backups and admin sessions
+MYSQL_MAX_CONNECTIONS = 300
+MYSQL_RESERVED_CONNECTIONS = 20
+
+def db_pool_size():
+    """Connections per worker, so all gunicorn workers fit in max_connections
+
+    gunicorn sets GUNICORN_WORKERS in each worker, see
+    deployment/gunicorn.config.py. A sync worker uses one connection at a
+    time, a gevent worker one per request in flight. Each worker also keeps
+    one connection outside the pool to intern urls, see app/urls.py.
+    """
+    workers = int(os.environ.get('GUNICORN_WORKERS', 1))
+    available = MYSQL_MAX_CONNECTIONS - MYSQL_RESERVED_CONNECTIONS
+    return max(available // workers - 1, 1)
+
 class Config(object):
     """Base config vars."""
     WTF_CSRF_ENABLED = True
     SECRET_KEY = 'redacted_pw'
-    SQLALCHEMY_DATABASE_URI = MYSQL_URI if DB_TYPE == 'mysql' else SQLITE3_URI
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URI') or \
+        (MYSQL_URI if DB_TYPE == 'mysql' else SQLITE3_URI)
     SQLALCHEMY_POOL_RECYCLE = 3600
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+    # Bounded pool per worker, requests beyond it wait up to POOL_TIMEOUT
+    # seconds for a connection (SQLite keeps its default pool)
+    if SQLALCHEMY_DATABASE_URI.startswith('mysql'):
+        SQLALCHEMY_POOL_SIZE = db_pool_size()
+        SQLALCHEMY_MAX_OVERFLOW = 0
+        SQLALCHEMY_POOL_TIMEOUT = 30
+
+    # Bulk inserts: rows per multi-row INSERT, and whether an upload commits
+    # as a single transaction (True) or after every chunk (False)
+    BULK_INSERT_CHUNK_SIZE = 1000
+    BULK_INSERT_ATOMIC = True
+
+    # Per-worker LRU of recently saved (user_id, hv_id) pairs, 0 to disable
+    HISTORY_VISIT_CACHE_SIZE = 100000
+
+    # Retries of website history, snapshot and activity uploads are answered
+    # without saving again, keyed by their Idempotency-Key header or content.
+    # Keys are kept in a per-worker LRU and for REQUEST_KEY_DAYS in the
+    # request_key table
+    REQUEST_KEY_CACHE_SIZE = 10000
+    REQUEST_KEY_DAYS = 7
+
+    # HTML blob store: compressed, deduplicated html for snapshots, activity
+    # and website history ('zlib', or 'zstd' with the zstandard package)
+    HTML_BLOB_STORE = True
+    HTML_BLOB_CODEC = 'zlib'
+    HTML_BLOB_CACHE_SIZE = 10000
+
+    # Cold tier: `python db_jobs.py html-archive` moves blobs older than
+    # HTML_ARCHIVE_AGE_DAYS to segment files in HTML_ARCHIVE_DIR, read back
+    # through mmap (see app/archive.py)
+    HTML_ARCHIVE_DIR = './var/html_archive'
+    HTML_ARCHIVE_AGE_DAYS = 90
+    HTML_ARCHIVE_SEGMENT_SIZE = 1024 * 1024 * 1024
+    HTML_ARCHIVE_OPEN_SEGMENTS = 64
+
+    # URL interning: history tables reference urls by id in the url table
+    URL_INTERNING = True
+    URL_CACHE_SIZE = 100000
+
+    # Tables partitioned by month of arrival on MySQL, see db_partitions.py.
+    # A new month reserves twice the ids of the last one, at least this many
+    PARTITION_TABLES = ('activity', 'snapshots')
+    PARTITION_MIN_HEADROOM = 1000000
+
+    # Codec of the compressed JSON payloads in the generic data table
+    DATA_CODEC = 'zlib'
+
+    # Cap on gzip/deflate request bodies once decompressed, in bytes
+    MAX_DECOMPRESSED_BODY_SIZE = 200 * 1024 * 1024
+
+    # Ingestion: 'sync' saves /save_data requests to SQL before answering,
+    # 'spool' appends them to SPOOL_DIR for drain_spool.py to replay
+    INGEST_MODE = 'sync'
+    SPOOL_DIR = os.environ.get('SPOOL_DIR') or './var/spool'
+    SPOOL_SEGMENT_SIZE = 256 * 1024 * 1024
+    SPOOL_FSYNC_RECORDS = 100
+    SPOOL_FSYNC_INTERVAL = 1.0
+    SPOOL_DRAIN_BATCH = 500
+
+    # Rate limits of /save_data, shared by the workers through RATE_LIMIT_FILE
+    # (see app/save_data/ratelimit.py). RATE_LIMITS holds token buckets per
+    # user and api as (requests per minute, burst), INFLIGHT_LIMITS caps the
+    # requests of an api processed at once. Over a limit the client gets a
+    # 429 with a Retry-After; None means no limit. Off until every participant
+    # runs an extension that retries after a 429, see deployment/README.md.
+    RATE_LIMIT = False
+    RATE_LIMIT_FILE = os.environ.get('RATE_LIMIT_FILE') or './var/ratelimit'
+    RATE_LIMIT_SLOTS = 2 ** 16
+    RATE_LIMITS = {
+        'default': (60, 30),
+        'browser_history': (10, 10),
+        'google_activity': (10, 10),
+    }
+    INFLIGHT_LIMITS = {
+        'default': None,
+        'browser_history': 32,
+        'google_activity': 32,
+    }
+    INFLIGHT_RETRY_AFTER = 5
+    # Workers with in-flight counters at once, None for twice GUNICORN_WORKERS
+    RATE_LIMIT_MAX_WORKERS = None
+
+    # Serve the static pages from a per-worker cache of rendered, compressed
+    # HTML (see app/pages.py), which browsers may reuse for PAGE_CACHE_MAX_AGE
+    PAGE_CACHE = True
+    PAGE_CACHE_MAX_AGE = 600
+
+    # /save_data rejects data of participants who declined consent
+    # (PARTICIPANT_CHECK), looked up in a per-worker registry (see
+    # app/participants.py) once per PARTICIPANT_TTL seconds, and once per
+    # PARTICIPANT_NEGATIVE_TTL for ids without a user row, whose data is
+    # saved and counted. Data of ENDED_COHORTS is never saved.
+    # PARTICIPANT_CHECK=off in the environment disables the lookup, e.g. for
+    # benchmarks.
+    PARTICIPANT_CHECK = os.environ.get('PARTICIPANT_CHECK') != 'off'
+    PARTICIPANT_CACHE_SIZE = 100000
+    PARTICIPANT_TTL = 300
+    PARTICIPANT_NEGATIVE_TTL = 10
+    ENDED_COHORTS = ('yougov',)
+
+    # Structured JSON logs written by a background thread (see app/logs.py),
+    # to LOG_FILE or stderr when None. LOG_SAMPLING is the share of records
+    # kept by event, LOG_RATE_LIMITS caps the records of an event per worker
+    # as (records per second, burst); None means no limit. Errors are never
+    # sampled.
+    LOG_LEVEL = 'INFO'
+    LOG_FILE = None
+    LOG_QUEUE_SIZE = 10000
+    LOG_SAMPLING = {
+        'request': 0.1,
+    }
+    LOG_RATE_LIMITS = {
+        'default': (50, 200),
+        'request': (20, 100),
+    }
+
+    # Bearer token of the /timeline read API, disabled when unset
+    TIMELINE_TOKEN = os.environ.get('TIMELINE_TOKEN')
+
+    # Snapshot URL term sets per participant source, see app/snapshots/terms.py
+    SNAPSHOT_TERMS_FILE = os.path.join(os.path.dirname(__file__), 'app',
+                                       'snapshots', 'snapshot_terms.json')
+
+    # Parse the meta data of /save_data requests ahead of their data, which is
+    # only read once the request is let in, and list data (e.g. browser
+    # history) item by item, instead of decoding the whole body. Spooled
+    # requests always have their meta data read first.
+    STREAM_JSON = True
+    STREAM_JSON_CHUNK_SIZE = 64 * 1024
+
 class ProdConfig(Config):
     DEBUG = False
     TESTING = False
@@ -39,4 +188,5 @@ class ProdConfig(Config):
 class DevConfig(Config):
     DEBUG = True
     TESTING = True
+    PAGE_CACHE = False
     EXPLAIN_TEMPLATE_LOADING = True
\ No newline at end of file
@@ -0,0 +1,568 @@
+""" Incremental backups of the SQL database
+
+Each run writes a segment directory `<dir>/<YYYYmmddTHHMMSS>-<full|incr>/`
+holding one gzipped JSON-lines file per table and a `manifest.json` with the
+row counts, id ranges and sha256 of every file. A full segment dumps every
+row; an incremental one the rows with ids after those of an earlier segment,
+so its cost is proportional to new data.
+
+Ids are handed out when a row is inserted, not when it is committed, so a row
+of a long transaction can show up after rows with higher ids. An incremental
+segment therefore starts at the last id of the latest segment taken at least
+TRANSACTION_MARGIN before the previous one, when every row with a lower id
+had been committed. Restore keeps the last copy of a row.
+
+Rows updated or deleted in place by the jobs of db_jobs.py, db_features.py
+and db_partitions.py are recorded by id range in row_change (see
+app/changes.py), and an incremental segment dumps the ranges recorded since
+again. Small tables updated by the application (FULL_TABLES) are dumped whole
+in every segment and restored from the last one. Rows changed by a migration
+are not recorded, so a new full segment is started automatically when the
+migration revision changes.
+
+The `<table>_p<YYYYMM>` tables that `db_partitions.py archive` moves old
+partitions to are backed up too, and created by restore.
+
+The segment files of the html archive (see app/archive.py) are copied to
+`<dir>/html_archive/`. They are only appended to, so each backup copies the
+bytes appended since the last one and records their sha256 in the manifest.
+They are copied after the database snapshot, whose rows only point at bytes
+synced before, and a backup stops if an html_blob row points past the copied
+bytes. Restore copies them back to HTML_ARCHIVE_DIR.
+
+A full segment and the incremental ones after it form a chain. Restore
+replays the latest chain (or the one ending at --until) into a database
+created at the same migration revision.
+
+    python db_backup.py backup --dir /media/data/backups
+    python db_backup.py backup --dir /media/data/backups --full --keep 3
+    python db_backup.py verify --dir /media/data/backups
+    python db_backup.py restore --dir /media/data/backups
+"""
+import argparse
+import base64
+import glob
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sys
+from datetime import datetime
+
+import sqlalchemy as sa
+
+from sqlplatform import app, db
+from app.archive import INDEX_EXT, SEGMENT_EXT
+from app.changes import TRANSACTION_MARGIN
+from app.models import HtmlBlob, RowChange, TablePartition
+
+MANIFEST = 'manifest.json'
+ARCHIVE_COPY = 'html_archive'
+STAMP_FORMAT = '%Y%m%dT%H%M%S'
+
+# Tables with rows updated in place by the application, e.g. /save_user upserts
+FULL_TABLES = ('user', 'table_partition', 'extract_watermark')
+
+
+def backup_tables():
+    """Tables with a single integer primary key, in dependency order"""
+    tables = []
+    for table in db.metadata.sorted_tables:
+        pk = list(table.primary_key.columns)
+        if len(pk) == 1 and isinstance(pk[0].type, sa.Integer):
+            tables.append(table)
+    return tables
+
+def archive_table(name, like):
+    """Table with the columns of another, as `db_partitions.py archive` makes"""
+    return sa.Table(name, sa.MetaData(), *(col.copy() for col in like.columns))
+
+def archive_tables(conn):
+    """Archived partitions, as (table, name of the table they came from)"""
+    t = TablePartition.__table__
+    query = sa.select([t.c.table_name, t.c.archive_table])\
+              .where(t.c.state == 'archived').order_by(t.c.archive_table)
+    tables = db.metadata.tables
+    return [(archive_table(row.archive_table, tables[row.table_name]), row.table_name)
+            for row in conn.execute(query) if row.table_name in tables]
+
+def encode(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode('ascii')
+    return value
+
+def decoder(column):
+    """Reverse of encode for the values of a column"""
+    sql_type = getattr(column.type, 'impl', column.type)
+    if isinstance(sql_type, sa.DateTime):
+        return datetime.fromisoformat
+    if isinstance(sql_type, sa.LargeBinary):
+        return base64.b64decode
+    return None
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def max_id(conn, table):
+    pk = list(table.primary_key.columns)[0]
+    return conn.execute(sa.select([sa.func.max(pk)])).scalar() or 0
+
+def migration_revision(conn):
+    try:
+        return conn.execute('SELECT version_num FROM alembic_version').scalar()
+    except sa.exc.DatabaseError:
+        return None
+
+
+def segment_time(segment):
+    return datetime.strptime(segment['created'], STAMP_FORMAT)
+
+def load_segments(backup_dir):
+    """Manifests of the complete segments, oldest first"""
+    segments = []
+    for path in sorted(glob.glob(os.path.join(backup_dir, '*', MANIFEST))):
+        with open(path, 'r') as infile:
+            manifest = json.load(infile)
+        manifest['path'] = os.path.dirname(path)
+        segments.append(manifest)
+    return segments
+
+def chains(segments):
+    """Group segments into chains, each starting with a full segment"""
+    result = []
+    for segment in segments:
+        if segment['full']:
+            result.append([])
+        if result:
+            result[-1].append(segment)
+    return result
+
+
+def settled_segment(segments):
+    """The segment whose ids start the next incremental one
+
+    The latest segment taken TRANSACTION_MARGIN before the last one. The
+    rows with ids up to its last ones had all been committed when the last
+    segment was taken, and a row committed since got its id after it was
+    taken, so above them.
+
+    Returns:
+        dict -- The manifest, None if there is none that old
+    """
+    before = segment_time(segments[-1]) - TRANSACTION_MARGIN
+    settled = [segment for segment in segments if segment_time(segment) <= before]
+    return settled[-1] if settled else None
+
+def changed_ranges(conn, start, end):
+    """Id ranges recorded in row_change with start < id <= end, by table
+
+    Returns:
+        dict -- Lists of [start, end] with start < id <= end, by table name
+    """
+    t = RowChange.__table__
+    query = sa.select([t.c.table_name, t.c.id_start, t.c.id_end])\
+              .where(t.c.id > start).where(t.c.id <= end)
+    ranges = {}
+    for row in conn.execute(query):
+        ranges.setdefault(row.table_name, []).append([row.id_start - 1,
+                                                      row.id_end - 1])
+    return ranges
+
+def merge_ranges(ranges):
+    """Sorted, non-overlapping ranges covering the given ones"""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+def dump_table(conn, table, path, ranges, batch_size):
+    """Write the rows with start < id <= end of each range to a gzipped
+    JSON-lines file
+
+    Returns:
+        int -- The number of rows written
+    """
+    pk = list(table.primary_key.columns)[0]
+    n_rows = 0
+    with gzip.open(path, 'wt', encoding='utf-8', compresslevel=6) as outfile:
+        for start, end in ranges:
+            last = start
+            while True:
+                query = sa.select(table.columns)\
+                          .where(pk > last).where(pk <= end)\
+                          .order_by(pk).limit(batch_size)
+                rows = conn.execute(query).fetchall()
+                if not rows:
+                    break
+                for row in rows:
+                    record = {key: encode(value) for key, value in row.items()}
+                    outfile.write(json.dumps(record) + '\n')
+                last = rows[-1][pk.name]
+                n_rows += len(rows)
+    return n_rows
+
+def archive_ends(conn, ranges):
+    """End of the bytes the html_blob rows of id ranges point at, by segment"""
+    t = HtmlBlob.__table__
+    query = sa.select([t.c.archive_segment,
+                       sa.func.max(t.c.archive_offset + t.c.archive_length)])\
+              .where(t.c.archive_segment.isnot(None))\
+              .where(sa.or_(*(sa.and_(t.c.id > start, t.c.id <= end)
+                              for start, end in ranges)))\
+              .group_by(t.c.archive_segment)
+    return {f'{number:06d}{SEGMENT_EXT}': end for number, end in conn.execute(query)}
+
+def copy_range(src_path, dst_path, start, end):
+    """Copy bytes start to end of a file to the same place in another
+
+    Returns:
+        str -- sha256 of the bytes
+    """
+    digest = hashlib.sha256()
+    with open(src_path, 'rb') as infile, open(dst_path, 'r+b') as outfile:
+        infile.seek(start)
+        outfile.seek(start)
+        outfile.truncate()
+        left = end - start
+        while left:
+            chunk = infile.read(min(left, 1024 * 1024))
+            if not chunk:
+                raise ValueError(f'{src_path} ends before byte {end}')
+            digest.update(chunk)
+            outfile.write(chunk)
+            left -= len(chunk)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    return digest.hexdigest()
+
+def backup_archive(archive_dir, backup_dir, previous):
+    """Copy the bytes appended to the html archive since the last backup
+
+    Arguments:
+        archive_dir {str} -- HTML_ARCHIVE_DIR
+        backup_dir {str} -- Directory holding the segments
+        previous {dict} -- Files of the last manifest, {} for none
+
+    Returns:
+        dict -- Size and [start, end, sha256] pieces of each file, by name
+    """
+    copy_dir = os.path.join(backup_dir, ARCHIVE_COPY)
+    os.makedirs(copy_dir, exist_ok=True)
+    files = {}
+    for path in sorted(glob.glob(os.path.join(archive_dir, '*' + SEGMENT_EXT)) +
+                       glob.glob(os.path.join(archive_dir, '*' + INDEX_EXT))):
+        name = os.path.basename(path)
+        info = previous.get(name, {'size': 0, 'pieces': []})
+        size = os.path.getsize(path)
+        if size < info['size']:
+            sys.exit(f'{path} is shorter than when it was backed up.')
+        pieces = list(info['pieces'])
+        dst_path = os.path.join(copy_dir, name)
+        if not os.path.exists(dst_path):
+            open(dst_path, 'wb').close()
+        if os.path.getsize(dst_path) < info['size']:
+            sys.exit(f'{dst_path} lost bytes that were backed up, start a new '
+                     f'backup directory.')
+        if size > info['size']:
+            # Bytes a run that failed may have copied past the size are redone
+            pieces.append([info['size'], size,
+                           copy_range(path, dst_path, info['size'], size)])
+        files[name] = {'size': size, 'pieces': pieces}
+    return files
+
+def backup(backup_dir, full=False, batch_size=5000):
+    """Write a new segment with the rows added or changed since the last one
+
+    Arguments:
+        backup_dir {str} -- Directory holding the segments
+
+    Keyword Arguments:
+        full {bool} -- Start a new chain with every row (default: {False})
+        batch_size {int} -- Rows read per query
+
+    Returns:
+        dict -- The manifest of the new segment
+    """
+    os.makedirs(backup_dir, exist_ok=True)
+    segments = load_segments(backup_dir)
+    previous = segments[-1] if segments else None
+
+    stamp = datetime.utcnow().strftime(STAMP_FORMAT)
+    pointed = {}
+    conn = db.engine.connect()
+    try:
+        with conn.begin():
+            # Every table is read from the same snapshot
+            if conn.dialect.name == 'mysql':
+                conn.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+                conn.execute('START TRANSACTION WITH CONSISTENT SNAPSHOT')
+
+            revision = migration_revision(conn)
+            if previous is None or previous['revision'] != revision:
+                full = True
+
+            kind = 'full' if full else 'incr'
+            tmp_dir = os.path.join(backup_dir, f'.tmp-{stamp}-{kind}')
+            os.makedirs(tmp_dir)
+            manifest = {'created': stamp, 'full': full, 'revision': revision,
+                        'tables': {}}
+
+            settled = None if full else settled_segment(segments)
+            def start_of(table):
+                if settled is None or table.name in FULL_TABLES:
+                    return 0
+                return settled['tables'].get(table.name, {}).get('end', 0)
+
+            row_change = RowChange.__table__
+            changed = {} if full else changed_ranges(
+                conn, start_of(row_change), max_id(conn, row_change))
+
+            tables = [(table, None) for table in backup_tables()]
+            for table, like in tables + archive_tables(conn):
+                pk = list(table.primary_key.columns)[0]
+                start, end = start_of(table), max_id(conn, table)
+                changes = [[low, min(high, end)]
+                           for low, high in changed.get(table.name, [])
+                           if low < min(high, end)]
+                ranges = merge_ranges([[start, end]] + changes)
+
+                name = f'{table.name}.jsonl.gz'
+                path = os.path.join(tmp_dir, name)
+                n_rows = dump_table(conn, table, path, ranges, batch_size)
+                info = manifest['tables'][table.name] = {
+                    'file': name, 'start': start, 'end': end, 'ranges': ranges,
+                    'rows': n_rows, 'columns': [col.name for col in table.columns],
+                    'sha256': sha256_file(path),
+                }
+                if like is not None:
+                    info['like'] = like
+                print(f'{table.name}: {n_rows} rows, {pk.name} {start}-{end}, '
+                      f'{len(changes)} changed ranges', flush=True)
+                if table.name == HtmlBlob.__tablename__:
+                    pointed = archive_ends(conn, ranges)
+    finally:
+        conn.close()
+
+    # Rows only point at synced bytes, so the files now hold all they need
+    manifest['html_archive'] = backup_archive(
+        app.config['HTML_ARCHIVE_DIR'], backup_dir,
+        previous.get('html_archive', {}) if previous else {})
+    for name, end in pointed.items():
+        size = manifest['html_archive'].get(name, {}).get('size', 0)
+        if end > size:
+            shutil.rmtree(tmp_dir)
+            sys.exit(f'html_blob rows point at byte {end} of {name}, only '
+                     f'{size} bytes were backed up. Not writing the segment.')
+    print(f'html archive: {len(manifest["html_archive"])} files copied to '
+          f'{os.path.join(backup_dir, ARCHIVE_COPY)}', flush=True)
+
+    with open(os.path.join(tmp_dir, MANIFEST), 'w') as outfile:
+        json.dump(manifest, outfile, indent=2)
+    segment_dir = os.path.join(backup_dir, f'{stamp}-{kind}')
+    os.rename(tmp_dir, segment_dir)
+    print(f'Backup written to {segment_dir}')
+    return manifest
+
+def prune(backup_dir, keep):
+    """Delete all but the last keep chains"""
+    for chain in chains(load_segments(backup_dir))[:-keep]:
+        for segment in chain:
+            shutil.rmtree(segment['path'])
+            print(f'Deleted {segment["path"]}')
+
+
+def sha256_range(path, start, end):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as infile:
+        infile.seek(start)
+        left = end - start
+        while left:
+            chunk = infile.read(min(left, 1024 * 1024))
+            if not chunk:
+                return None
+            digest.update(chunk)
+            left -= len(chunk)
+    return digest.hexdigest()
+
+def verify(segment, archive=True):
+    """Check the checksums of a segment's files
+
+    Keyword Arguments:
+        archive {bool} -- Check the copied html archive files too
+
+    Returns:
+        list -- The files that are missing or don't match
+    """
+    bad = []
+    for info in segment['tables'].values():
+        path = os.path.join(segment['path'], info['file'])
+        if not os.path.exists(path) or sha256_file(path) != info['sha256']:
+            bad.append(path)
+    if archive:
+        copy_dir = os.path.join(os.path.dirname(segment['path']), ARCHIVE_COPY)
+        for name, info in segment.get('html_archive', {}).items():
+            path = os.path.join(copy_dir, name)
+            if not os.path.exists(path) or \
+               any(sha256_range(path, start, end) != sha256
+                   for start, end, sha256 in info['pieces']):
+                bad.append(path)
+    return bad
+
+def restore_archive(backup_dir, files, archive_dir):
+    """Copy the backed up html archive files to HTML_ARCHIVE_DIR
+
+    Bytes already in a file are kept, the rest is copied up to the size at
+    the time of the backup.
+    """
+    os.makedirs(archive_dir, exist_ok=True)
+    for name, info in sorted(files.items()):
+        path = os.path.join(archive_dir, name)
+        if not os.path.exists(path):
+            open(path, 'wb').close()
+        size = os.path.getsize(path)
+        if size < info['size']:
+            copy_range(os.path.join(backup_dir, ARCHIVE_COPY, name), path,
+                       size, info['size'])
+    print(f'html archive: {len(files)} files in {archive_dir}', flush=True)
+
+def restore_table(conn, table, path, ranges, batch_size):
+    """Replace the rows of the id ranges of a segment file with its rows
+
+    Rows that conflict on another unique key are skipped.
+
+    Arguments:
+        ranges {list} -- [start, end] with start < id <= end, as dumped
+
+    Returns:
+        int -- The number of rows read
+    """
+    pk = list(table.primary_key.columns)[0]
+    for start, end in ranges:
+        with conn.begin():
+            conn.execute(table.delete().where(pk > start).where(pk <= end))
+
+    decoders = {col.name: decoder(col) for col in table.columns}
+    insert = table.insert().prefix_with('IGNORE', dialect='mysql')\
+                           .prefix_with('OR IGNORE', dialect='sqlite')
+    n_rows = 0
+    chunk = []
+    with gzip.open(path, 'rt', encoding='utf-8') as infile:
+        for line in infile:
+            record = json.loads(line)
+            row = {}
+            for col, decode in decoders.items():
+                value = record.get(col)
+                row[col] = decode(value) if decode and value is not None else value
+            chunk.append(row)
+            if len(chunk) >= batch_size:
+                with conn.begin():
+                    conn.execute(insert, chunk)
+                n_rows += len(chunk)
+                chunk = []
+    if chunk:
+        with conn.begin():
+            conn.execute(insert, chunk)
+        n_rows += len(chunk)
+    return n_rows
+
+def restore(backup_dir, until=None, batch_size=1000):
+    """Replay a chain of segments into the database
+
+    The database must be at the migration revision of the segments, e.g.
+    created with `flask db upgrade <revision>`. Each segment replaces the
+    rows of the id ranges it holds, so later copies of a row win and an
+    interrupted restore can be rerun.
+
+    Arguments:
+        backup_dir {str} -- Directory holding the segments
+
+    Keyword Arguments:
+        until {str} -- Restore up to the segment created at this stamp
+                       (default: the latest)
+        batch_size {int} -- Rows per INSERT
+    """
+    segments = load_segments(backup_dir)
+    if until:
+        segments = [s for s in segments if s['created'] <= until]
+    if not segments:
+        sys.exit('No complete backup segments found.')
+    chain = chains(segments)[-1]
+
+    for segment in chain:
+        # The archive files of the last segment cover those of the others
+        bad = verify(segment, archive=segment is chain[-1])
+        if bad:
+            sys.exit(f'Checksum mismatch, not restoring: {", ".join(bad)}')
+
+    conn = db.engine.connect()
+    try:
+        revision = migration_revision(conn)
+        if revision != chain[0]['revision']:
+            sys.exit(f'Database is at revision {revision}, the backup at '
+                     f'{chain[0]["revision"]}. Run `flask db upgrade '
+                     f'{chain[0]["revision"]}` on an empty database first.')
+
+        tables = backup_tables()
+        archived = {name: info['like'] for segment in chain
+                    for name, info in segment['tables'].items() if 'like' in info}
+        for name, like in sorted(archived.items()):
+            table = archive_table(name, db.metadata.tables[like])
+            table.create(conn, checkfirst=True)
+            tables.append(table)
+
+        for table in tables:
+            # Tables rewritten in place only need their last dump
+            replay = chain[-1:] if table.name in FULL_TABLES else chain
+            for segment in replay:
+                info = segment['tables'].get(table.name)
+                if info is None:
+                    continue
+                path = os.path.join(segment['path'], info['file'])
+                ranges = info.get('ranges', [[info['start'], info['end']]])
+                n_rows = restore_table(conn, table, path, ranges, batch_size)
+                print(f'{table.name}: {n_rows} rows from {segment["created"]}',
+                      flush=True)
+    finally:
+        conn.close()
+    restore_archive(backup_dir, chain[-1].get('html_archive', {}),
+                    app.config['HTML_ARCHIVE_DIR'])
+    print(f'Restored {len(chain)} segments up to {chain[-1]["created"]}.')
+
+
+parser = argparse.ArgumentParser(description=__doc__,
+                                 formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('command', choices=['backup', 'verify', 'restore'])
+parser.add_argument('--dir', required=True, help='backup directory')
+parser.add_argument('--full', action='store_true',
+                    help='backup: start a new chain with a full segment')
+parser.add_argument('--keep', type=int, default=0,
+                    help='backup: number of chains to keep (default: all)')
+parser.add_argument('--until', help='restore: last segment stamp to replay')
+parser.add_argument('--batch-size', type=int, default=5000,
+                    help='rows per query')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    with app.app_context():
+        if args.command == 'backup':
+            backup(args.dir, full=args.full, batch_size=args.batch_size)
+            if args.keep:
+                prune(args.dir, args.keep)
+        elif args.command == 'verify':
+            segments = load_segments(args.dir)
+            bad = [path for segment in segments
+                   for path in verify(segment, archive=segment is segments[-1])]
+            print('\n'.join(bad) if bad else 'All segments verified.')
+            sys.exit(1 if bad else 0)
+        else:
+            restore(args.dir, until=args.until, batch_size=args.batch_size)
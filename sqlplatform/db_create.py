@@ -2,6 +2,7 @@
 """
 import os
 import shutil
+from flask_migrate import stamp
 from sqlplatform import app, db
 
 basedir = os.path.abspath(os.path.dirname(__file__))
@@ -11,6 +12,9 @@ with app.app_context():
     db.init_app(app)
     db.create_all()
 
+    # Mark the new tables as up to date with the migrations
+    stamp()
+
 if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite:'):
     shutil.move('app/test.db', 'test.db')
 
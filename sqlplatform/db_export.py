@@ -0,0 +1,385 @@
+""" Export the SQL database to Parquet files
+
+Each table is read in primary key order with a server-side cursor, one batch
+at a time, and written to `<out>/<table>/date=<YYYY-MM-DD>/part-<first>-<last>.parquet`.
+The last exported id of each table is kept in `<out>/_watermarks.json`, so
+every run only exports rows added since the previous one.
+
+Ids are handed out when a row is inserted, not when it is committed, so a row
+of a long transaction can show up after rows with higher ids. Each run records
+the last ids of the tables, and exports up to those recorded by the latest run
+at least --margin minutes before (TRANSACTION_MARGIN by default), when every
+row with a lower id had been committed. A first run only records them, pass
+--margin 0 to export everything while the app is stopped.
+
+Rows updated in place by the jobs of db_jobs.py, db_features.py and
+db_partitions.py are recorded by id range in row_change (see app/changes.py).
+The ranges recorded since the last run are exported again, to files named
+`part-<first>-<last>-<YYYYmmddTHHMMSS>.parquet` after the time of the run;
+readers keep the copy of a row from the latest file. The user table, updated
+by /save_user, is exported whole every run and replaces the previous export.
+
+Interned urls are exported as text in `url`, next to their `url_id`.
+The payloads of the generic data table are exported as JSON text in `data`.
+
+HTML is written inline (`--html include`), left out (`--html exclude`) or
+written to `<out>/<table>_html/` with the row id (`--html separate`).
+
+    python db_export.py --out /media/data/export
+    python db_export.py --out /media/data/export --margin 0
+    python db_export.py --out /media/data/export --tables snapshots --html separate
+"""
+import argparse
+import json
+import os
+import shutil
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import sqlalchemy as sa
+
+from sqlplatform import app, db
+from app.blobs import blob_text, decompress, decode_data
+from app.changes import TRANSACTION_MARGIN
+from app.models import (
+    User, UserReinstall, Data, BrowserHistory, WebsiteHistory, Snapshots,
+    Activity, HtmlBlob, Url, RowChange
+)
+
+# Exported models and the column each is partitioned by
+MODELS = {
+    'user': (User, 'install_time'),
+    'user_reinstall': (UserReinstall, 'install_time'),
+    'data': (Data, 'timestamp'),
+    'browser_history': (BrowserHistory, 'timestamp'),
+    'website_history': (WebsiteHistory, 'timestamp'),
+    'snapshots': (Snapshots, 'timestamp'),
+    'activity': (Activity, 'timestamp'),
+}
+HTML_TABLES = ('website_history', 'snapshots', 'activity')
+# Tables updated in place by the application, exported whole every run
+FULL_TABLES = ('user',)
+WATERMARKS = '_watermarks.json'
+# Keys of the watermarks file: the last ids of the tables recorded by each
+# run, and the last row_change id exported again by table
+SEEN = '_seen'
+CHANGES = '_row_change'
+STAMP_FORMAT = '%Y%m%dT%H%M%S'
+
+
+def arrow_type(column):
+    """Arrow type for a SQLAlchemy column"""
+    sql_type = column.type
+    # Unwrap variants, e.g. the DATETIME(3) timestamps on MySQL
+    sql_type = getattr(sql_type, 'impl', sql_type)
+    if isinstance(sql_type, (sa.Integer, sa.BigInteger)):
+        return pa.int64()
+    if isinstance(sql_type, sa.Boolean):
+        return pa.bool_()
+    if isinstance(sql_type, sa.DateTime):
+        return pa.timestamp('ms')
+    if isinstance(sql_type, sa.LargeBinary):
+        return pa.binary()
+    return pa.string()
+
+def arrow_schema(columns):
+    return pa.schema([pa.field(col.name, arrow_type(col)) for col in columns])
+
+def load_watermarks(out_dir):
+    path = os.path.join(out_dir, WATERMARKS)
+    if os.path.exists(path):
+        with open(path, 'r') as infile:
+            return json.load(infile)
+    return {}
+
+def save_watermarks(out_dir, watermarks):
+    path = os.path.join(out_dir, WATERMARKS)
+    with open(path + '.tmp', 'w') as outfile:
+        json.dump(watermarks, outfile, indent=2)
+    os.replace(path + '.tmp', path)
+
+def max_id(table):
+    pk = list(table.primary_key.columns)[0]
+    return db.session.execute(sa.select([sa.func.max(pk)])).scalar() or 0
+
+def settled_ends(watermarks, stamp, margin):
+    """Record the last ids of the tables, and get those recorded margin before
+
+    The rows with ids up to them had all been committed by now.
+
+    Arguments:
+        watermarks {dict} -- The watermarks, with the ids recorded by each run
+        stamp {str} -- Time of this run
+        margin {timedelta} -- Longest a transaction inserting rows stays open
+
+    Returns:
+        dict -- The last ids by table name, None if no run was that long ago
+    """
+    tables = [model.__table__ for model, _ in MODELS.values()]
+    ends = {table.name: max_id(table) for table in tables + [RowChange.__table__]}
+    db.session.close()
+    seen = watermarks.setdefault(SEEN, [])
+    seen.append({'created': stamp, 'ends': ends})
+
+    before = datetime.strptime(stamp, STAMP_FORMAT) - margin
+    settled = [i for i, run in enumerate(seen)
+               if datetime.strptime(run['created'], STAMP_FORMAT) <= before]
+    if not settled:
+        return None
+    # Older runs are no longer needed
+    del seen[:settled[-1]]
+    return seen[0]['ends']
+
+def changed_ranges(table, start, end):
+    """Id ranges of a table recorded in row_change with start < id <= end
+
+    Returns:
+        list -- [start, end] ranges with start < id <= end
+    """
+    t = RowChange.__table__
+    query = sa.select([t.c.id_start, t.c.id_end])\
+              .where(t.c.table_name == table)\
+              .where(t.c.id > start).where(t.c.id <= end)
+    ranges = [[row.id_start - 1, row.id_end - 1]
+              for row in db.session.execute(query)]
+    db.session.close()
+    return ranges
+
+def merge_ranges(ranges):
+    """Sorted, non-overlapping ranges covering the given ones"""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+def fetch_html(rows):
+    """Decompressed HTML of a batch of rows, keyed by row id"""
+    hashes = {row['html_hash'] for row in rows if row['html_hash']}
+    blobs = {}
+    if hashes:
+        query = sa.select([HtmlBlob.hash, HtmlBlob.codec, HtmlBlob.data,
+                           HtmlBlob.archive_segment, HtmlBlob.archive_offset,
+                           HtmlBlob.archive_length])\
+                  .where(HtmlBlob.hash.in_(hashes))
+        for blob_hash, *stored in db.session.execute(query):
+            blobs[blob_hash] = blob_text(*stored)
+    return {row['id']: blobs.get(row['html_hash'], row['html']) for row in rows}
+
+def fill_urls(rows):
+    """Set the url of a batch of rows from their url id"""
+    ids = {row['url_id'] for row in rows if row['url_id'] is not None}
+    if not ids:
+        return
+    query = sa.select([Url.id, Url.url]).where(Url.id.in_(ids))
+    url_by_id = dict(db.session.execute(query).fetchall())
+    for row in rows:
+        if row['url_id'] is not None:
+            row['url'] = url_by_id.get(row['url_id'])
+
+def data_json(row):
+    """JSON text of a data row's payload"""
+    if row['codec'] is not None:
+        return decompress(row['payload'], row['codec']).decode('utf-8')
+    value = decode_data(row['data'], None, None)
+    # Rows without a payload keep their data as is
+    return row['data'] if value == row['data'] else json.dumps(value)
+
+def write_partitions(out_dir, table, schema, rows, partition_column, pk,
+                     suffix=''):
+    """Write a batch of rows, one file per day, suffix ending their names"""
+    by_day = defaultdict(list)
+    for row in rows:
+        stamp = row[partition_column]
+        by_day[stamp.strftime('%Y-%m-%d') if stamp else 'unknown'].append(row)
+
+    for day, day_rows in sorted(by_day.items()):
+        part_dir = os.path.join(out_dir, table, f'date={day}')
+        os.makedirs(part_dir, exist_ok=True)
+        name = f'part-{day_rows[0][pk]:012d}-{day_rows[-1][pk]:012d}{suffix}.parquet'
+        columns = {}
+        for field in schema:
+            values = [row[field.name] for row in day_rows]
+            if field.type == pa.bool_():
+                # MySQL returns booleans as 0/1
+                values = [None if v is None else bool(v) for v in values]
+            columns[field.name] = values
+        pq.write_table(pa.Table.from_pydict(columns, schema=schema),
+                       os.path.join(part_dir, name), compression='zstd')
+
+def export_rows(out_dir, table, start, end, batch_size, html, suffix=''):
+    """Export the rows of a table with start < id <= end, end None for all
+
+    Yields:
+        tuple -- The number of rows and last id of each batch written
+    """
+    model, partition_column = MODELS[table]
+    pk = model.__table__.primary_key.columns.values()[0]
+    columns = list(model.__table__.columns)
+    has_html = table in HTML_TABLES
+    if has_html:
+        columns = [col for col in columns if col.name not in ('html', 'html_hash')]
+    if model is Data:
+        columns = [col for col in columns if col.name not in ('payload', 'codec')]
+    schema = arrow_schema(columns)
+    if has_html and html == 'include':
+        schema = schema.append(pa.field('html', pa.string()))
+    html_schema = pa.schema([pa.field('id', pa.int64()),
+                             pa.field(partition_column, pa.timestamp('ms')),
+                             pa.field('html', pa.string())])
+
+    # Only read the html columns when they are exported
+    select_columns = list(model.__table__.columns)
+    if has_html and html == 'exclude':
+        select_columns = [col for col in select_columns
+                          if col.name not in ('html', 'html_hash')]
+
+    last_id = start
+    while True:
+        query = sa.select(select_columns)\
+                  .where(pk > last_id).order_by(pk).limit(batch_size)
+        if end is not None:
+            query = query.where(pk <= end)
+        # A connection of its own, so every batch of every table is streamed
+        # rather than only the first that opened the session's connection
+        rows = []
+        with db.engine.connect() as conn:
+            result = conn.execution_options(stream_results=True).execute(query)
+            while True:
+                chunk = result.fetchmany(1000)
+                if not chunk:
+                    break
+                rows.extend(dict(row) for row in chunk)
+        if not rows:
+            break
+
+        if 'url_id' in model.__table__.columns:
+            fill_urls(rows)
+        if model is Data:
+            for row in rows:
+                row['data'] = data_json(row)
+
+        if has_html and html != 'exclude':
+            html_by_id = fetch_html(rows)
+            if html == 'include':
+                for row in rows:
+                    row['html'] = html_by_id[row['id']]
+            else:
+                html_rows = [dict(id=row['id'], html=html_by_id[row['id']],
+                                  **{partition_column: row[partition_column]})
+                             for row in rows]
+                write_partitions(out_dir, f'{table}_html', html_schema,
+                                 html_rows, partition_column, 'id', suffix)
+
+        write_partitions(out_dir, table, schema, rows, partition_column, pk.name,
+                         suffix)
+        last_id = rows[-1][pk.name]
+        db.session.close()
+        yield len(rows), last_id
+
+def export_table(out_dir, table, watermarks, batch_size, html, end,
+                 changes=(), stamp=None):
+    """Export the rows of a table added since its watermark, up to end, and
+    again those of the changed ranges at or below the watermark
+
+    Arguments:
+        end {int} -- Last id to export, None for every row
+        changes {list} -- [start, end] ranges of ids changed in place
+        stamp {str} -- Time of the run, ending the names of the files of
+                       changed rows
+
+    Returns:
+        int -- The number of rows exported
+    """
+    n_rows = 0
+    if table in FULL_TABLES:
+        # Written aside and swapped in, so an export is always complete
+        tmp_dir = os.path.join(out_dir, '.tmp')
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        for n, _ in export_rows(tmp_dir, table, 0, None, batch_size, html):
+            n_rows += n
+        shutil.rmtree(os.path.join(out_dir, table), ignore_errors=True)
+        if n_rows:
+            os.rename(os.path.join(tmp_dir, table), os.path.join(out_dir, table))
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        print(f'{table}: {n_rows} rows, whole table', flush=True)
+        return n_rows
+
+    last_id = watermarks.get(table, 0)
+    pk = MODELS[table][0].__table__.primary_key.columns.values()[0]
+    for n, last_id in export_rows(out_dir, table, last_id, end, batch_size, html):
+        watermarks[table] = last_id
+        save_watermarks(out_dir, watermarks)
+        n_rows += n
+        print(f'{table}: {n_rows} rows, up to {pk.name} {last_id}', flush=True)
+
+    # Rows above the watermark are exported as they are now on a later run
+    n_changed = 0
+    for start, change_end in changes:
+        change_end = min(change_end, last_id)
+        if start < change_end:
+            for n, _ in export_rows(out_dir, table, start, change_end,
+                                    batch_size, html, suffix=f'-{stamp}'):
+                n_changed += n
+    if changes:
+        print(f'{table}: {n_changed} changed rows exported again', flush=True)
+    return n_rows + n_changed
+
+def export(out_dir, tables, batch_size, html, margin=TRANSACTION_MARGIN):
+    """Export the rows of tables added or changed since the last run
+
+    Returns:
+        int -- The number of rows exported
+    """
+    watermarks = load_watermarks(out_dir)
+    stamp = datetime.utcnow().strftime(STAMP_FORMAT)
+    ends = settled_ends(watermarks, stamp, margin)
+    save_watermarks(out_dir, watermarks)
+    if ends is None:
+        print(f'Last ids recorded, rows are exported from a run at least '
+              f'{margin} after this one', flush=True)
+        ends = {}
+
+    n_rows = 0
+    last_changes = watermarks.setdefault(CHANGES, {})
+    for table in tables:
+        if table in FULL_TABLES:
+            n_rows += export_table(out_dir, table, watermarks, batch_size, html,
+                                   None)
+        elif table in ends:
+            # Changes recorded since the last run, of rows exported before
+            change_end = ends[RowChange.__tablename__]
+            changes = merge_ranges(changed_ranges(
+                table, last_changes.get(table, 0), change_end))
+            n_rows += export_table(out_dir, table, watermarks, batch_size,
+                                   html, ends[table], changes, stamp)
+            last_changes[table] = change_end
+            save_watermarks(out_dir, watermarks)
+    return n_rows
+
+
+parser = argparse.ArgumentParser(description=__doc__,
+                                 formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('--out', required=True, help='output directory')
+parser.add_argument('--tables', nargs='+', choices=list(MODELS),
+                    default=list(MODELS), help='tables to export (default: all)')
+parser.add_argument('--html', choices=['include', 'exclude', 'separate'],
+                    default='exclude', help='where HTML goes (default: exclude)')
+parser.add_argument('--batch-size', type=int, default=10000,
+                    help='rows per batch and file, lower it for HTML tables')
+parser.add_argument('--margin', type=float,
+                    default=TRANSACTION_MARGIN.total_seconds() / 60,
+                    help='minutes after which inserted rows are committed, 0 '
+                         'when the app is stopped (default: %(default)s)')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    os.makedirs(args.out, exist_ok=True)
+    with app.app_context():
+        export(args.out, args.tables, args.batch_size, args.html,
+               timedelta(minutes=args.margin))
+    print("Export done.")
@@ -0,0 +1,253 @@
+""" Parse the stored pages once into the extracted_page and extracted_item tables
+
+Rows of snapshots, activity and website_history are read in id order after
+the watermark of their table, parsed in a pool of processes (see
+app/features.py), and saved together with the new watermark in one
+transaction. A rerun only parses the rows that arrived since, and an
+interrupted run loses at most the batches in flight.
+
+Ids are handed out when a row is inserted, so a row of a long transaction can
+be committed after the watermark passed its id. Each run first parses the
+rows without features among the last --overlap ids below the watermark. Their
+pages are inserted with INSERT IGNORE on ux_extracted_page_source, and their
+items only with the pages actually inserted.
+
+The next batch is read from the database while the pool parses the last one.
+
+    python db_features.py                          # hourly from cron
+    python db_features.py --sources activity --workers 8
+    python db_features.py --rebuild --sources snapshots   # after EXTRACTOR_VERSION changed
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime
+from multiprocessing import Pool
+
+import sqlalchemy as sa
+
+from sqlplatform import app, db
+from app.archive import read_archived
+from app.changes import record_change
+from app.features import EXTRACTOR_VERSION, extract_page
+from app.models import (
+    HtmlBlob, Url, ExtractedPage, ExtractedItem, ExtractWatermark,
+    WebsiteHistory, Snapshots, Activity
+)
+
+SOURCES = {
+    'snapshots': Snapshots,
+    'activity': Activity,
+    'website_history': WebsiteHistory,
+}
+
+# Columns of activity expanded into items
+JSON_COLUMNS = ('links', 'tweet_ids', 'youtube_iframes')
+
+
+def get_watermark(conn, source):
+    """The last id of a table parsed so far, creating its watermark row"""
+    t = ExtractWatermark.__table__
+    conn.execute(t.insert().prefix_with('IGNORE', dialect='mysql')
+                           .prefix_with('OR IGNORE', dialect='sqlite'),
+                 source=source, last_id=0, version=EXTRACTOR_VERSION,
+                 updated=datetime.utcnow())
+    row = conn.execute(sa.select([t.c.last_id, t.c.version])
+                         .where(t.c.source == source)).first()
+    if row.version != EXTRACTOR_VERSION and row.last_id:
+        print(f'{source}: parsed up to id {row.last_id} by extractor version '
+              f'{row.version}, now {EXTRACTOR_VERSION}. New rows get the new '
+              f'version, --rebuild to parse the old ones again.')
+    return row.last_id
+
+def select_rows(source):
+    """Rows of a table with their blob and url, in id order"""
+    t = SOURCES[source].__table__
+    b = HtmlBlob.__table__
+    u = Url.__table__
+    columns = [t.c.id, t.c.user_id, t.c.timestamp, t.c.url_id,
+               sa.func.coalesce(u.c.url, t.c.url).label('url'), t.c.html,
+               b.c.codec, b.c.data, b.c.archive_segment, b.c.archive_offset,
+               b.c.archive_length]
+    if source == 'activity':
+        columns += [t.c[name] for name in JSON_COLUMNS]
+    joins = t.outerjoin(b, t.c.html_hash == b.c.hash)\
+             .outerjoin(u, t.c.url_id == u.c.id)
+    return sa.select(columns).select_from(joins).order_by(t.c.id), t, joins
+
+def read_batch(conn, source, last, batch_size):
+    """The next rows of a table after an id, with their blob and url"""
+    select, t, joins = select_rows(source)
+    return conn.execute(select.where(t.c.id > last).limit(batch_size)).fetchall()
+
+def read_missed(conn, source, last, overlap):
+    """Rows of a table among the overlap ids up to the watermark that have no
+    features"""
+    select, t, joins = select_rows(source)
+    p = ExtractedPage.__table__
+    joins = joins.outerjoin(p, sa.and_(p.c.source == source,
+                                       p.c.source_id == t.c.id))
+    select = select.select_from(joins).where(p.c.id.is_(None))\
+                   .where(t.c.id > last - overlap).where(t.c.id <= last)
+    return conn.execute(select).fetchall()
+
+def make_task(source, row):
+    """What a pool process needs to parse a row, see extract_page"""
+    data = row.data
+    if data is None and row.archive_segment is not None:
+        data = read_archived(row.archive_segment, row.archive_offset,
+                             row.archive_length)
+    task = dict(source=source, source_id=row.id, url=row.url, html=row.html,
+                codec=row.codec, data=data)
+    if source == 'activity':
+        task.update((name, row[name]) for name in JSON_COLUMNS)
+    return task
+
+def add_row_values(rows, results):
+    """The extracted pages, with the user, time and url of their rows, and
+    their items"""
+    for row, (page, page_items) in zip(rows, results):
+        page.update(user_id=row.user_id, timestamp=row.timestamp,
+                    url_id=row.url_id)
+        yield page, page_items
+
+def save_batch(conn, source, previous, rows, results):
+    """Insert the features of a batch and move the watermark past it
+
+    Returns:
+        tuple -- Pages and items inserted
+    """
+    pages, items = [], []
+    for page, page_items in add_row_values(rows, results):
+        pages.append(page)
+        items.extend(page_items)
+
+    w = ExtractWatermark.__table__
+    with conn.begin() as transaction:
+        # Another run that got here first leaves the watermark elsewhere
+        moved = conn.execute(
+            w.update().where(w.c.source == source)
+                      .where(w.c.last_id == previous)
+                      .values(last_id=rows[-1].id, version=EXTRACTOR_VERSION,
+                              updated=datetime.utcnow()))
+        if moved.rowcount != 1:
+            transaction.rollback()
+            sys.exit(f'{source}: the watermark moved, is another '
+                     f'db_features.py running?')
+        conn.execute(ExtractedPage.__table__.insert(), pages)
+        if items:
+            conn.execute(ExtractedItem.__table__.insert(), items)
+    return len(pages), len(items)
+
+def save_missed(conn, rows, results):
+    """Insert the features of rows below the watermark that have none yet
+
+    Returns:
+        tuple -- Pages and items inserted
+    """
+    insert = ExtractedPage.__table__.insert()\
+                .prefix_with('IGNORE', dialect='mysql')\
+                .prefix_with('OR IGNORE', dialect='sqlite')
+    n_pages = n_items = 0
+    with conn.begin():
+        for page, items in add_row_values(rows, results):
+            # Another run may have parsed the row since, keep its items
+            if not conn.execute(insert, page).rowcount:
+                continue
+            n_pages += 1
+            if items:
+                conn.execute(ExtractedItem.__table__.insert(), items)
+                n_items += len(items)
+    return n_pages, n_items
+
+def extract_missed(conn, pool, source, last, overlap):
+    """Parse the rows committed late below the watermark of a table"""
+    rows = read_missed(conn, source, last, overlap)
+    if not rows:
+        return
+    results = pool.map(extract_page, [make_task(source, row) for row in rows],
+                       chunksize=4)
+    pages, items = save_missed(conn, rows, results)
+    print(f'{source}: {pages} pages, {items} items of rows committed after '
+          f'the watermark passed them', flush=True)
+
+def extract(conn, pool, source, batch_size, overlap):
+    """Parse the rows of a table after its watermark"""
+    last = get_watermark(conn, source)
+    if overlap:
+        extract_missed(conn, pool, source, last, overlap)
+    start = time.monotonic()
+    n_pages = n_items = 0
+    pending = None
+    while True:
+        rows = read_batch(conn, source, last, batch_size)
+        result = None
+        if rows:
+            tasks = [make_task(source, row) for row in rows]
+            result = pool.map_async(extract_page, tasks, chunksize=4)
+
+        if pending is not None:
+            previous, pending_rows, pending_result = pending
+            pages, items = save_batch(conn, source, previous, pending_rows,
+                                      pending_result.get())
+            n_pages += pages
+            n_items += items
+            rate = n_pages / (time.monotonic() - start)
+            print(f'{source}: {n_pages} pages, {n_items} items, up to id '
+                  f'{pending_rows[-1].id} ({rate:.1f} pages/s)', flush=True)
+
+        if not rows:
+            break
+        pending = (last, rows, result)
+        last = rows[-1].id
+
+def rebuild(conn, source, chunk_size=1000):
+    """Delete the features of a table and reset its watermark"""
+    for model in (ExtractedItem, ExtractedPage):
+        t = model.__table__
+        select = sa.select([t.c.id]).where(t.c.source == source)\
+                   .order_by(t.c.id).limit(chunk_size)
+        while True:
+            ids = [row.id for row in conn.execute(select)]
+            if not ids:
+                break
+            with conn.begin():
+                conn.execute(t.delete().where(t.c.id.in_(ids)))
+                record_change(conn, t.name, ids[0], ids[-1] + 1)
+    w = ExtractWatermark.__table__
+    conn.execute(w.update().where(w.c.source == source)
+                  .values(last_id=0, version=EXTRACTOR_VERSION,
+                          updated=datetime.utcnow()))
+    print(f'{source}: features deleted, parsing from the start')
+
+
+parser = argparse.ArgumentParser(description=__doc__,
+                                 formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('--sources', type=lambda value: value.split(','),
+                    default=list(SOURCES),
+                    help=f'comma separated, among {", ".join(SOURCES)}')
+parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                    help='parsing processes (default: one per CPU)')
+parser.add_argument('--batch-size', type=int, default=200,
+                    help='rows per batch and transaction')
+parser.add_argument('--overlap', type=int, default=10000,
+                    help='ids below the watermark checked for rows committed late')
+parser.add_argument('--rebuild', action='store_true',
+                    help='delete the features of the sources and parse them again')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if not set(args.sources) <= set(SOURCES):
+        parser.error(f'--sources must be among {", ".join(SOURCES)}')
+    with app.app_context():
+        # Fork the pool before connecting, the processes don't use the database
+        with Pool(args.workers) as pool:
+            conn = db.engine.connect()
+            try:
+                for source in args.sources:
+                    if args.rebuild:
+                        rebuild(conn, source)
+                    extract(conn, pool, source, args.batch_size, args.overlap)
+            finally:
+                conn.close()
@@ -0,0 +1,307 @@
+""" Background data migrations
+
+Long running conversions of existing rows that run next to the application
+after a schema migration added the columns they fill. Rows are converted in
+primary key chunks, each committed on its own, and only rows that still need
+it are touched, so a job can be stopped and rerun at any time.
+
+    python db_jobs.py data-payloads --pause 0.1
+    python db_jobs.py url-ids --pause 0.1
+    python db_jobs.py html-archive --pause 0.1
+    python db_jobs.py request-keys
+"""
+import argparse
+import base64
+import json
+import time
+from datetime import datetime, timedelta
+
+import sqlalchemy as sa
+
+from sqlplatform import app, db
+from app import urls
+from app.archive import SegmentWriter, read_archived
+from app.blobs import compress, decompress, hash_html
+from app.changes import record_change
+from app.models import (
+    Data, Url, HtmlBlob, RequestKey, BrowserHistory, WebsiteHistory, Snapshots,
+    Activity
+)
+
+
+def data_payloads(conn, chunk_size, pause, revert=False):
+    """Move base64 JSON in data.data to compressed data.payload
+
+    Rows whose data is not base64 JSON, e.g. 'error: no data received', are
+    left as they are.
+
+    Keyword Arguments:
+        revert {bool} -- Convert compressed rows back to base64, needed before
+                         downgrading revision af0013a0c1bc
+    """
+    t = Data.__table__
+    codec = app.config['DATA_CODEC']
+    todo = t.c.codec.isnot(None) if revert else \
+           sa.and_(t.c.codec.is_(None), t.c.data.isnot(None))
+    select = sa.select([t.c.id, t.c.data, t.c.payload, t.c.codec])\
+               .where(t.c.id > sa.bindparam('last')).where(todo)\
+               .order_by(t.c.id).limit(chunk_size)
+    update = t.update().where(t.c.id == sa.bindparam('_id'))\
+                       .values(data=sa.bindparam('_data'),
+                               payload=sa.bindparam('_payload'),
+                               codec=sa.bindparam('_codec'))
+
+    last, n_rows, n_converted = 0, 0, 0
+    while True:
+        rows = conn.execute(select, last=last).fetchall()
+        if not rows:
+            break
+        values = []
+        for row in rows:
+            if revert:
+                raw = decompress(row.payload, row.codec)
+                values.append(dict(_id=row.id, _payload=None, _codec=None,
+                                   _data=base64.urlsafe_b64encode(raw).decode('ascii')))
+                continue
+            try:
+                raw = base64.urlsafe_b64decode(row.data)
+                json.loads(raw.decode('utf-8'))
+            except ValueError:
+                continue
+            values.append(dict(_id=row.id, _data=None, _codec=codec,
+                               _payload=compress(raw, codec)))
+        if values:
+            with conn.begin():
+                conn.execute(update, values)
+                record_change(conn, t.name, values[0]['_id'], values[-1]['_id'] + 1)
+        last = rows[-1].id
+        n_rows += len(rows)
+        n_converted += len(values)
+        print(f'data: {n_converted} of {n_rows} rows converted, up to id {last}',
+              flush=True)
+        time.sleep(pause)
+
+def url_ids(conn, chunk_size, pause, revert=False):
+    """Move the url text of history rows to the url table
+
+    Keyword Arguments:
+        revert {bool} -- Copy the url text back to the rows, needed before
+                         downgrading revision 13090643364b
+    """
+    for model in (BrowserHistory, WebsiteHistory, Snapshots, Activity):
+        t = model.__table__
+        pk = list(t.primary_key.columns)[0]
+        if revert:
+            select = sa.select([pk, Url.url]).select_from(
+                         t.join(Url.__table__, t.c.url_id == Url.id))
+        else:
+            select = sa.select([pk, t.c.url])\
+                       .where(t.c.url_id.is_(None)).where(t.c.url.isnot(None))
+        select = select.where(pk > sa.bindparam('last'))\
+                       .order_by(pk).limit(chunk_size)
+        update = t.update().where(pk == sa.bindparam('_pk'))\
+                           .values(url=sa.bindparam('_url'),
+                                   url_id=sa.bindparam('_url_id'))
+
+        last, n_rows = 0, 0
+        while True:
+            rows = conn.execute(select, last=last).fetchall()
+            if not rows:
+                break
+            if revert:
+                values = [dict(_pk=row[0], _url=row[1], _url_id=None)
+                          for row in rows]
+            else:
+                ids = urls.intern_urls([row[1] for row in rows], conn)
+                values = [dict(_pk=row[0], _url=None, _url_id=ids[row[1]])
+                          for row in rows]
+            with conn.begin():
+                conn.execute(update, values)
+                record_change(conn, t.name, rows[0][0], rows[-1][0] + 1)
+            if not revert:
+                urls.remember_url_ids(ids)
+            last = rows[-1][0]
+            n_rows += len(rows)
+            print(f'{t.name}: {n_rows} rows converted, up to {pk.name} {last}',
+                  flush=True)
+            time.sleep(pause)
+
+def archive_inline_html(conn, writer, cutoff, chunk_size, pause):
+    """Archive the inline html of rows saved before the blob store"""
+    codec = app.config['HTML_BLOB_CODEC']
+    insert = HtmlBlob.__table__.insert()\
+                .prefix_with('IGNORE', dialect='mysql')\
+                .prefix_with('OR IGNORE', dialect='sqlite')
+    for model in (WebsiteHistory, Snapshots, Activity):
+        t = model.__table__
+        select = sa.select([t.c.id, t.c.html, t.c.timestamp])\
+                   .where(t.c.id > sa.bindparam('last'))\
+                   .where(t.c.html.isnot(None)).where(t.c.timestamp < cutoff)\
+                   .order_by(t.c.id).limit(chunk_size)
+        update = t.update().where(t.c.id == sa.bindparam('_id'))\
+                           .values(html=None, html_hash=sa.bindparam('_hash'))
+
+        last, n_rows = 0, 0
+        while True:
+            rows = conn.execute(select, last=last).fetchall()
+            if not rows:
+                break
+            new_blobs, values = {}, []
+            for row in rows:
+                blob_hash = hash_html(row.html)
+                values.append(dict(_id=row.id, _hash=blob_hash))
+                if blob_hash in new_blobs:
+                    continue
+                raw = row.html.encode('utf-8')
+                segment, offset, length = writer.append(
+                    blob_hash, compress(raw, codec))
+                new_blobs[blob_hash] = dict(
+                    hash=blob_hash, codec=codec, size=len(raw), data=None,
+                    created=row.timestamp, archive_segment=segment,
+                    archive_offset=offset, archive_length=length)
+            writer.sync()
+            with conn.begin():
+                conn.execute(insert, list(new_blobs.values()))
+                conn.execute(update, values)
+                record_change(conn, t.name, rows[0].id, rows[-1].id + 1)
+            last = rows[-1].id
+            n_rows += len(rows)
+            print(f'{t.name}: {n_rows} inline html archived, up to id {last}',
+                  flush=True)
+            time.sleep(pause)
+
+def html_archive(conn, chunk_size, pause, revert=False):
+    """Move the HTML of old blobs to segment files, see app/archive.py
+
+    Blobs created more than HTML_ARCHIVE_AGE_DAYS ago, and the inline html
+    of older rows saved before the blob store, are appended to the segments.
+    The segments are fsynced before the rows point at them and drop their
+    data, so an interrupted job loses nothing and appends again when rerun.
+
+    Keyword Arguments:
+        revert {bool} -- Copy archived data back to html_blob, needed before
+                         downgrading revision 5b8f0d2e7a41. Segments are left
+                         in place.
+    """
+    t = HtmlBlob.__table__
+    update = t.update().where(t.c.id == sa.bindparam('_id'))\
+                       .values(data=sa.bindparam('_data'),
+                               archive_segment=sa.bindparam('_segment'),
+                               archive_offset=sa.bindparam('_offset'),
+                               archive_length=sa.bindparam('_length'))
+
+    if revert:
+        select = sa.select([t.c.id, t.c.archive_segment, t.c.archive_offset,
+                            t.c.archive_length])\
+                   .where(t.c.id > sa.bindparam('last'))\
+                   .where(t.c.archive_segment.isnot(None))\
+                   .order_by(t.c.id).limit(chunk_size)
+        last, n_rows = 0, 0
+        while True:
+            rows = conn.execute(select, last=last).fetchall()
+            if not rows:
+                break
+            values = [dict(_id=row.id, _data=read_archived(*row[1:]),
+                           _segment=None, _offset=None, _length=None)
+                      for row in rows]
+            with conn.begin():
+                conn.execute(update, values)
+                record_change(conn, t.name, rows[0].id, rows[-1].id + 1)
+            last = rows[-1].id
+            n_rows += len(rows)
+            print(f'html_blob: {n_rows} blobs restored, up to id {last}',
+                  flush=True)
+            time.sleep(pause)
+        return
+
+    cutoff = datetime.utcnow() - timedelta(days=app.config['HTML_ARCHIVE_AGE_DAYS'])
+    writer = SegmentWriter(app.config['HTML_ARCHIVE_DIR'],
+                           app.config['HTML_ARCHIVE_SEGMENT_SIZE'])
+    try:
+        archive_inline_html(conn, writer, cutoff, chunk_size, pause)
+
+        # Stop at the last old blob rather than scanning the recent ones
+        bound = conn.execute(sa.select([sa.func.max(t.c.id)])
+                               .where(t.c.created < cutoff)).scalar() or 0
+        select = sa.select([t.c.id, t.c.hash, t.c.data])\
+                   .where(t.c.id > sa.bindparam('last')).where(t.c.id <= bound)\
+                   .where(t.c.created < cutoff).where(t.c.data.isnot(None))\
+                   .order_by(t.c.id).limit(chunk_size)
+        last, n_rows, n_bytes = 0, 0, 0
+        while True:
+            rows = conn.execute(select, last=last).fetchall()
+            if not rows:
+                break
+            values = []
+            for row in rows:
+                segment, offset, length = writer.append(row.hash, row.data)
+                values.append(dict(_id=row.id, _data=None, _segment=segment,
+                                   _offset=offset, _length=length))
+                n_bytes += length
+            writer.sync()
+            with conn.begin():
+                conn.execute(update, values)
+                record_change(conn, t.name, rows[0].id, rows[-1].id + 1)
+            last = rows[-1].id
+            n_rows += len(rows)
+            print(f'html_blob: {n_rows} blobs ({n_bytes / 2 ** 20:.1f} MiB) '
+                  f'archived, up to id {last}', flush=True)
+            time.sleep(pause)
+    finally:
+        writer.close()
+
+def request_keys(conn, chunk_size, pause, revert=False):
+    """Delete request keys older than REQUEST_KEY_DAYS
+
+    Retries come within minutes, old keys only take space. There is nothing
+    to revert.
+    """
+    if revert:
+        return
+    t = RequestKey.__table__
+    cutoff = datetime.utcnow() - timedelta(days=app.config['REQUEST_KEY_DAYS'])
+    bound = conn.execute(sa.select([sa.func.max(t.c.id)])
+                           .where(t.c.created < cutoff)).scalar() or 0
+    select = sa.select([t.c.id]).where(t.c.id <= bound)\
+               .order_by(t.c.id).limit(chunk_size)
+
+    n_rows = 0
+    while True:
+        ids = [row.id for row in conn.execute(select)]
+        if not ids:
+            break
+        with conn.begin():
+            conn.execute(t.delete().where(t.c.id.in_(ids)))
+            record_change(conn, t.name, ids[0], ids[-1] + 1)
+        n_rows += len(ids)
+        print(f'request_key: {n_rows} keys deleted, up to id {ids[-1]}',
+              flush=True)
+        time.sleep(pause)
+
+
+JOBS = {
+    'data-payloads': data_payloads,
+    'url-ids': url_ids,
+    'html-archive': html_archive,
+    'request-keys': request_keys,
+}
+
+parser = argparse.ArgumentParser(description=__doc__,
+                                 formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('job', choices=list(JOBS))
+parser.add_argument('--chunk-size', type=int, default=1000,
+                    help='rows per chunk and transaction')
+parser.add_argument('--pause', type=float, default=0,
+                    help='seconds to sleep between chunks to limit load')
+parser.add_argument('--revert', action='store_true',
+                    help='undo the job, before downgrading its revision')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    with app.app_context():
+        conn = db.engine.connect()
+        try:
+            JOBS[args.job](conn, args.chunk_size, args.pause, revert=args.revert)
+        finally:
+            conn.close()
+    print("Job done.")
@@ -0,0 +1,220 @@
+""" Monthly partitions of the large tables on MySQL
+
+activity and snapshots (PARTITION_TABLES) are partitioned by RANGE on their
+id, one partition per month of arrival, named p<YYYYMM>, and a catch-all
+pmax. The table_partition catalog records the id range and arrival period of
+each, which app/partitions.py uses to restrict time range queries to the
+partitions that can hold the rows.
+
+A month's partition reserves ids beyond those it is expected to use. At the
+start of the next month, `rollover` splits the new month's partition off the
+empty pmax and moves the auto-increment counter to its first id, so no rows
+are copied. If a month runs out of ids its rows overflow into pmax and the
+next rollover moves only those. The counter survives restarts from MySQL 8.0.
+
+An old study period is removed with `archive`, which swaps its partitions
+into tables of their own (activity_p202001, ...) and drops them from the
+table. Both are metadata changes that take a moment whatever the size. The
+archive tables can then be dumped and dropped, or dropped right away with
+--drop.
+
+    python db_partitions.py init --table activity   # rebuilds the table once
+    python db_partitions.py rollover                # daily from cron
+    python db_partitions.py archive --table activity --before 2020-06 [--drop]
+    python db_partitions.py list
+"""
+import argparse
+import sys
+from datetime import datetime
+
+from sqlplatform import app, db
+from app.models import RowChange, TablePartition
+from app.partitions import get_partitions
+
+# The id columns are INT
+MAX_ID = 2 ** 31 - 1
+
+
+def month_name(when):
+    return when.strftime('p%Y%m')
+
+def next_id(conn, table):
+    """The id the next inserted row gets at the least"""
+    return (conn.execute(f'SELECT MAX(id) FROM `{table}`').scalar() or 0) + 1
+
+def partition_names(conn, table):
+    query = 'SELECT partition_name FROM information_schema.partitions ' \
+            'WHERE table_schema = DATABASE() AND table_name = %s ' \
+            'AND partition_name IS NOT NULL ORDER BY partition_ordinal_position'
+    return [row[0] for row in conn.execute(query, (table,))]
+
+def headroom(used):
+    """Ids to reserve for a month, given the ids the last one used"""
+    return max(app.config['PARTITION_MIN_HEADROOM'], 2 * used)
+
+def check_id_end(table, id_end):
+    if id_end > MAX_ID:
+        sys.exit(f'{table}: reserving ids up to {id_end} exceeds the INT id '
+                 f'column, lower PARTITION_MIN_HEADROOM or widen the column.')
+
+
+def init(conn, table):
+    """Partition an existing table by month
+
+    The months before the current one are split where their first rows
+    start, judged by the timestamp column. Rebuilds the table, so run it
+    with INGEST_MODE = 'spool' and the drainer stopped.
+    """
+    if partition_names(conn, table):
+        sys.exit(f'{table} is already partitioned.')
+
+    current = month_name(datetime.utcnow())
+    query = f"SELECT DATE_FORMAT(`timestamp`, 'p%%Y%%m') AS name, MIN(id) " \
+            f"FROM `{table}` WHERE `timestamp` IS NOT NULL " \
+            f"GROUP BY name ORDER BY name"
+    months = []
+    for name, first_id in conn.execute(query):
+        # Months must start at increasing ids, late rows stay in the one before
+        if name <= current and (not months or first_id > months[-1][1]):
+            months.append((name, first_id))
+
+    first_id = next_id(conn, table)
+    if not months or months[-1][0] != current:
+        months.append((current, first_id))
+    # The first partition also holds the rows before it, e.g. without timestamp
+    months[0] = (months[0][0], 0)
+
+    # Reserve ids for the current month by the ids the last one used
+    used = months[-1][1] - months[-2][1] if len(months) > 1 else first_id
+    id_end = first_id + headroom(used)
+    check_id_end(table, id_end)
+
+    definitions, entries = [], []
+    for i, (name, start) in enumerate(months):
+        end = months[i + 1][1] if i + 1 < len(months) else id_end
+        definitions.append(f'PARTITION {name} VALUES LESS THAN ({end})')
+        entries.append(TablePartition(
+            table_name=table, name=name, id_start=start, id_end=end,
+            period_start=None if i == 0 else datetime.strptime(name, 'p%Y%m'),
+            period_end=datetime.strptime(months[i + 1][0], 'p%Y%m')
+                       if i + 1 < len(months) else None,
+            state='active'))
+    definitions.append('PARTITION pmax VALUES LESS THAN MAXVALUE')
+
+    print(f'{table}: partitioning into {len(months)} months, rebuilding...',
+          flush=True)
+    conn.execute(f'ALTER TABLE `{table}` PARTITION BY RANGE (id) '
+                 f'({", ".join(definitions)})')
+    db.session.add_all(entries)
+    db.session.commit()
+
+def rollover(conn, table):
+    """Start the partition of the current month, if it doesn't exist yet"""
+    partitions = [p for p in get_partitions(table) if p.period_end is None]
+    if not partitions:
+        print(f'{table}: not partitioned, see `db_partitions.py init`')
+        return
+    previous = partitions[-1]
+
+    now = datetime.utcnow()
+    name = month_name(now)
+    if previous.name >= name:
+        print(f'{table}: {previous.name} is current')
+        return
+
+    first_id = next_id(conn, table)
+    start = previous.id_end
+    id_end = max(first_id, start) + headroom(first_id - previous.id_start)
+    check_id_end(table, id_end)
+
+    conn.execute(f'ALTER TABLE `{table}` REORGANIZE PARTITION pmax INTO ('
+                 f'PARTITION {name} VALUES LESS THAN ({id_end}), '
+                 f'PARTITION pmax VALUES LESS THAN MAXVALUE)')
+    if first_id < start:
+        conn.execute(f'ALTER TABLE `{table}` AUTO_INCREMENT = {start}')
+
+    # Rows that overflowed the last month arrived in its period
+    period_start = now if first_id <= start else previous.period_start
+    previous.period_end = now
+    db.session.add(TablePartition(
+        table_name=table, name=name, id_start=start, id_end=id_end,
+        period_start=period_start, period_end=None, state='active'))
+    db.session.commit()
+    print(f'{table}: {name} started at id {start}, reserved up to {id_end}')
+
+def archive(conn, table, before, drop=False):
+    """Move the partitions of months before a date out of the table
+
+    Arguments:
+        table {str} -- Table name
+        before {datetime} -- Partitions of the months before are moved
+
+    Keyword Arguments:
+        drop {bool} -- Drop the archive tables too (default: {False})
+    """
+    for partition in get_partitions(table):
+        if partition.state != 'active' or partition.period_end is None or \
+           partition.name >= month_name(before):
+            continue
+
+        archive_table = f'{table}_{partition.name}'
+        conn.execute(f'CREATE TABLE `{archive_table}` LIKE `{table}`')
+        conn.execute(f'ALTER TABLE `{archive_table}` REMOVE PARTITIONING')
+        conn.execute(f'ALTER TABLE `{table}` EXCHANGE PARTITION {partition.name} '
+                     f'WITH TABLE `{archive_table}`')
+        conn.execute(f'ALTER TABLE `{table}` DROP PARTITION {partition.name}')
+        partition.state = 'archived'
+        partition.archive_table = archive_table
+        # The rows left the table, backups dump the range again, empty
+        db.session.add(RowChange(table_name=table, id_start=partition.id_start,
+                                 id_end=partition.id_end))
+        print(f'{table}: {partition.name} moved to {archive_table}')
+
+        if drop:
+            conn.execute(f'DROP TABLE `{archive_table}`')
+            partition.state = 'dropped'
+            print(f'{table}: dropped {archive_table}')
+        db.session.commit()
+
+def list_partitions(table):
+    for p in get_partitions(table):
+        period_end = p.period_end or 'now'
+        print(f'{table} {p.name:8} ids {p.id_start}-{p.id_end} '
+              f'arrived {p.period_start or "..."} to {period_end} '
+              f'{p.state} {p.archive_table or ""}')
+
+
+parser = argparse.ArgumentParser(description=__doc__,
+                                 formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('command', choices=['init', 'rollover', 'archive', 'list'])
+parser.add_argument('--table', action='append',
+                    help='table to work on, repeatable (default: PARTITION_TABLES)')
+parser.add_argument('--before', type=lambda value: datetime.strptime(value, '%Y-%m'),
+                    help='archive: months before this YYYY-MM')
+parser.add_argument('--drop', action='store_true',
+                    help='archive: drop the archive tables instead of keeping them')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    with app.app_context():
+        tables = args.table or app.config['PARTITION_TABLES']
+        if args.command == 'list':
+            for table in tables:
+                list_partitions(table)
+            sys.exit()
+        if db.engine.dialect.name != 'mysql':
+            sys.exit('Partitioning needs MySQL.')
+        if args.command == 'archive' and args.before is None:
+            sys.exit('archive needs --before YYYY-MM.')
+
+        conn = db.engine.connect()
+        try:
+            for table in tables:
+                if args.command == 'init':
+                    init(conn, table)
+                elif args.command == 'rollover':
+                    rollover(conn, table)
+                else:
+                    archive(conn, table, args.before, drop=args.drop)
+        finally:
+            conn.close()
@@ -0,0 +1,36 @@
+""" Print a participant's rows of all tables in time order, as NDJSON
+
+Reads the timeline page by page like the /timeline API, see
+app/timeline/query.py, so memory stays bounded however long it is.
+
+    python db_timeline.py <user_id> --since 2020-10-01 --tables activity,data
+    python db_timeline.py <user_id> --limit 100 --cursor <cursor> --bodies
+"""
+import argparse
+import json
+import sys
+
+from sqlplatform import app
+from app.save_data.ingest import parse_timestamp
+from app.timeline.query import TABLES, timeline
+
+parser = argparse.ArgumentParser(description=__doc__,
+                                 formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('user_id')
+parser.add_argument('--tables', type=lambda value: value.split(','),
+                    help=f'comma separated, among {", ".join(TABLES)}')
+parser.add_argument('--since', type=parse_timestamp, help='ISO time to start at')
+parser.add_argument('--until', type=parse_timestamp, help='ISO time to end before')
+parser.add_argument('--cursor', help='continue after this cursor')
+parser.add_argument('--limit', type=int, help='rows at most (default: all)')
+parser.add_argument('--bodies', action='store_true',
+                    help='include html and data payloads')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.tables and not set(args.tables) <= set(TABLES):
+        parser.error(f'--tables must be among {", ".join(TABLES)}')
+    with app.app_context():
+        for record in timeline(args.user_id, args.tables, args.since,
+                               args.until, args.cursor, args.limit, args.bodies):
+            sys.stdout.write(json.dumps(record) + '\n')
@@ -1,4 +1,5 @@
 import os
+import shutil
 
 def num_cpus():
     if not hasattr(os, "sysconf"):
@@ -18,9 +19,34 @@ errorlog = "-"
 accesslog = "-"
 
 bind = 'localhost:5000'
-workers = num_cpus() * 2 + 1 # 257
+
+# 'sync' (default) or 'gevent', see deployment/README.md
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'sync')
+if worker_class == 'gevent':
+    # Each worker serves many slow uploads while they are read
+    workers = num_cpus() + 1
+    worker_connections = 100
+else:
+    workers = num_cpus() * 2 + 1 # 257
 
 timeout = 3 * 60  # 3 minutes
 keepalive = 24 * 60 * 60  # 1 day
 
 capture_output = True
+
+# Workers share their metrics through files in this directory, see app/metrics
+_METRICS = os.environ.setdefault('prometheus_multiproc_dir',
+                                  os.path.join(_VAR, 'metrics'))
+
+def on_starting(server):
+    # Start from empty metrics
+    shutil.rmtree(_METRICS, ignore_errors=True)
+    os.makedirs(_METRICS)
+
+def post_fork(server, worker):
+    # Size the database pool of the worker, see config.db_pool_size
+    os.environ['GUNICORN_WORKERS'] = str(server.cfg.workers)
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,22 @@
+""" Replay spooled /save_data requests into the SQL database
+
+Runs next to the gunicorn workers when INGEST_MODE = 'spool', see
+app/save_data/spool.py and deployment/supervisor.conf.
+"""
+import argparse
+from sqlplatform import app
+from app.save_data.spool import Drainer
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('--once', action='store_true',
+                    help='drain the spool once and exit')
+parser.add_argument('--poll', type=float, default=1.0,
+                    help='seconds to wait when the spool is empty')
+args = parser.parse_args()
+
+with app.app_context():
+    drainer = Drainer(app.config['SPOOL_DIR'], app.config['SPOOL_DRAIN_BATCH'])
+    if args.once:
+        print(f'Drained {drainer.drain()} records.')
+    else:
+        drainer.run(args.poll)
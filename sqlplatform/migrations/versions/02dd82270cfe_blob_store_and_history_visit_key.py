@@ -0,0 +1,53 @@
+"""blob store and history visit key
+
+Revision ID: 02dd82270cfe
+Revises: 96bd8dd5dba2
+Create Date: 2026-10-18 09:27:27.346395
+
+Removes duplicate history visits before adding the unique (user_id, hv_id)
+key, which scans browser_history once.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from app import schema
+
+
+# revision identifiers, used by Alembic.
+revision = '02dd82270cfe'
+down_revision = '96bd8dd5dba2'
+branch_labels = None
+depends_on = None
+
+
+HTML_TABLES = ['website_history', 'snapshots', 'activity']
+
+
+def upgrade():
+    schema.delete_duplicates('browser_history', 'sql_id', ['user_id', 'hv_id'])
+    schema.create_index('uq_browser_history_user_hv', 'browser_history',
+                        ['user_id', 'hv_id'], unique=True)
+
+    op.create_table(
+        'html_blob',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('hash', sa.String(length=64), nullable=False),
+        sa.Column('codec', sa.String(length=10), nullable=True),
+        sa.Column('size', sa.BigInteger(), nullable=True),
+        sa.Column('data', sa.LargeBinary(length=4294000000), nullable=True),
+        sa.Column('created', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('hash')
+    )
+    for table in HTML_TABLES:
+        op.add_column(table, sa.Column('html_hash', sa.String(length=64),
+                                       nullable=True))
+
+
+def downgrade():
+    for table in HTML_TABLES:
+        with op.batch_alter_table(table) as batch:
+            batch.drop_column('html_hash')
+    op.drop_table('html_blob')
+    schema.drop_index('uq_browser_history_user_hv', 'browser_history')
@@ -0,0 +1,53 @@
+"""url interning
+
+Revision ID: 13090643364b
+Revises: af0013a0c1bc
+Create Date: 2026-10-18 09:52:40.503117
+
+Adds the url table and an indexed url_id to the history tables. New rows
+reference their url by id; existing rows keep the url text until
+`python db_jobs.py url-ids` moves it to the url table.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from app import schema
+
+
+# revision identifiers, used by Alembic.
+revision = '13090643364b'
+down_revision = 'af0013a0c1bc'
+branch_labels = None
+depends_on = None
+
+
+URL_TABLES = ['browser_history', 'website_history', 'snapshots', 'activity']
+
+
+def upgrade():
+    op.create_table(
+        'url',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('url_hash', sa.String(length=64), nullable=False),
+        sa.Column('url', sa.Text(), nullable=True),
+        sa.Column('domain', sa.String(length=255), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('url_hash')
+    )
+    op.create_index('ix_url_domain', 'url', ['domain'], unique=False)
+
+    for table in URL_TABLES:
+        op.add_column(table, sa.Column('url_id', sa.Integer(), nullable=True))
+        schema.create_index(f'ix_{table}_url_id', table, ['url_id'])
+
+
+def downgrade():
+    # Rows converted by the url-ids job need their url text back first, see
+    # `python db_jobs.py url-ids --revert`
+    for table in URL_TABLES:
+        schema.drop_index(f'ix_{table}_url_id', table)
+        with op.batch_alter_table(table) as batch:
+            batch.drop_column('url_id')
+    op.drop_index('ix_url_domain', table_name='url')
+    op.drop_table('url')
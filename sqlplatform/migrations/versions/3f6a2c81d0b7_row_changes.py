@@ -0,0 +1,36 @@
+"""row changes
+
+Revision ID: 3f6a2c81d0b7
+Revises: e41b7c9a2d58
+Create Date: 2026-10-18 17:20:13.540921
+
+Adds the catalog of id ranges that db_jobs.py, db_features.py and
+db_partitions.py update or delete in place, which incremental backups read
+again, see app/changes.py.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f6a2c81d0b7'
+down_revision = 'e41b7c9a2d58'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'row_change',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('table_name', sa.String(length=64), nullable=False),
+        sa.Column('id_start', sa.BigInteger(), nullable=False),
+        sa.Column('id_end', sa.BigInteger(), nullable=False),
+        sa.Column('created', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('row_change')
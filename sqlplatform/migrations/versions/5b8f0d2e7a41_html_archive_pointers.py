@@ -0,0 +1,42 @@
+"""html archive pointers
+
+Revision ID: 5b8f0d2e7a41
+Revises: 9e3c3d09dd6d
+Create Date: 2026-10-18 11:40:53.207164
+
+Adds where the data of an archived html_blob row is in the segment files,
+and an index on `created` to find the blobs old enough to archive. Blobs are
+moved by `python db_jobs.py html-archive`.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from app import schema
+
+
+# revision identifiers, used by Alembic.
+revision = '5b8f0d2e7a41'
+down_revision = '9e3c3d09dd6d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('html_blob', sa.Column('archive_segment', sa.Integer(),
+                                         nullable=True))
+    op.add_column('html_blob', sa.Column('archive_offset', sa.BigInteger(),
+                                         nullable=True))
+    op.add_column('html_blob', sa.Column('archive_length', sa.BigInteger(),
+                                         nullable=True))
+    schema.create_index('ix_html_blob_created', 'html_blob', ['created'])
+
+
+def downgrade():
+    # Archived blobs need their data back first, see
+    # `python db_jobs.py html-archive --revert`
+    schema.drop_index('ix_html_blob_created', 'html_blob')
+    with op.batch_alter_table('html_blob') as batch:
+        batch.drop_column('archive_length')
+        batch.drop_column('archive_offset')
+        batch.drop_column('archive_segment')
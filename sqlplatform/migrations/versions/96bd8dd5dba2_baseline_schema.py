@@ -0,0 +1,108 @@
+"""baseline schema
+
+Revision ID: 96bd8dd5dba2
+Revises: 
+Create Date: 2026-10-18 09:27:26.596990
+
+Tables as created by db_create.py before migrations were introduced. Stamp
+existing databases with `flask db stamp 96bd8dd5dba2` instead of running it.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '96bd8dd5dba2'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'user',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('user_id', sa.String(length=128), nullable=True),
+        sa.Column('browser', sa.String(length=10), nullable=True),
+        sa.Column('consent', sa.Boolean(), nullable=True),
+        sa.Column('consent_fb', sa.Boolean(), nullable=True),
+        sa.Column('install_time', sa.String(length=128), nullable=True),
+        sa.Column('version', sa.String(length=10), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table(
+        'data',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('api', sa.String(length=128), nullable=True),
+        sa.Column('data', sa.Text(length=4294000000), nullable=True),
+        sa.Column('user_id', sa.String(length=128), nullable=True),
+        sa.Column('worker_id', sa.String(length=128), nullable=True),
+        sa.Column('timestamp', sa.String(length=128), nullable=True),
+        sa.Column('version', sa.String(length=25), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table(
+        'browser_history',
+        sa.Column('sql_id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('hv_id', sa.String(length=260), nullable=True),
+        sa.Column('id', sa.String(length=128), nullable=True),
+        sa.Column('visitId', sa.String(length=128), nullable=True),
+        sa.Column('url', sa.Text(), nullable=True),
+        sa.Column('visitTime', sa.BigInteger(), nullable=True),
+        sa.Column('referringVisitId', sa.String(length=128), nullable=True),
+        sa.Column('transition', sa.String(length=25), nullable=True),
+        sa.Column('user_id', sa.String(length=128), nullable=True),
+        sa.Column('worker_id', sa.String(length=128), nullable=True),
+        sa.Column('timestamp', sa.String(length=128), nullable=True),
+        sa.Column('version', sa.String(length=25), nullable=True),
+        sa.PrimaryKeyConstraint('sql_id')
+    )
+    op.create_table(
+        'website_history',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('url', sa.Text(), nullable=True),
+        sa.Column('name', sa.String(length=25), nullable=True),
+        sa.Column('html', sa.Text(length=4294000000), nullable=True),
+        sa.Column('user_id', sa.String(length=128), nullable=True),
+        sa.Column('worker_id', sa.String(length=128), nullable=True),
+        sa.Column('timestamp', sa.String(length=128), nullable=True),
+        sa.Column('version', sa.String(length=25), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table(
+        'snapshots',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('wintab', sa.String(length=128), nullable=True),
+        sa.Column('incognito', sa.Boolean(), nullable=True),
+        sa.Column('url', sa.Text(), nullable=True),
+        sa.Column('html', sa.Text(length=4294000000), nullable=True),
+        sa.Column('user_id', sa.String(length=128), nullable=True),
+        sa.Column('worker_id', sa.String(length=128), nullable=True),
+        sa.Column('timestamp', sa.String(length=128), nullable=True),
+        sa.Column('version', sa.String(length=25), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table(
+        'activity',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('wintab', sa.String(length=128), nullable=True),
+        sa.Column('lastwt', sa.String(length=128), nullable=True),
+        sa.Column('type', sa.String(length=25), nullable=True),
+        sa.Column('url', sa.Text(), nullable=True),
+        sa.Column('html', sa.Text(length=4294000000), nullable=True),
+        sa.Column('links', sa.Text(length=16777000), nullable=True),
+        sa.Column('tweet_ids', sa.Text(), nullable=True),
+        sa.Column('youtube_iframes', sa.Text(), nullable=True),
+        sa.Column('user_id', sa.String(length=128), nullable=True),
+        sa.Column('worker_id', sa.String(length=128), nullable=True),
+        sa.Column('timestamp', sa.String(length=128), nullable=True),
+        sa.Column('version', sa.String(length=25), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    for table in ['activity', 'snapshots', 'website_history',
+                  'browser_history', 'data', 'user']:
+        op.drop_table(table)
@@ -0,0 +1,45 @@
+"""table partition catalog
+
+Revision ID: 9e3c3d09dd6d
+Revises: 13090643364b
+Create Date: 2026-10-18 11:02:17.384912
+
+Adds the catalog of the monthly partitions of activity and snapshots. The
+tables themselves are partitioned by `python db_partitions.py init`, which
+rebuilds them, see db_partitions.py.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9e3c3d09dd6d'
+down_revision = '13090643364b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'table_partition',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('table_name', sa.String(length=64), nullable=False),
+        sa.Column('name', sa.String(length=64), nullable=False),
+        sa.Column('id_start', sa.BigInteger(), nullable=True),
+        sa.Column('id_end', sa.BigInteger(), nullable=True),
+        sa.Column('period_start', sa.DateTime(), nullable=True),
+        sa.Column('period_end', sa.DateTime(), nullable=True),
+        sa.Column('state', sa.String(length=10), nullable=True),
+        sa.Column('archive_table', sa.String(length=64), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ux_table_partition_name', 'table_partition',
+                    ['table_name', 'name'], unique=True)
+
+
+def downgrade():
+    # Partitioned tables keep their partitions, remove them with
+    # `ALTER TABLE <table> REMOVE PARTITIONING` (rebuilds the table)
+    op.drop_index('ux_table_partition_name', table_name='table_partition')
+    op.drop_table('table_partition')
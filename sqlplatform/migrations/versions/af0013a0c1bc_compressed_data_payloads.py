@@ -0,0 +1,34 @@
+"""compressed data payloads
+
+Revision ID: af0013a0c1bc
+Revises: fac1e9ecf263
+Create Date: 2026-10-18 09:41:02.118530
+
+Adds the compressed `payload` and its `codec` to the generic data table. New
+rows are written there; existing base64 rows keep working through
+app.blobs.decode_data and are converted by `python db_jobs.py data-payloads`.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'af0013a0c1bc'
+down_revision = 'fac1e9ecf263'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('data', sa.Column('payload', sa.LargeBinary(length=4294000000),
+                                    nullable=True))
+    op.add_column('data', sa.Column('codec', sa.String(length=10), nullable=True))
+
+
+def downgrade():
+    # Converted rows have to be turned back into base64 first, see
+    # `python db_jobs.py data-payloads --revert`
+    with op.batch_alter_table('data') as batch:
+        batch.drop_column('codec')
+        batch.drop_column('payload')
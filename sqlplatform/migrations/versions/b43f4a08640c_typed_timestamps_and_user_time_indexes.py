@@ -0,0 +1,105 @@
+"""typed timestamps and user time indexes
+
+Revision ID: b43f4a08640c
+Revises: 02dd82270cfe
+Create Date: 2026-10-18 09:27:28.101648
+
+Expand step of the timestamp conversion, safe to run against a live database:
+
+1. Add DATETIME(3) columns next to the `timestamp`/`install_time` strings
+2. Backfill them in primary key chunks
+3. Rename the strings to `*_raw` and the new columns into their place
+4. Add (user_id, timestamp) indexes and the unique user.user_id index. The
+   later registrations of a user_id are moved to user_reinstall first.
+
+Deploy the matching application code right after this revision, see
+migrations/README. The `*_raw` columns are dropped by the next revision.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+from app import schema
+from app.save_data.ingest import parse_timestamp
+
+
+# revision identifiers, used by Alembic.
+revision = 'b43f4a08640c'
+down_revision = '02dd82270cfe'
+branch_labels = None
+depends_on = None
+
+
+Timestamp = sa.DateTime().with_variant(mysql.DATETIME(fsp=3), 'mysql')
+
+# Table, primary key and timestamp column to convert
+TIMESTAMP_COLUMNS = [
+    ('user', 'id', 'install_time'),
+    ('data', 'id', 'timestamp'),
+    ('browser_history', 'sql_id', 'timestamp'),
+    ('website_history', 'id', 'timestamp'),
+    ('snapshots', 'id', 'timestamp'),
+    ('activity', 'id', 'timestamp'),
+]
+
+# Columns of the user rows moved to user_reinstall
+USER_COLUMNS = ['user_id', 'browser', 'consent', 'consent_fb', 'install_time',
+                'version']
+
+
+def convert(value):
+    try:
+        return parse_timestamp(value)
+    except ValueError:
+        return None
+
+
+def upgrade():
+    for table, pk, column in TIMESTAMP_COLUMNS:
+        op.add_column(table, sa.Column(f'{column}_dt', Timestamp, nullable=True))
+        schema.backfill(table, pk, column, f'{column}_dt', convert)
+
+        with op.batch_alter_table(table) as batch:
+            batch.alter_column(column, new_column_name=f'{column}_raw',
+                               existing_type=sa.String(length=128))
+            batch.alter_column(f'{column}_dt', new_column_name=column,
+                               existing_type=Timestamp)
+
+        if table != 'user':
+            schema.create_index(f'ix_{table}_user_timestamp', table,
+                                ['user_id', 'timestamp'])
+
+    op.create_table(
+        'user_reinstall',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('user_id', sa.String(length=128), nullable=True),
+        sa.Column('browser', sa.String(length=10), nullable=True),
+        sa.Column('consent', sa.Boolean(), nullable=True),
+        sa.Column('consent_fb', sa.Boolean(), nullable=True),
+        sa.Column('install_time', Timestamp, nullable=True),
+        sa.Column('version', sa.String(length=10), nullable=True),
+        sa.Column('created', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_user_reinstall_user_id', 'user_reinstall', ['user_id'],
+                    unique=False)
+    schema.delete_duplicates('user', 'id', ['user_id'], copy_to='user_reinstall',
+                             copy_columns=USER_COLUMNS)
+    schema.create_index('ux_user_user_id', 'user', ['user_id'], unique=True)
+
+
+def downgrade():
+    schema.drop_index('ux_user_user_id', 'user')
+    op.drop_index('ix_user_reinstall_user_id', table_name='user_reinstall')
+    op.drop_table('user_reinstall')
+    for table, pk, column in reversed(TIMESTAMP_COLUMNS):
+        if table != 'user':
+            schema.drop_index(f'ix_{table}_user_timestamp', table)
+        with op.batch_alter_table(table) as batch:
+            batch.alter_column(column, new_column_name=f'{column}_dt',
+                               existing_type=Timestamp)
+            batch.alter_column(f'{column}_raw', new_column_name=column,
+                               existing_type=sa.String(length=128))
+        with op.batch_alter_table(table) as batch:
+            batch.drop_column(f'{column}_dt')
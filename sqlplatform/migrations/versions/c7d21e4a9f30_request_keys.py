@@ -0,0 +1,38 @@
+"""request keys
+
+Revision ID: c7d21e4a9f30
+Revises: 5b8f0d2e7a41
+Create Date: 2026-10-18 12:14:06.551820
+
+Adds the keys of saved website history, snapshot and activity requests, so
+their retries are not saved again. `python db_jobs.py request-keys` deletes
+keys older than REQUEST_KEY_DAYS.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7d21e4a9f30'
+down_revision = '5b8f0d2e7a41'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'request_key',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('key', sa.String(length=64), nullable=False),
+        sa.Column('created', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('key')
+    )
+    op.create_index('ix_request_key_created', 'request_key', ['created'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_request_key_created', table_name='request_key')
+    op.drop_table('request_key')
@@ -0,0 +1,87 @@
+"""extracted page features
+
+Revision ID: e41b7c9a2d58
+Revises: c7d21e4a9f30
+Create Date: 2026-10-18 15:02:41.208113
+
+Adds the tables db_features.py fills with the titles, links, search results,
+video and tweet ids parsed from the stored pages, and the watermarks of the
+rows it has parsed. Run `python db_features.py` to fill them.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+# revision identifiers, used by Alembic.
+revision = 'e41b7c9a2d58'
+down_revision = 'c7d21e4a9f30'
+branch_labels = None
+depends_on = None
+
+Timestamp = sa.DateTime().with_variant(mysql.DATETIME(fsp=3), 'mysql')
+
+
+def upgrade():
+    op.create_table(
+        'extracted_page',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('source', sa.String(length=32), nullable=False),
+        sa.Column('source_id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.String(length=128), nullable=True),
+        sa.Column('timestamp', Timestamp, nullable=True),
+        sa.Column('url_id', sa.Integer(), nullable=True),
+        sa.Column('domain', sa.String(length=255), nullable=True),
+        sa.Column('title', sa.Text(), nullable=True),
+        sa.Column('html_size', sa.BigInteger(), nullable=True),
+        sa.Column('n_links', sa.Integer(), nullable=True),
+        sa.Column('n_results', sa.Integer(), nullable=True),
+        sa.Column('version', sa.Integer(), nullable=True),
+        sa.Column('error', sa.String(length=255), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ux_extracted_page_source', 'extracted_page',
+                    ['source', 'source_id'], unique=True)
+    op.create_index('ix_extracted_page_user_timestamp', 'extracted_page',
+                    ['user_id', 'timestamp'], unique=False)
+    op.create_index('ix_extracted_page_domain', 'extracted_page', ['domain'],
+                    unique=False)
+
+    op.create_table(
+        'extracted_item',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('source', sa.String(length=32), nullable=False),
+        sa.Column('source_id', sa.Integer(), nullable=False),
+        sa.Column('kind', sa.String(length=16), nullable=False),
+        sa.Column('position', sa.Integer(), nullable=True),
+        sa.Column('value', sa.Text(), nullable=True),
+        sa.Column('domain', sa.String(length=255), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_extracted_item_source', 'extracted_item',
+                    ['source', 'source_id'], unique=False)
+    op.create_index('ix_extracted_item_kind_domain', 'extracted_item',
+                    ['kind', 'domain'], unique=False)
+
+    op.create_table(
+        'extract_watermark',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('source', sa.String(length=32), nullable=False),
+        sa.Column('last_id', sa.BigInteger(), nullable=True),
+        sa.Column('version', sa.Integer(), nullable=True),
+        sa.Column('updated', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('source')
+    )
+
+
+def downgrade():
+    op.drop_table('extract_watermark')
+    op.drop_index('ix_extracted_item_kind_domain', table_name='extracted_item')
+    op.drop_index('ix_extracted_item_source', table_name='extracted_item')
+    op.drop_table('extracted_item')
+    op.drop_index('ix_extracted_page_domain', table_name='extracted_page')
+    op.drop_index('ix_extracted_page_user_timestamp', table_name='extracted_page')
+    op.drop_index('ux_extracted_page_source', table_name='extracted_page')
+    op.drop_table('extracted_page')
@@ -0,0 +1,62 @@
+"""drop raw timestamp columns
+
+Revision ID: fac1e9ecf263
+Revises: b43f4a08640c
+Create Date: 2026-10-18 09:27:28.706803
+
+Contract step of the timestamp conversion. Converts rows written between the
+backfill and the rename of the previous revision, then drops the `*_raw`
+string columns. Dropping a column rebuilds the table on MySQL (online, but
+I/O heavy), so run it in a quiet period.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from app import schema
+from app.save_data.ingest import parse_timestamp
+
+
+# revision identifiers, used by Alembic.
+revision = 'fac1e9ecf263'
+down_revision = 'b43f4a08640c'
+branch_labels = None
+depends_on = None
+
+
+# Table, primary key and timestamp column
+TIMESTAMP_COLUMNS = [
+    ('user', 'id', 'install_time'),
+    ('data', 'id', 'timestamp'),
+    ('browser_history', 'sql_id', 'timestamp'),
+    ('website_history', 'id', 'timestamp'),
+    ('snapshots', 'id', 'timestamp'),
+    ('activity', 'id', 'timestamp'),
+]
+
+
+def convert(value):
+    try:
+        return parse_timestamp(value)
+    except ValueError:
+        return None
+
+
+def to_iso(value):
+    # SQLite returns datetimes of untyped columns as strings
+    value = parse_timestamp(value) if isinstance(value, str) else value
+    return value.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+def upgrade():
+    for table, pk, column in TIMESTAMP_COLUMNS:
+        schema.backfill(table, pk, f'{column}_raw', column, convert)
+        with op.batch_alter_table(table) as batch:
+            batch.drop_column(f'{column}_raw')
+
+
+def downgrade():
+    for table, pk, column in TIMESTAMP_COLUMNS:
+        op.add_column(table, sa.Column(f'{column}_raw', sa.String(length=128),
+                                       nullable=True))
+        schema.backfill(table, pk, column, f'{column}_raw', to_iso)